@@ -0,0 +1,177 @@
+import dataclasses
+import numpy as np
+
+# the "closest days" predictor of server/src/prediction.ts (makeClosestLine + averageDays), on the cached grid.
+# instead of one cutoff at a time it scores every candidate day for a whole batch of queries with a few matmuls.
+#
+# differences to the ts version: today and the candidate days are compared at the grid slots instead of at
+# today's raw sample times, a candidate day counts at the slots within the span of its samples (no 15 minute
+# grace at the ends), and history is not cut short when old weeks are sparse.
+# like makeClosestLine, it falls back to the weekday average with 3 or fewer history weeks. hist.length counts the
+# weeks built, empty ones included (at least 60 in buildWeeksAsOf), so the first weeks of the data don't trigger it
+# there either; with history never cut short here it is num_weeks <= 3.
+
+MINIMUM_COMPARE_POINTS = 6
+OUTPUTS = ('value', 'lower', 'upper', 'lowerWide', 'upperWide')
+
+
+@dataclasses.dataclass
+class AnalogParams:
+    # the defaults are the tuned constants of prediction.ts
+    pool_size: int = 18
+    min_scale: float = 0.5
+    max_scale: float = 1.25
+    weekday_penalty: float = 8
+    match_tail: float = 3
+    rank_decay: float = 3
+    num_weeks: int = 120
+    inner_lower_quantile: float = 0.25
+    inner_upper_quantile: float = 0.75
+
+
+def week_start(days):
+    # ordinal of the sunday that starts the week (js getDay() weeks, like buildWeeksAsOf)
+    days = np.asarray(days, dtype=np.int64)
+    return days - days % 7
+
+
+def weighted_quantile(values, weights, q):
+    # weightedQuantile of prediction.ts along axis 1: linear interpolation between the two samples straddling
+    # the target cumulative weight. entries with weight 0 are ignored; where all are, the result is 0
+    sort_key = np.where(weights > 0, values, np.inf)
+    order = np.argsort(sort_key, axis=1, kind='stable')
+    v = np.take_along_axis(values, order, axis=1)
+    w = np.take_along_axis(weights, order, axis=1)
+    cum = np.cumsum(w, axis=1)
+    target = q * cum[:, -1:]
+    num_valid = (w > 0).sum(axis=1, keepdims=True)
+
+    i = np.argmax(cum >= target, axis=1)[:, None]
+    i = np.clip(i, 0, np.maximum(num_valid - 1, 0))
+    prev = np.maximum(i - 1, 0)
+    v_i = np.take_along_axis(v, i, axis=1)
+    v_prev = np.take_along_axis(v, prev, axis=1)
+    w_i = np.take_along_axis(w, i, axis=1)
+    cum_prev = np.take_along_axis(cum, prev, axis=1)
+    frac = np.where(w_i > 0, (target - cum_prev) / np.where(w_i > 0, w_i, 1), 0)
+    out = np.where(i == 0, v_i, v_prev + frac * (v_i - v_prev))[:, 0]
+    return np.where(num_valid[:, 0] > 0, out, 0)
+
+
+def average_days(values, valid, weights, params: AnalogParams):
+    # averageDays of prediction.ts for a batch: values/valid (queries, pool, slots), weights (queries, pool).
+    # returns the weighted mean line and the inner (quartile) and outer (min-max) bands, all 0 where no day counts
+    w = weights[:, :, None] * valid
+    total = w.sum(axis=1)
+    has = total > 0
+    value = (w * values).sum(axis=1) / np.where(has, total, 1)
+
+    def quantile(q):
+        # slots as extra queries, so the pool is axis 1
+        flat = weighted_quantile(values.transpose(0, 2, 1).reshape(-1, values.shape[1]),
+                                 w.transpose(0, 2, 1).reshape(-1, w.shape[1]), q)
+        return flat.reshape(value.shape)
+
+    # the inner band must contain the central estimate, the outer one the inner one
+    lower = np.minimum(quantile(params.inner_lower_quantile), value)
+    upper = np.maximum(quantile(params.inner_upper_quantile), value)
+    lower_wide = np.minimum(quantile(0.0), lower)
+    upper_wide = np.maximum(quantile(1.0), upper)
+    return {name: np.where(has, out, 0.0)
+            for name, out in zip(OUTPUTS, (value, lower, upper, lower_wide, upper_wide))}
+
+
+class AnalogPredictor:
+    # history: the full grid (days, weekday, occupancy) and for every day the mask of slots within its samples.
+    # called like the backtest predictors, a query only ever uses candidate days from the weeks before its own
+    def __init__(self, days, weekday, occupancy, span, params: AnalogParams = None, chunk=256):
+        self.days = np.asarray(days, dtype=np.int64)
+        self.weekday = np.asarray(weekday, dtype=np.int64)
+        self.valid = np.asarray(span, dtype=bool)
+        self.x = np.asarray(occupancy, dtype=np.float64)
+        self.params = params or AnalogParams()
+        self.chunk = chunk
+        self.name = 'analog'
+
+        # the per-candidate factors of the matmuls, computed once
+        valid = self.valid.astype(np.float64)
+        self._v = valid
+        self._vx = valid * self.x
+        self._vxx = valid * self.x * self.x
+        self._week_start = week_start(self.days)
+
+    def with_params(self, params: AnalogParams):
+        # same history, other constants (sweeps)
+        other = object.__new__(AnalogPredictor)
+        other.__dict__.update(self.__dict__)
+        other.params = params
+        return other
+
+    def __call__(self, days, weekday, cutoff_slots, prefixes, observed):
+        # prefixes: (queries, slots) today's occupancy as of the cutoff, observed: the slots of it that are
+        # actual observations (after the first sample of the day, up to the cutoff)
+        out = {name: np.zeros(prefixes.shape) for name in OUTPUTS}
+        for start in range(0, len(prefixes), self.chunk):
+            part = slice(start, start + self.chunk)
+            for name, value in self._predict(np.asarray(days)[part], np.asarray(weekday)[part],
+                                             np.asarray(prefixes, dtype=np.float64)[part],
+                                             np.asarray(observed, dtype=bool)[part]).items():
+                out[name][part] = value
+        return out
+
+    def _history(self, days):
+        # (queries, candidates): is the candidate in the history weeks of the query, and the week weight
+        weeks_back = (week_start(days)[:, None] - self._week_start[None, :]) // 7
+        in_history = (weeks_back >= 1) & (weeks_back <= self.params.num_weeks)
+        return in_history, np.where(weeks_back <= 4, 3.0, 1.0)
+
+    def _predict(self, days, weekday, y, observed):
+        p = self.params
+        in_history, week_weight = self._history(days)
+        same_weekday = weekday[:, None] == self.weekday[None, :]
+
+        # per-point weight, ramping from 1 up to 1 + match_tail at the latest observed point
+        o = observed.astype(np.float64)
+        num_obs = o.sum(axis=1)
+        index = np.cumsum(o, axis=1) - 1
+        last = np.maximum(1, num_obs - 1)
+        w = o * (1 + p.match_tail * index / last[:, None])
+
+        # weighted least squares of today on every candidate (scale only), as sums over the shared slots
+        sum_xy = (w * y) @ self._vx.T
+        sum_xx = w @ self._vxx.T
+        sum_yy = (w * y * y) @ self._v.T
+        weight_sum = w @ self._v.T
+        compared = o @ self._v.T
+        m = np.where(sum_xx > 0, sum_xy / np.where(sum_xx > 0, sum_xx, 1), 1.0)
+        m = np.clip(m, p.min_scale, p.max_scale)
+        error = np.maximum(sum_yy - 2 * m * sum_xy + m * m * sum_xx, 0)
+
+        enough = (compared >= MINIMUM_COMPARE_POINTS) & (compared >= num_obs[:, None] * 0.8 - 1)
+        mse = np.where(enough, error / np.where(weight_sum > 0, weight_sum, 1), np.inf)
+        mse = mse / week_weight
+        mse = np.where(same_weekday, mse, mse * p.weekday_penalty)
+        mse = np.where(in_history, mse, np.inf)
+
+        # the pool_size closest days, best first, weighted by rank
+        pool = min(p.pool_size, mse.shape[1])
+        idx = np.argpartition(mse, pool - 1, axis=1)[:, :pool] if pool < mse.shape[1] else np.tile(np.arange(pool), (len(mse), 1))
+        idx = np.take_along_axis(idx, np.argsort(np.take_along_axis(mse, idx, axis=1), axis=1, kind='stable'), axis=1)
+        finite = np.isfinite(np.take_along_axis(mse, idx, axis=1))
+        rank_weight = (p.pool_size - np.arange(pool, dtype=np.float64)) ** p.rank_decay * finite
+        scale = np.take_along_axis(m, idx, axis=1)
+        out = average_days(scale[:, :, None] * self.x[idx], self.valid[idx] & finite[:, :, None], rank_weight, p)
+
+        # too little of today to compare, too few history weeks (hist.length <= 3 in the ts) or no candidate could be
+        # scored: plain weighted average of the weekday
+        fallback = (num_obs < MINIMUM_COMPARE_POINTS) | ~finite.any(axis=1) | (p.num_weeks <= 3)
+        if fallback.any():
+            candidates = in_history[fallback] & same_weekday[fallback]
+            width = max(int(candidates.sum(axis=1).max()), 1)
+            idx = np.argsort(~candidates, axis=1, kind='stable')[:, :width]
+            member = np.take_along_axis(candidates, idx, axis=1)
+            weights = np.take_along_axis(week_weight[fallback], idx, axis=1) * member
+            average = average_days(self.x[idx], self.valid[idx] & member[:, :, None], weights, p)
+            for name in OUTPUTS:
+                out[name][fallback] = average[name]
+        return out
@@ -0,0 +1,33 @@
+import json
+import numpy as np
+import torch
+
+# loading side of ai/export.py. deliberately only torch and numpy: serving an exported model must not pull in
+# the training stack or ai/data.py (pandas, the csv cache)
+
+
+def load_artifact(path, map_location='cpu'):
+    # (scripted module, meta dict written by the export)
+    extra_files = {'meta.json': ''}
+    module = torch.jit.load(path, map_location=map_location, _extra_files=extra_files)
+    module.eval()
+    return module, json.loads(extra_files['meta.json'])
+
+
+class ArtifactPredictor:
+    # exported model behind the predictor interface of ai/backtest.py (and ai/serve.py)
+    def __init__(self, module, name='artifact', max_rows=512):
+        self.module = module
+        self.name = name
+        self.max_rows = max_rows
+
+    def __call__(self, days, weekday, cutoff_slots, prefixes, observed):
+        weekday = torch.as_tensor(np.asarray(weekday), dtype=torch.long)
+        prefixes = torch.as_tensor(np.asarray(prefixes), dtype=torch.float32)
+        cutoff_slots = torch.as_tensor(np.asarray(cutoff_slots), dtype=torch.long)
+        out = []
+        with torch.no_grad():
+            for start in range(0, len(prefixes), self.max_rows):
+                part = slice(start, start + self.max_rows)
+                out.append(self.module(weekday[part], prefixes[part], cutoff_slots[part]))
+        return {'value': torch.cat(out, dim=0).numpy().astype(np.float64)}
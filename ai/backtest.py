@@ -0,0 +1,399 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import itertools
+import dataclasses
+import numpy as np
+import torch
+
+from .data import (NUM_TIME_PER_DAY, GYM_GRID, day_ordinals, day_start_ns, resample_grid, arrivals_from_occupancy,
+                   occupancy_from_arrivals, load_grid, load_samples, load_splits)
+from .rollout import rollout, direct_forecast
+from .checkpoint import load_model_and_config
+from .analog import AnalogParams, AnalogPredictor
+from .main import MODELS_DIR
+from . import profiling
+
+# python -m ai.backtest --model ai/models/<run>/model_final.pt [--days all] [--out report.json] [--points points.npz]
+# python -m ai.backtest --predictor analog [--param pool_size=12,18,24 --param rank_decay=1,3]
+#
+# the as-of protocol of server/test/backtest.ts: at every cutoff the predictor only sees samples of the day up to the
+# cutoff, every later grid slot of the day is scored against what actually happened
+
+CUTOFF_HOURS = [8, 11, 14, 17, 20]  # wall-clock times we pretend "now" is
+HORIZON_BIN_MIN = 60  # metrics and conformal residuals per horizon bin, in minutes
+MAX_HORIZON_BIN = 17  # cap (window is 18h wide)
+HISTORY_DAYS = 56  # the first 8 weeks have too little history behind them
+CONFORMAL_QUANTILES = [0.05, 0.25, 0.75, 0.95]
+MIN_BIN_RESIDUALS = 40  # sparser bins use the global residual quantiles
+BAND_CLIP = (0, 100)
+
+NS_PER_MINUTE = 60 * 1_000_000_000
+
+
+def cutoff_slot(hour, grid=GYM_GRID):
+    # the grid slot at the cutoff time, it is the last one the predictor may see
+    return (hour * 60 - grid.start_minute) // grid.step_minutes
+
+
+def eval_days(grid, which='validation'):
+    # sorted day ordinals to evaluate: the held out validation days or all of them, without the first weeks
+    days = np.asarray(grid.days, dtype=np.int64)
+    days = days[days >= days[0] + HISTORY_DAYS] if len(days) else days
+    if which == 'validation':
+        held_out = np.array([day.toordinal() for day in load_splits()['validation_days']], dtype=np.int64)
+        days = days[np.isin(days, held_out)]
+    return days
+
+
+@profiling.timed('as_of_prefixes')
+def as_of_prefixes(times_ns, values, days, cutoff_hours, grid=GYM_GRID):
+    # (len(days), len(cutoff_hours), num_slots) occupancy, each row resampled only from the samples of its day
+    # at or before the cutoff (the no-leakage guard). slots after the cutoff hold junk the predictors must ignore
+    sample_days = day_ordinals(times_ns)
+    in_eval = np.isin(sample_days, days)
+    times_ns, values, sample_days = times_ns[in_eval], values[in_eval], sample_days[in_eval]
+    since_midnight = times_ns - day_start_ns(sample_days)
+
+    out = np.zeros((len(days), len(cutoff_hours), grid.num_slots))
+    for j, hour in enumerate(cutoff_hours):
+        keep = since_midnight <= hour * 60 * NS_PER_MINUTE
+        got_days, occupancy = resample_grid(times_ns[keep], values[keep], grid, min_samples=1, verbose=False)
+        # a day without any sample before the cutoff stays all zeros
+        out[np.searchsorted(days, got_days), j] = occupancy
+    return out
+
+
+def _sample_bounds(times_ns, days, grid=GYM_GRID):
+    # (len(days), num_slots) masks of the slots at or after the first sample of the day and of those at or
+    # before the last one
+    times_ns = np.sort(times_ns, kind='stable')
+    starts = day_start_ns(days)
+    first = np.searchsorted(times_ns, starts, side='left')
+    last = np.searchsorted(times_ns, starts + 86400 * 1_000_000_000, side='left') - 1
+    has_samples = (last >= first)[:, None]
+    first_t = times_ns[np.minimum(first, len(times_ns) - 1)]
+    last_t = times_ns[np.maximum(last, 0)]
+    slot_times = starts[:, None] + grid.offsets_ns()[None, :]
+    return has_samples & (slot_times >= first_t[:, None]), has_samples & (slot_times <= last_t[:, None])
+
+
+def observed_span(times_ns, days, grid=GYM_GRID):
+    # (len(days), num_slots) mask of the slots within the span of the day's samples; like the ts harness,
+    # nothing is scored before the first or after the last sample of a day
+    after_first, before_last = _sample_bounds(times_ns, days, grid)
+    return after_first & before_last
+
+
+class TransformerPredictor:
+    # the TransformerDecoder over all (day, cutoff) rows as one batch. decode='ar' is the greedy rollout, 'direct'
+    # reads the whole rest of the day off the horizon head in one forward pass (models trained with --objective
+    # horizon/both)
+    def __init__(self, model, use_arrival_data=True, max_rows=512, decode='ar'):
+        if decode not in ('ar', 'direct'):
+            raise ValueError(f"unknown decode {decode}")
+        if getattr(model, 'num_series', 0):
+            # the gym forecast has no series to pass, the model would fail on the first decode
+            raise ValueError("multi-series (--data wifi) models forecast buildings, not the gym, "
+                             "evaluate them with python -m ai.wifi")
+        if decode == 'direct' and not model.has_horizon_head():
+            raise ValueError("decode='direct' needs a model trained with a horizon head")
+        self.model = model
+        self.use_arrival_data = use_arrival_data
+        # the day token, see DayGridDataset
+        self.day_multiplier = 3 if use_arrival_data else 20
+        self.max_rows = max_rows
+        self.decode = direct_forecast if decode == 'direct' else rollout
+        self.name = 'transformer_direct' if decode == 'direct' else 'transformer'
+
+    def __call__(self, days, weekday, cutoff_slots, prefixes, observed):
+        # prefixes: (rows, num_slots) occupancy known up to and including cutoff_slots. returns {'value': (rows, num_slots)}.
+        # the model was trained on the grid as is, including the zeros before the first sample, so observed is unused
+        series = arrivals_from_occupancy(prefixes) if self.use_arrival_data else prefixes
+        x = torch.empty((len(series), series.shape[1] + 1), dtype=torch.float32)
+        x[:, 0] = torch.as_tensor(weekday, dtype=torch.float32) * self.day_multiplier
+        x[:, 1:] = torch.from_numpy(np.asarray(series, dtype=np.float32))
+        lengths = torch.as_tensor(cutoff_slots, dtype=torch.long) + 2  # day token + slots 0..cutoff
+
+        out = []
+        for start in range(0, len(x), self.max_rows):
+            out.append(self.decode(self.model, x[start:start + self.max_rows], lengths[start:start + self.max_rows],
+                                   NUM_TIME_PER_DAY + 1)[:, 1:])
+        forecast = torch.cat(out, dim=0)
+        if self.use_arrival_data:
+            forecast = occupancy_from_arrivals(forecast)
+        return {'value': forecast.cpu().numpy().astype(np.float64)}
+
+
+def run_predictor(predictor, days, weekday, cutoff_hours, prefixes, observed):
+    # one call for all (day, cutoff) rows. returns the outputs as (days, cutoffs, slots) and the wall-clock seconds
+    num_days, num_cutoffs, num_slots = prefixes.shape
+    cutoff_slots = np.tile([cutoff_slot(hour) for hour in cutoff_hours], num_days)
+    start = time.perf_counter()
+    outputs = predictor(np.repeat(days, num_cutoffs), np.repeat(weekday, num_cutoffs), cutoff_slots,
+                        prefixes.reshape(-1, num_slots), observed.reshape(-1, num_slots))
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    return {name: value.reshape(num_days, num_cutoffs, num_slots) for name, value in outputs.items()}, seconds
+
+
+def _pinball(actual, qhat, tau):
+    u = actual - qhat
+    return np.where(u >= 0, tau * u, (tau - 1) * u)
+
+
+def _band_metrics(actual, lo, hi, tau_lo, tau_hi):
+    return {
+        'coverage': float(np.mean((actual >= lo) & (actual <= hi))),
+        'width': float(np.mean(hi - lo)),
+        'pinball': [float(np.mean(_pinball(actual, lo, tau_lo))), float(np.mean(_pinball(actual, hi, tau_hi)))],
+    }
+
+
+def collect_points(outputs, actual, scored, days, cutoff_hours, grid=GYM_GRID):
+    # the scored points as flat arrays: every slot after the cutoff within the observed span of the day
+    num_days, num_cutoffs, num_slots = outputs['value'].shape
+    slot_minutes = grid.start_minute + grid.step_minutes * np.arange(num_slots)
+    horizon = slot_minutes[None, :] - np.asarray(cutoff_hours)[:, None] * 60  # (cutoffs, slots)
+    mask = scored[:, None, :] & (horizon[None] > 0)
+    day_pos, cutoff_pos, slot = np.nonzero(mask)
+    points = {
+        'day': days[day_pos],
+        'day_pos': day_pos,
+        'cutoff_hour': np.asarray(cutoff_hours)[cutoff_pos],
+        'slot': slot,
+        'horizon': horizon[cutoff_pos, slot],
+        'actual': actual[day_pos, slot].astype(np.float64),
+    }
+    for name, value in outputs.items():
+        points[name] = value[mask]
+    return points
+
+
+def evaluate(points):
+    # the metrics of backtest.ts on a set of points: MAE, the predictor's own bands (if any) and conformal bands
+    # calibrated on the even days and tested on the odd ones
+    value, actual = points['value'], points['actual']
+    abs_err = np.abs(value - actual)
+    bins = np.minimum(points['horizon'] // HORIZON_BIN_MIN, MAX_HORIZON_BIN)
+    report = {
+        'num_points': int(len(value)),
+        'mae': float(abs_err.mean()) if len(value) else None,
+        'mae_by_horizon': [{'from_min': int(b * HORIZON_BIN_MIN), 'to_min': int((b + 1) * HORIZON_BIN_MIN),
+                            'mae': float(abs_err[bins == b].mean()), 'n': int((bins == b).sum())}
+                           for b in np.unique(bins)],
+        'mae_by_cutoff': {str(int(h)): float(abs_err[points['cutoff_hour'] == h].mean())
+                          for h in np.unique(points['cutoff_hour'])},
+    }
+
+    calib = points['day_pos'] % 2 == 0
+    test = ~calib
+    if not calib.any() or not test.any():
+        return report
+
+    if 'lower' in points:
+        report['bands'] = {
+            'inner': _band_metrics(actual[test], points['lower'][test], points['upper'][test], 0.25, 0.75),
+            'outer': _band_metrics(actual[test], points['lowerWide'][test], points['upperWide'][test], 0.0, 1.0),
+        }
+
+    # per horizon bin residual quantiles, np.quantile interpolates linearly like quantile() in backtest.ts
+    residual = actual - value
+    global_q = np.quantile(residual[calib], CONFORMAL_QUANTILES)
+    by_bin = {}
+    for b in range(MAX_HORIZON_BIN + 1):
+        in_bin = residual[calib & (bins == b)]
+        by_bin[b] = np.quantile(in_bin, CONFORMAL_QUANTILES) if len(in_bin) >= MIN_BIN_RESIDUALS else global_q
+    table = np.stack([by_bin[b] for b in range(MAX_HORIZON_BIN + 1)])
+    q = table[bins[test]]  # (test points, quantiles)
+    lo90, lo50, hi50, hi90 = (np.clip(value[test] + q[:, i], *BAND_CLIP) for i in range(len(CONFORMAL_QUANTILES)))
+    cov50_by_bin = (actual[test] >= lo50) & (actual[test] <= hi50)
+    report['conformal'] = {
+        'cov50': _band_metrics(actual[test], lo50, hi50, 0.25, 0.75),
+        'cov90': _band_metrics(actual[test], lo90, hi90, 0.05, 0.95),
+        'cov50_by_horizon': [{'from_min': int(b * HORIZON_BIN_MIN), 'coverage': float(cov50_by_bin[bins[test] == b].mean()),
+                              'n': int((bins[test] == b).sum())} for b in np.unique(bins[test])],
+    }
+    # residual offsets for serving: band = value + quantile of the forecast's horizon bin
+    report['residual_quantiles'] = {
+        'bin_minutes': HORIZON_BIN_MIN,
+        'quantiles': CONFORMAL_QUANTILES,
+        'by_bin': table.tolist(),
+    }
+    return report
+
+
+def prepare(which='validation', cutoff_hours=CUTOFF_HOURS):
+    # everything the predictors get to see and are scored against, shared by all runs on the same days
+    grid = load_grid()
+    times_ns, values = load_samples()
+    times_ns, values = np.asarray(times_ns), np.asarray(values, dtype=np.float64)
+    days = eval_days(grid, which)
+    grid_pos = np.searchsorted(grid.days, days)
+    after_first, before_last = _sample_bounds(times_ns, days)
+    slots = np.arange(GYM_GRID.num_slots)
+    cutoff_slots = np.array([cutoff_slot(hour) for hour in cutoff_hours])
+    return {
+        'which': which,
+        'grid': grid,
+        'times_ns': times_ns,
+        'days': days,
+        'weekday': np.asarray(grid.weekday)[grid_pos],
+        'cutoff_hours': list(cutoff_hours),
+        'prefixes': as_of_prefixes(times_ns, values, days, cutoff_hours),
+        # the first sample of a day is before the cutoff or there are no observations at all, so this stays causal
+        'observed': after_first[:, None, :] & (slots[None, None, :] <= cutoff_slots[None, :, None]),
+        'actual': np.asarray(grid.occupancy)[grid_pos],
+        'scored': after_first & before_last,
+    }
+
+
+def backtest(predictor, data, points_path=None):
+    days, cutoff_hours = data['days'], data['cutoff_hours']
+    print(f"Evaluating {len(days)} days x {len(cutoff_hours)} cutoffs with {predictor.name}")
+    outputs, seconds = run_predictor(predictor, days, data['weekday'], cutoff_hours, data['prefixes'], data['observed'])
+    points = collect_points(outputs, data['actual'], data['scored'], days, cutoff_hours)
+    profiling.flush(backtest=predictor.name, days=data['which'])
+    if points_path:
+        np.savez_compressed(points_path, **points)
+
+    num_forecasts = len(days) * len(cutoff_hours)
+    return {
+        'predictor': predictor.name,
+        'created': datetime.datetime.now().isoformat(),
+        'days': data['which'],
+        'num_days': int(len(days)),
+        'first_day': datetime.date.fromordinal(int(days[0])).isoformat() if len(days) else None,
+        'last_day': datetime.date.fromordinal(int(days[-1])).isoformat() if len(days) else None,
+        'cutoff_hours': list(cutoff_hours),
+        'num_forecasts': num_forecasts,
+        'seconds': seconds,
+        'ms_per_forecast': 1000 * seconds / max(num_forecasts, 1),
+        **evaluate(points),
+    }
+
+
+def analog_predictor(data, params=None):
+    # the analog predictor over the whole cached history (it only ever picks days from earlier weeks)
+    grid = data['grid']
+    return AnalogPredictor(grid.days, grid.weekday, grid.occupancy, observed_span(data['times_ns'], grid.days), params)
+
+
+def parse_params(params):
+    # --param field=v1,v2 -> every combination as AnalogParams
+    fields = {field.name: field.type for field in dataclasses.fields(AnalogParams)}
+    space = {}
+    for param in params:
+        name, _, values = param.partition('=')
+        if name not in fields:
+            raise ValueError(f"not an AnalogParams field: {name}")
+        space[name] = [(int if fields[name] is int else float)(value) for value in values.split(',')]
+    names = sorted(space)
+    return [AnalogParams(**dict(zip(names, values))) for values in itertools.product(*(space[name] for name in names))]
+
+
+def print_report(report):
+    print(f"\n{report['predictor']}: {report['num_forecasts']} forecasts in {report['seconds']:.2f}s "
+          f"({report['ms_per_forecast']:.2f} ms/forecast), {report['num_points']} points, "
+          + (f"MAE {report['mae']:.3f}" if report['num_points'] else "no scored points"))
+    for row in report['mae_by_horizon']:
+        print(f"  {row['from_min']}-{row['to_min']}min ahead: MAE={row['mae']:.3f}  (n={row['n']})")
+    if 'bands' in report:
+        for name, band in report['bands'].items():
+            print(f"  {name} band: cov={100 * band['coverage']:.1f}%  w={band['width']:.1f}")
+    if 'conformal' in report:
+        for name in ('cov50', 'cov90'):
+            band = report['conformal'][name]
+            print(f"  conformal {name}: cov={100 * band['coverage']:.1f}%  w={band['width']:.1f}  "
+                  f"pinball={band['pinball'][0]:.3f}/{band['pinball'][1]:.3f}")
+
+
+def print_comparison(reports):
+    # MAE per horizon bin of several predictors on the same points, side by side
+    names = [report['predictor'] for report in reports]
+    print("\n" + " " * 16 + "".join(f"{name:>20}" for name in names))
+    print(f"{'all':>16}" + "".join(f"{report['mae'] if report['num_points'] else float('nan'):>20.3f}"
+                                   for report in reports))
+    by_bin = [{row['from_min']: row['mae'] for row in report['mae_by_horizon']} for report in reports]
+    for row in reports[0]['mae_by_horizon']:
+        label = f"{row['from_min']}-{row['to_min']}min"
+        print(f"{label:>16}" + "".join(f"{bins.get(row['from_min'], float('nan')):>20.3f}" for bins in by_bin))
+    print(f"{'ms/forecast':>16}" + "".join(f"{report['ms_per_forecast']:>20.2f}" for report in reports))
+
+
+def _write_report(report, out):
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Report written to {out}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ai.backtest', description="As-of backtest of the forecasters")
+    parser.add_argument('--predictor', choices=['transformer', 'analog'], default='transformer')
+    parser.add_argument('--model', help="checkpoint or old pickled model (transformer)")
+    parser.add_argument('--decode', choices=['ar', 'direct', 'compare'],
+                        help="transformer: autoregressive rollout, the horizon head, or both on the same points "
+                             "(default: compare if the model has a horizon head, else ar)")
+    parser.add_argument('--param', action='append', default=[],
+                        help="analog constant, field=v1,v2,... (repeatable); more than one value runs a sweep")
+    parser.add_argument('--days', choices=['validation', 'all'], default='validation',
+                        help="held out days only (default), or every day the model may have trained on")
+    parser.add_argument('--cutoffs', default=','.join(map(str, CUTOFF_HOURS)), help="cutoff hours, comma separated")
+    parser.add_argument('--out', help="json report (default: backtest_<time>.json next to the model, or in ai/models)")
+    parser.add_argument('--points', help="also save every scored point (.npz), to compare predictors point by point")
+    args = parser.parse_args(argv)
+    if args.predictor == 'transformer' and not args.model:
+        parser.error("--model is required for the transformer")
+
+    data = prepare(args.days, [int(h) for h in args.cutoffs.split(',')])
+    out = args.out or os.path.join(os.path.dirname(os.path.abspath(args.model)) if args.model else MODELS_DIR,
+                                   datetime.datetime.now().strftime(f'backtest_{args.predictor}_%Y%m%d_%H%M%S.json'))
+
+    if args.predictor == 'analog':
+        base = analog_predictor(data)
+        reports = []
+        for params in parse_params(args.param) if args.param else [AnalogParams()]:
+            report = backtest(base.with_params(params), data, args.points if len(reports) == 0 else None)
+            report['params'] = dataclasses.asdict(params)
+            print_report(report)
+            reports.append(report)
+        if len(reports) > 1:
+            print("\nSweep, best first:")
+            # a run without scored points (e.g. a cutoff at the end of the day) has no MAE to rank
+            for report in sorted((r for r in reports if r['mae'] is not None), key=lambda r: r['mae']):
+                print(f"  MAE {report['mae']:.3f}  {report['seconds']:.1f}s  {report['params']}")
+        _write_report(reports[0] if len(reports) == 1 else reports, out)
+        return
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model, config = load_model_and_config(args.model, map_location=device)
+    model = model.to(device).eval()
+    if getattr(model, 'num_series', 0):
+        parser.error("this is a multi-series (--data wifi) model, evaluate it with python -m ai.wifi")
+    # the old pickled models were all trained on arrivals
+    use_arrival_data = config['use_arrival_data'] if config else True
+    decode = args.decode or ('compare' if model.has_horizon_head() else 'ar')
+    if decode != 'ar' and not model.has_horizon_head():
+        parser.error(f"--decode {decode} needs a model trained with --objective horizon or both")
+    reports = []
+    for mode in ['ar', 'direct'] if decode == 'compare' else [decode]:
+        points = args.points
+        if points and decode == 'compare':
+            points = f"{os.path.splitext(points)[0]}_{mode}.npz"
+        report = backtest(TransformerPredictor(model, use_arrival_data, decode=mode), data, points)
+        report['model'] = os.path.abspath(args.model)
+        report['device'] = str(device)
+        report['decode'] = mode
+        print_report(report)
+        reports.append(report)
+    if len(reports) > 1:
+        print_comparison(reports)
+    _write_report(reports[0] if len(reports) == 1 else reports, out)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,118 @@
+import sys
+import time
+import argparse
+import numpy as np
+import torch
+
+from .model import TransformerDecoder
+from .rollout import rollout
+from .main import TrainConfig, train
+
+# python -m ai.bench_attention [--seq-lens 216,577,1441] [--d-model 128 --nhead 1] [--train-epochs 20]
+#
+# mha (nn.MultiheadAttention + positional table) against rotary (fused SDPA blocks from llama.py) on random data
+# of the training shapes. the rotary variant swaps the whole block, not only the attention: FusedDecoderBlock is
+# pre-norm (LayerNorm) with GELU where DecoderOnlyTransformerLayer has no norm and ReLU, so the numbers compare the
+# two block designs. measured: train steps/sec, forward tokens/sec and the latency of a KV-cached rollout, also for
+# sequences longer than a gym day (577 = 24h at 2.5min, 1441 = 24h at 1min). --train-epochs additionally trains
+# both variants with the same seed on the real data and compares the validation losses
+
+VARIANTS = ('mha', 'rotary')
+
+
+def _time(fn, repeats, warmup=2):
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return np.array(times)
+
+
+def bench_variant(attention, seq_len, d_model, nhead, num_layers, batch_size, repeats, device):
+    torch.manual_seed(0)
+    # the mha variant needs a positional table as long as the sequence, the rotary one extends itself
+    model = TransformerDecoder(d_model=d_model, nhead=nhead, num_layers=num_layers, dropout_rate=0.0,
+                               logscale_tricks=False, max_time_dim=seq_len, attention=attention).to(device)
+    optimizer = torch.optim.AdamW(model.parameters(), lr=1e-3)
+    criterion = torch.nn.MSELoss()
+    batch = torch.rand(batch_size, seq_len, device=device) * 100
+
+    def train_step():
+        optimizer.zero_grad()
+        output = model(batch[:, :-1]).permute(1, 0, 2)
+        loss = criterion(output, batch[:, 1:].unsqueeze(-1))
+        loss.backward()
+        optimizer.step()
+
+    def forward():
+        with torch.no_grad():
+            model(batch[:, :-1])
+
+    def decode():
+        rollout(model, batch, torch.full((batch_size,), seq_len // 2, dtype=torch.long), seq_len)
+
+    model.train()
+    train_times = _time(train_step, repeats)
+    model.eval()
+    fwd = _time(forward, repeats)
+    dec = _time(decode, max(1, repeats // 4), warmup=1)
+    tokens = batch_size * (seq_len - 1)
+    return {
+        'attention': attention,
+        'seq_len': seq_len,
+        'train_steps_per_sec': float(1 / np.median(train_times)),
+        'train_tokens_per_sec': float(tokens / np.median(train_times)),
+        'forward_tokens_per_sec': float(tokens / np.median(fwd)),
+        'rollout_ms': float(1000 * np.median(dec)),
+    }
+
+
+def train_variants(epochs, base):
+    # same config and seed, only the attention (and with it the block design, see above) differs
+    results = {}
+    for attention in VARIANTS:
+        config = TrainConfig(**{**base, 'attention': attention, 'epochs': epochs, 'seed': 0,
+                                'run_name': f'bench_attention/{attention}'})
+        start = time.perf_counter()
+        all_stats = train(config)
+        best = min(all_stats, key=lambda s: s['valid_loss'])
+        results[attention] = {'best_valid_loss': best['valid_loss'], 'best_epoch': best['epoch'],
+                              'final_valid_loss': all_stats[-1]['valid_loss'], 'seconds': time.perf_counter() - start}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ai.bench_attention', description="mha vs rotary attention")
+    parser.add_argument('--seq-lens', default='216,577,1441')
+    parser.add_argument('--d-model', type=int, default=128)
+    parser.add_argument('--nhead', type=int, default=1)
+    parser.add_argument('--num-layers', type=int, default=2)
+    parser.add_argument('--batch-size', type=int, default=8)
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--train-epochs', type=int, default=0, help="also train both variants for this many epochs")
+    args = parser.parse_args(argv)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    print("rotary = fused pre-norm blocks from llama.py, so this compares block designs, not only the attention")
+    print(f"{'attention':<10}{'seq_len':>8}{'train steps/s':>15}{'train tok/s':>13}{'fwd tok/s':>12}{'rollout ms':>12}")
+    for seq_len in (int(n) for n in args.seq_lens.split(',')):
+        for attention in VARIANTS:
+            r = bench_variant(attention, seq_len, args.d_model, args.nhead, args.num_layers, args.batch_size,
+                              args.repeats, device)
+            print(f"{r['attention']:<10}{r['seq_len']:>8}{r['train_steps_per_sec']:>15.2f}{r['train_tokens_per_sec']:>13.0f}"
+                  f"{r['forward_tokens_per_sec']:>12.0f}{r['rollout_ms']:>12.1f}")
+
+    if args.train_epochs:
+        base = {'d_model': args.d_model, 'nhead': args.nhead, 'num_layers': args.num_layers, 'batch_size': args.batch_size}
+        for attention, r in train_variants(args.train_epochs, base).items():
+            print(f"{attention}: best valid loss {r['best_valid_loss']:.4f} (epoch {r['best_epoch']}), "
+                  f"final {r['final_valid_loss']:.4f}, {r['seconds']:.0f}s")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
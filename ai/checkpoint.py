@@ -0,0 +1,71 @@
+import os
+import json
+import random
+import numpy as np
+import torch
+
+from .model import TransformerDecoder
+
+# bump when the layout of the checkpoint dict changes
+CHECKPOINT_FORMAT = 1
+
+
+def rng_state():
+    # everything that decides shuffling, dropout and the random sequence-training start points
+    return {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+        'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+    }
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def save_checkpoint(path, model: TransformerDecoder, model_kwargs, optimizer=None, **extra):
+    # state dicts only, plus the kwargs to rebuild the model. extra holds the training progress (epoch, stats, config ...)
+    state = {
+        'format': CHECKPOINT_FORMAT,
+        'model_kwargs': model_kwargs,
+        'model_state': model.state_dict(),
+        'optimizer_state': optimizer.state_dict() if optimizer is not None else None,
+        'rng': rng_state(),
+        **extra,
+    }
+    # a run that gets pre-empted while writing must not destroy the previous checkpoint
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, map_location='cpu'):
+    # the rng state holds plain python objects, so no weights_only
+    return torch.load(path, map_location=map_location, weights_only=False)
+
+
+def load_model(path, map_location=None) -> TransformerDecoder:
+    # works for checkpoints written by save_checkpoint and for the old fully pickled models (*.ptp)
+    return load_model_and_config(path, map_location)[0]
+
+
+def load_model_and_config(path, map_location=None):
+    # (model, training config dict). the old pickled models carry no config, that one is None
+    obj = torch.load(path, map_location=map_location, weights_only=False)
+    if isinstance(obj, torch.nn.Module):
+        return obj, None
+    model = TransformerDecoder(**obj['model_kwargs'])
+    model.load_state_dict(obj['model_state'])
+    return model, obj.get('config')
+
+
+def append_run(registry_path, record):
+    # one json object per line, never rewritten
+    os.makedirs(os.path.dirname(registry_path), exist_ok=True)
+    with open(registry_path, 'a') as f:
+        f.write(json.dumps(record) + '\n')
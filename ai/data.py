@@ -1,134 +1,754 @@
 import pandas as pd
+import numpy as np
 import os
+import io
+import json
+import hashlib
 import torch
 import datetime
 from torch.utils.data import DataLoader
 import torch.nn as nn
 import random
 
+from .profiling import timed
+
 pd.set_option("future.no_silent_downcasting", True)
 pd.set_option('display.max_rows', 500)
 pd.set_option('display.max_columns', 500)
 pd.set_option('display.width', 150)
 
 
-# read csv
-df = pd.read_csv(os.path.join(os.path.dirname(__file__), 'data', 'out.csv'), header=None, names=['id', 'value', 'time'])
-df['time'] = pd.to_datetime(df['time'])
-df['value'] = df['value'].astype(float)
-# we dont really need the id, so we can drop it
-df = df.drop(columns=['id'])
+DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
+DEFAULT_CSV = os.path.join(DATA_DIR, 'out.csv')
+CACHE_DIR = os.path.join(DATA_DIR, 'cache')
+# per-AP export of wifi_data, see data/get_wifi_data.sh
+WIFI_CSV = os.path.join(DATA_DIR, 'wifi.csv')
+WIFI_CACHE_DIR = os.path.join(CACHE_DIR, 'wifi')
+# bump when the preprocessing changes, so old caches get rebuilt
+CACHE_VERSION = 2
+
+NUM_TIME_PER_DAY = 215
 
-# drop all rows where value is > 250
-df = df[df['value'] <= 250]
+# the system registers when a member enters, and removes them exactly 1:30h later,
+# so an arrival is still counted in the occupancy of the following 17 slots
+ARRIVAL_WINDOW = 17
 
-# group by day
-df['day'] = df['time'].dt.date
-grouped = df.groupby('day')
+@timed('arrivals')
+def arrivals_from_occupancy(occupancy):
+    # we remove this effect here such that we have a predictor of when people arrive.
+    # works on a whole (days, slots) array at once: every arrival depends on the clamped arrivals before it,
+    # so we still walk the slots, but each step is one vector op over all days and the window sum is kept running
+    occupancy = np.asarray(occupancy, dtype=np.float64)
+    arrivals = np.zeros_like(occupancy)
+    window_sum = np.zeros(occupancy.shape[:-1])
+    for i in range(occupancy.shape[-1]):
+        arrivals[..., i] = np.maximum(0, occupancy[..., i] - window_sum)  # ensure no negative values
+        window_sum += arrivals[..., i]
+        if i >= ARRIVAL_WINDOW:
+            window_sum -= arrivals[..., i - ARRIVAL_WINDOW]
+    return arrivals
 
-print("Number of days:", len(grouped))
-print("Day with most data:", grouped.size().idxmax(), "with", grouped.size().max(), "entries")
-print("Day with least data:", grouped.size().idxmin(), "with", grouped.size().min(), "entries")
-# drop all days with less than 200 entries
-grouped = grouped.filter(lambda x: len(x) >= 200)
-grouped = grouped.groupby('day')
+def occupancy_from_arrivals(arrivals):
+    # inverse of arrivals_from_occupancy: everyone who arrived within the window is still there.
+    # batched over the leading dims, takes numpy arrays or torch tensors (e.g. forecasts, without the day token)
+    width = ARRIVAL_WINDOW + 1
+    if isinstance(arrivals, torch.Tensor):
+        csum = torch.cumsum(nn.functional.pad(arrivals, (width, 0)), dim=-1)
+    else:
+        arrivals = np.asarray(arrivals)
+        csum = np.cumsum(np.pad(arrivals, [(0, 0)] * (arrivals.ndim - 1) + [(width, 0)]), axis=-1)
+    return csum[..., width:] - csum[..., :-width]
 
-print("Number of days after filtering:", len(grouped))
+def day_into_arrival_data(day_data: list[float]):
+    return arrivals_from_occupancy(day_data).tolist()
 
+@timed('csv_load')
+def read_samples(csv_path=DEFAULT_CSV):
+    # read csv (a path or a file object), columns id, value, time
+    df = pd.read_csv(csv_path, header=None, names=['id', 'value', 'time'])
+    df['time'] = pd.to_datetime(df['time'])
+    df['value'] = df['value'].astype(float)
+    return df
 
-# create a dictionary with day as key and values as list of values
-# now our data is a bit problematic:
-# the created_at is not aligned to any particular grid, so we would need to resample it
-# so lets do that here, we just do a list for values every 5 minutes, starting at 06:00 and ending at 23:30
-# we use linear interpolation to fill the gaps
-day_data = {}
-day_arrival_data = {}
-# print the 100 largest values
-largest_values = df["value"].nlargest(20)
-#print("100 largest values:")
-#print(largest_values)
+def filter_samples(df):
+    # we dont really need the id, so we can drop it
+    df = df.drop(columns=['id'])
 
-NUM_TIME_PER_DAY = 215
+    # drop all rows where value is > 250
+    df = df[df['value'] <= 250]
+    return df
 
-def day_into_arrival_data(day_data: list[float]):
-    # the system registers when a member enters, and removes them exactly 1:30h later
-    # so we remove this effect here such that we have a predictor of when people arrive
-
-    arrival_data = []
-    for i in range(len(day_data)):
-        val = day_data[i]
-        for j in range(i - 17, i):
-            if j < 0:
+# datetime.date(1970, 1, 1).toordinal()
+_EPOCH_ORDINAL = 719163
+
+def day_ordinals(times_ns):
+    # naive datetime64[ns] (as int64) -> datetime.date.toordinal() of their day
+    return np.asarray(times_ns).astype('datetime64[ns]').astype('datetime64[D]').astype(np.int64) + _EPOCH_ORDINAL
+
+def day_start_ns(days):
+    # inverse of day_ordinals: midnight of every day, as naive int64 ns
+    return (np.asarray(days, dtype=np.int64) - _EPOCH_ORDINAL) * 86400 * 1_000_000_000
+
+
+class GridSpec:
+    # a fixed time grid per day: num_slots points every step_minutes, starting start_minute after midnight
+    def __init__(self, start_minute, step_minutes, num_slots):
+        self.start_minute = start_minute
+        self.step_minutes = step_minutes
+        self.num_slots = num_slots
+
+    def offsets_ns(self):
+        # time of every slot since midnight
+        minutes = self.start_minute + self.step_minutes * np.arange(self.num_slots, dtype=np.int64)
+        return minutes * 60 * 1_000_000_000
+
+# the gym is open 06:00 - 24:00, last slot is 23:50
+GYM_GRID = GridSpec(6 * 60, 5, NUM_TIME_PER_DAY)
+# the wifi side looks at the whole day
+FULL_DAY_GRID = GridSpec(0, 5, 24 * 12)
+
+@timed('resample')
+def resample_grid(times_ns, values, grid=GYM_GRID, max_value=250, min_samples=200, verbose=True):
+    # maps raw samples onto grid for every day at once.
+    # times_ns are naive datetime64[ns] as int64, in any order. returns the sorted day ordinals and a (days, num_slots) array.
+    #
+    # same result as the per-day pandas version (resample_days_pandas): samples above max_value are dropped,
+    # days with fewer than min_samples samples are dropped, duplicate timestamps keep the first sample.
+    # pandas' linear interpolation ignores the index, so a slot between two samples gets the value at its *position*
+    # among the slots in between, not at its time. slots before the first sample are 0, after the last one they
+    # keep the last value.
+    times_ns = np.asarray(times_ns, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if max_value is not None:
+        keep = values <= max_value
+        times_ns, values = times_ns[keep], values[keep]
+
+    order = np.argsort(times_ns, kind='stable')
+    times_ns, values = times_ns[order], values[order]
+    sample_days = day_ordinals(times_ns)
+
+    # the day filter counts duplicates too
+    days, counts = np.unique(sample_days, return_counts=True)
+    days = days[counts >= min_samples]
+    if verbose:
+        print("Number of days:", len(counts))
+        print("Number of days after filtering:", len(days))
+    keep = np.isin(sample_days, days)
+    keep[1:] &= times_ns[1:] != times_ns[:-1]
+    times_ns, values, sample_days = times_ns[keep], values[keep], sample_days[keep]
+    if len(times_ns) == 0:
+        return days, np.zeros((0, grid.num_slots))
+
+    # per day the range of its samples
+    day_start = np.searchsorted(sample_days, days, side='left')
+    day_end = np.searchsorted(sample_days, days, side='right')
+
+    # all slots of all days, globally sorted
+    slot_times = day_start_ns(days)[:, None] + grid.offsets_ns()[None, :]
+    flat_slots = slot_times.reshape(-1)
+    slot_day = np.repeat(np.arange(len(days)), grid.num_slots)
+    first = day_start[slot_day]
+    end = day_end[slot_day]
+
+    nxt = np.searchsorted(times_ns, flat_slots, side='left')  # first sample at or after the slot
+    nxt_c = np.minimum(nxt, max(len(times_ns) - 1, 0))
+    has_next = nxt < end
+    exact = has_next & (times_ns[nxt_c] == flat_slots)
+    prv = nxt - 1
+    has_prev = prv >= first
+    prv_c = np.maximum(prv, 0)
+
+    out = np.zeros(len(flat_slots), dtype=np.float64)
+
+    # after the last sample of the day
+    trailing = has_prev & ~has_next
+    out[trailing] = values[prv_c[trailing]]
+
+    # between two samples: position among the slots strictly between them
+    between = has_prev & has_next & ~exact
+    t_prev = times_ns[prv_c[between]]
+    t_next = times_ns[nxt_c[between]]
+    after_prev = np.searchsorted(flat_slots, t_prev, side='right')
+    num_between = np.searchsorted(flat_slots, t_next, side='left') - after_prev
+    position = np.flatnonzero(between) - after_prev + 1
+    v_prev = values[prv_c[between]]
+    v_next = values[nxt_c[between]]
+    out[between] = v_prev + (v_next - v_prev) * position / (num_between + 1)
+
+    out[exact] = values[nxt_c[exact]]
+    # everything else is before the first sample and stays 0
+    return days, out.reshape(len(days), grid.num_slots)
+
+def resample_days(df, grid=GYM_GRID):
+    # returns the sorted list of days and their (days, num_slots) occupancy grid
+    times_ns = df['time'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    days, occupancy = resample_grid(times_ns, df['value'].to_numpy(dtype=np.float64), grid)
+    return [datetime.date.fromordinal(int(day)) for day in days], occupancy
+
+def resample_days_pandas(df):
+    # the original per-day implementation, slow. kept as the reference for resample_days
+    # (python -m ai.data check-resample)
+
+    # group by day
+    df = df[['time', 'value']].copy()
+    df['day'] = df['time'].dt.date
+    grouped = df.groupby('day')
+
+    print("Number of days:", len(grouped))
+    print("Day with most data:", grouped.size().idxmax(), "with", grouped.size().max(), "entries")
+    print("Day with least data:", grouped.size().idxmin(), "with", grouped.size().min(), "entries")
+    # drop all days with less than 200 entries
+    grouped = grouped.filter(lambda x: len(x) >= 200)
+    grouped = grouped.groupby('day')
+
+    print("Number of days after filtering:", len(grouped))
+
+    # now our data is a bit problematic:
+    # the created_at is not aligned to any particular grid, so we would need to resample it
+    # so lets do that here, we just do a list for values every 5 minutes, starting at 06:00 and ending at 23:50
+    # we use linear interpolation to fill the gaps
+    days = []
+    occupancy = np.zeros((len(grouped), NUM_TIME_PER_DAY), dtype=np.float64)
+    for i, (day, group) in enumerate(grouped):
+        # create a date range for the day with 5 minute frequency
+        date_range = pd.date_range(start=f"{day} 06:00:00", end=f"{day} 23:50:00", freq='5min')
+        assert len(date_range) == NUM_TIME_PER_DAY, f"Expected {NUM_TIME_PER_DAY} time points for day {day}, got {len(date_range)}"
+        # ensure 'time' index is unique before reindexing
+        group = group.drop_duplicates(subset='time')
+        # reindex the group to this date range
+        group = group.set_index('time')
+        group = group.drop(columns=['day'])
+        group = group.reindex(group.index.union(date_range))
+
+        group = group.interpolate(method='linear', fill_value="extrapolate")
+        #group = group.interpolate(method='nearest', fill_value="extrapolate")
+
+        group = group.reindex(date_range, method='nearest', tolerance=pd.Timedelta('1min'))
+        group = group.fillna(0)  # fill any remaining NaNs with 0
+
+        days.append(day)
+        occupancy[i] = group['value'].to_numpy()
+    return days, occupancy
+
+def _save_array(cache_dir, name, array):
+    # write next to the target and rename, readers never see half written files
+    tmp_path = os.path.join(cache_dir, f'{name}.npy.tmp')
+    with open(tmp_path, 'wb') as f:
+        np.save(f, np.ascontiguousarray(array))
+    os.replace(tmp_path, os.path.join(cache_dir, f'{name}.npy'))
+
+def _load_array(cache_dir, name, mmap_mode='r'):
+    return np.load(os.path.join(cache_dir, f'{name}.npy'), mmap_mode=mmap_mode)
+
+
+class DayGrid:
+    # the preprocessed data: one row per day, occupancy and arrivals on the 5 minute grid.
+    # arrays are float32 (memory-mapped when loaded from the cache), days are stored as date ordinals
+    def __init__(self, days, weekday, occupancy, arrivals):
+        self.days = days  # (num_days,) int32, datetime.date.toordinal()
+        self.weekday = weekday  # (num_days,) int8, 0=Monday, 6=Sunday
+        self.occupancy = occupancy  # (num_days, NUM_TIME_PER_DAY) float32
+        self.arrivals = arrivals  # (num_days, NUM_TIME_PER_DAY) float32
+
+    def __len__(self):
+        return len(self.days)
+
+    @property
+    def dates(self):
+        return [datetime.date.fromordinal(int(day)) for day in self.days]
+
+    @staticmethod
+    def from_days(days, occupancy):
+        # the explicit width also covers an ingest whose days all had too few samples (no rows)
+        occupancy = np.asarray(occupancy, dtype=np.float64).reshape(len(days), NUM_TIME_PER_DAY)
+        return DayGrid(
+            days=np.array([day.toordinal() for day in days], dtype=np.int32),
+            weekday=np.array([day.weekday() for day in days], dtype=np.int8),
+            occupancy=occupancy.astype(np.float32),
+            # from the float64 grid so the deconvolution doesn't pick up rounding errors
+            arrivals=arrivals_from_occupancy(occupancy).astype(np.float32),
+        )
+
+    def replace_days(self, changed_days, other):
+        # drop the rows for changed_days (ordinals) and merge in the rows of other, keeping the days sorted.
+        # a changed day may be missing from other, e.g. if it still has too few samples
+        keep = ~np.isin(self.days, changed_days)
+        days = np.concatenate([self.days[keep], other.days])
+        order = np.argsort(days, kind='stable')
+        return DayGrid(*(np.concatenate([getattr(self, name)[keep], getattr(other, name)])[order] for name in self._ARRAYS))
+
+    _ARRAYS = ('days', 'weekday', 'occupancy', 'arrivals')
+
+    def save(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in self._ARRAYS:
+            _save_array(cache_dir, name, getattr(self, name))
+
+    @staticmethod
+    def load(cache_dir, mmap_mode='r'):
+        return DayGrid(*(_load_array(cache_dir, name, mmap_mode) for name in DayGrid._ARRAYS))
+
+
+def _read_cache_meta(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'meta.json')) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_cache_meta(cache_dir, meta):
+    tmp_path = os.path.join(cache_dir, 'meta.json.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(meta, f, indent=4)
+    os.replace(tmp_path, os.path.join(cache_dir, 'meta.json'))
+
+def _hash_file(f, h, limit=None):
+    # feed f into h, at most limit bytes
+    while limit is None or limit > 0:
+        chunk = f.read(1 << 20 if limit is None else min(1 << 20, limit))
+        if not chunk:
+            break
+        h.update(chunk)
+        if limit is not None:
+            limit -= len(chunk)
+    return h
+
+def _file_hash(path):
+    with open(path, 'rb') as f:
+        return _hash_file(f, hashlib.sha256()).hexdigest()
+
+def _save_samples(cache_dir, df):
+    # the filtered raw samples are kept next to the grid, so days touched by new rows can be resampled again
+    _save_array(cache_dir, 'samples_time', df['time'].to_numpy(dtype='datetime64[ns]').astype(np.int64))
+    _save_array(cache_dir, 'samples_value', df['value'].to_numpy(dtype=np.float32))
+
+def _load_samples(cache_dir):
+    return _load_array(cache_dir, 'samples_time'), _load_array(cache_dir, 'samples_value')
+
+def _samples_frame(times, values):
+    return pd.DataFrame({'time': pd.to_datetime(np.asarray(times), unit='ns'), 'value': np.asarray(values, dtype=np.float64)})
+
+def _cache_meta(csv_path, sha256, raw, grid):
+    stat = os.stat(csv_path)
+    return {
+        'version': CACHE_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': sha256,
+        # the newest row we have seen, the next ingestion only takes rows after it
+        'last_id': int(raw['id'].max()) if len(raw) else -1,
+        'last_time': raw['time'].max().isoformat() if len(raw) else None,
+        'num_days': len(grid),
+    }
+
+def build_cache(csv_path=DEFAULT_CSV, cache_dir=CACHE_DIR):
+    # full preprocessing of the csv
+    raw = read_samples(csv_path)
+    samples = filter_samples(raw)
+    grid = DayGrid.from_days(*resample_days(samples))
+    grid.save(cache_dir)
+    _save_samples(cache_dir, samples)
+    # meta is written last, it marks the cache as complete
+    _write_cache_meta(cache_dir, _cache_meta(csv_path, _file_hash(csv_path), raw, grid))
+    return grid
+
+def ingest_new_rows(raw, cache_dir=CACHE_DIR, meta=None):
+    # merge rows that are newer than the cache into it: only the days they fall on are resampled again.
+    # raw is a frame as returned by read_samples, rows we already have (id <= last_id) are skipped.
+    # returns the updated grid and the number of new rows. needs a complete cache to merge into (load_grid builds one)
+    meta = meta or _read_cache_meta(cache_dir)
+    if meta is None or meta.get('version') != CACHE_VERSION:
+        raise ValueError(f"no up to date cache in {cache_dir} to ingest into, build it first (python -m ai.data)")
+    raw = raw[raw['id'] > meta['last_id']]
+    new = filter_samples(raw)
+    grid = DayGrid.load(cache_dir)
+    if len(raw) == 0:
+        return grid, 0
+    if len(new) > 0:
+        grid = _merge_samples(grid, new, cache_dir)
+
+    meta.update(
+        last_id=int(raw['id'].max()),
+        last_time=max(meta['last_time'] or '', raw['time'].max().isoformat()),
+        num_days=len(grid),
+    )
+    _write_cache_meta(cache_dir, meta)
+    return grid, len(raw)
+
+def _merge_samples(grid, new, cache_dir):
+    # append the filtered samples and resample the days they fall on.
+    # only the touched days are resampled, but the sample arrays are rewritten as a whole (an .npy can't be appended
+    # to in place), so an ingest still reads and writes every sample once: 12 bytes per sample, a few MB for years
+    # of the gym data, far below parsing the csv again
+    old_times, old_values = _load_samples(cache_dir)
+    new_times = new['time'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    times = np.concatenate([old_times, new_times])
+    values = np.concatenate([old_values, new['value'].to_numpy(dtype=np.float32)])
+
+    changed_days = np.unique(day_ordinals(new_times))
+    touched = np.isin(day_ordinals(times), changed_days)
+    print(f"Ingesting {len(new)} new samples, resampling {len(changed_days)} days")
+    grid = grid.replace_days(changed_days, DayGrid.from_days(*resample_days(_samples_frame(times[touched], values[touched]))))
+
+    grid.save(cache_dir)
+    _save_array(cache_dir, 'samples_time', times)
+    _save_array(cache_dir, 'samples_value', values)
+    return grid
+
+def _ingest_csv_tail(csv_path, cache_dir, meta):
+    # out.csv only ever grows (see data/get_data.sh append): if the part we ingested last time is unchanged,
+    # parse just the bytes after it. returns False if the file was rewritten and needs a full rebuild.
+    # checking "unchanged" hashes the whole old part, a sequential read of the file; only the tail is parsed,
+    # which is where the time went
+    stat = os.stat(csv_path)
+    if stat.st_size <= meta['size']:
+        return False
+    with open(csv_path, 'rb') as f:
+        h = _hash_file(f, hashlib.sha256(), limit=meta['size'])
+        if h.hexdigest() != meta['sha256']:
+            return False
+        f.seek(meta['size'] - 1)
+        if f.read(1) != b'\n':
+            return False
+        tail = f.read()
+    h.update(tail)
+
+    _, num_rows = ingest_new_rows(read_samples(io.BytesIO(tail)), cache_dir, meta)
+    print(f"Ingested {num_rows} rows from the tail of {csv_path}")
+    meta.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=h.hexdigest())
+    _write_cache_meta(cache_dir, meta)
+    return True
+
+def _cache_is_fresh(csv_path, cache_dir):
+    meta = _read_cache_meta(cache_dir)
+    if meta is None or meta.get('version') != CACHE_VERSION:
+        return False
+    if not os.path.exists(csv_path):
+        # e.g. an inference box that only got the cache
+        return True
+    stat = os.stat(csv_path)
+    if meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns:
+        return True
+    # same size but touched, or re-exported with identical content: only the hash can tell
+    if meta['size'] == stat.st_size and meta['sha256'] == _file_hash(csv_path):
+        meta['mtime_ns'] = stat.st_mtime_ns
+        _write_cache_meta(cache_dir, meta)
+        return True
+    # new rows appended
+    return _ingest_csv_tail(csv_path, cache_dir, meta)
+
+_loaded_grids = {}
+
+@timed('load_grid')
+def load_grid(csv_path=DEFAULT_CSV, cache_dir=CACHE_DIR):
+    # the preprocessed grid for csv_path. appended rows are merged into the cache,
+    # it is only rebuilt from scratch if the csv was rewritten
+    key = (os.path.abspath(csv_path), os.path.abspath(cache_dir))
+    if key not in _loaded_grids:
+        if not _cache_is_fresh(csv_path, cache_dir):
+            print(f"Preprocessing {csv_path} into {cache_dir}")
+            build_cache(csv_path, cache_dir)
+        _loaded_grids[key] = DayGrid.load(cache_dir)
+    return _loaded_grids[key]
+
+def load_samples(csv_path=DEFAULT_CSV, cache_dir=CACHE_DIR):
+    # the filtered raw samples behind the grid, memory-mapped: times (int64 ns, naive) and values
+    load_grid(csv_path, cache_dir)
+    return _load_samples(cache_dir)
+
+# the wifi data: one series per building, built from the per-AP rows like fetchBuildingSeries in server/src/index.ts.
+# every AP is averaged within 10 minute buckets (several uploads in a bucket count once), the online APs of a building
+# are summed per bucket, and the buckets are resampled onto FULL_DAY_GRID like the gym samples
+WIFI_BUCKET_MINUTES = 10
+# a (building, day) needs half of its buckets
+WIFI_MIN_BUCKETS = 72
+
+@timed('csv_load')
+def read_ap_samples(csv_path=WIFI_CSV):
+    # columns id, apname, building, users (2.4 + 5 GHz), time. only online rows are exported
+    df = pd.read_csv(csv_path, header=None, names=['id', 'apname', 'building', 'users', 'time'], escapechar='\\',
+                     keep_default_na=False, dtype={'apname': str, 'building': str})
+    df['time'] = pd.to_datetime(df['time'])
+    df['users'] = df['users'].astype(float)
+    return df
+
+@timed('aggregate')
+def building_series(df, bucket_minutes=WIFI_BUCKET_MINUTES):
+    # {building: (bucket start times as naive int64 ns, summed users)}, buildings sorted by name
+    bucket_ns = bucket_minutes * 60 * 1_000_000_000
+    times_ns = df['time'].to_numpy(dtype='datetime64[ns]').astype(np.int64)
+    per_ap = pd.DataFrame({'building': df['building'].to_numpy(), 'apname': df['apname'].to_numpy(),
+                           'bucket': times_ns // bucket_ns, 'users': df['users'].to_numpy()})
+    per_ap = per_ap.groupby(['building', 'bucket', 'apname'], sort=False)['users'].mean()
+    total = per_ap.groupby(level=['building', 'bucket']).sum().sort_index()
+    return {
+        building: (group.index.get_level_values('bucket').to_numpy(dtype=np.int64) * bucket_ns, group.to_numpy())
+        for building, group in total.groupby(level='building')
+    }
+
+
+class SeriesGrid:
+    # several series on one grid: one row per (series, day), sorted by series and then day.
+    # names[series[i]] is the series of row i
+    def __init__(self, names, series, days, weekday, values):
+        self.names = names  # list of str
+        self.series = series  # (num_rows,) int32, index into names
+        self.days = days  # (num_rows,) int32, datetime.date.toordinal()
+        self.weekday = weekday  # (num_rows,) int8, 0=Monday, 6=Sunday
+        self.values = values  # (num_rows, grid.num_slots) float32
+
+    def __len__(self):
+        return len(self.days)
+
+    @staticmethod
+    def from_series(series, grid=FULL_DAY_GRID, min_samples=WIFI_MIN_BUCKETS):
+        # series: {name: (times_ns, values)}, as returned by building_series
+        names, rows = [], []
+        for name, (times_ns, values) in series.items():
+            days, grid_values = resample_grid(times_ns, values, grid, max_value=None, min_samples=min_samples,
+                                              verbose=False)
+            if len(days) == 0:
                 continue
-            val -= arrival_data[j]
-        val = max(0, val)  # ensure no negative values
-        arrival_data.append(val)
-
-    return arrival_data
-
-for day, group in grouped:
-    # create a date range for the day with 5 minute frequency
-    date_range = pd.date_range(start=f"{day} 06:00:00", end=f"{day} 23:50:00", freq='5min')
-    assert len(date_range) == NUM_TIME_PER_DAY, f"Expected {NUM_TIME_PER_DAY} time points for day {day}, got {len(date_range)}"
-    # ensure 'time' index is unique before reindexing
-    group = group.drop_duplicates(subset='time')
-    # reindex the group to this date range
-    group = group.set_index('time')
-    group = group.drop(columns=['day'])
-    group = group.reindex(group.index.union(date_range))
-
-    group = group.interpolate(method='linear', fill_value="extrapolate")
-    #group = group.interpolate(method='nearest', fill_value="extrapolate")
-
-    group = group.reindex(date_range, method='nearest', tolerance=pd.Timedelta('1min'))
-    group = group.fillna(0)  # fill any remaining NaNs with 0
-   
-    day_data[day] = group['value'].tolist()
-    day_arrival_data[day] = day_into_arrival_data(day_data[day])
+            rows.append((np.full(len(days), len(names), dtype=np.int32), days.astype(np.int32), grid_values))
+            names.append(name)
+        if not rows:
+            return SeriesGrid([], *(np.zeros(0, dtype=t) for t in (np.int32, np.int32, np.int8)),
+                              np.zeros((0, grid.num_slots), dtype=np.float32))
+        days = np.concatenate([r[1] for r in rows])
+        return SeriesGrid(
+            names=names,
+            series=np.concatenate([r[0] for r in rows]),
+            days=days,
+            weekday=((days.astype(np.int64) - 1) % 7).astype(np.int8),  # ordinal 1 (0001-01-01) is a Monday
+            values=np.concatenate([r[2] for r in rows]).astype(np.float32),
+        )
+
+    _ARRAYS = ('series', 'days', 'weekday', 'values')
+
+    def save(self, cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+        for name in self._ARRAYS:
+            _save_array(cache_dir, name, getattr(self, name))
+
+    @staticmethod
+    def load(cache_dir, names, mmap_mode='r'):
+        return SeriesGrid(names, *(_load_array(cache_dir, name, mmap_mode) for name in SeriesGrid._ARRAYS))
+
+
+def build_wifi_cache(csv_path=WIFI_CSV, cache_dir=WIFI_CACHE_DIR):
+    # the wifi export is rebuilt as a whole, the grid is small next to the per-AP rows
+    raw = read_ap_samples(csv_path)
+    grid = SeriesGrid.from_series(building_series(raw))
+    grid.save(cache_dir)
+    stat = os.stat(csv_path)
+    _write_cache_meta(cache_dir, {
+        'version': CACHE_VERSION,
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': _file_hash(csv_path),
+        'num_samples': len(raw),
+        'num_rows': len(grid),
+        'names': grid.names,
+    })
+    print(f"{len(grid.names)} buildings, {len(grid)} building days from {len(raw)} AP samples")
+    return grid
+
+def _wifi_cache_meta(csv_path, cache_dir):
+    # the meta of an up to date cache, else None
+    meta = _read_cache_meta(cache_dir)
+    if meta is None or meta.get('version') != CACHE_VERSION:
+        return None
+    if not os.path.exists(csv_path):
+        return meta
+    stat = os.stat(csv_path)
+    if meta['size'] != stat.st_size:
+        return None
+    if meta['mtime_ns'] != stat.st_mtime_ns:
+        if meta['sha256'] != _file_hash(csv_path):
+            return None
+        meta['mtime_ns'] = stat.st_mtime_ns
+        _write_cache_meta(cache_dir, meta)
+    return meta
+
+@timed('load_grid')
+def load_series_grid(csv_path=WIFI_CSV, cache_dir=WIFI_CACHE_DIR):
+    # the per-building grid for csv_path, rebuilt whenever the export changed
+    key = (os.path.abspath(csv_path), os.path.abspath(cache_dir))
+    if key not in _loaded_grids:
+        meta = _wifi_cache_meta(csv_path, cache_dir)
+        if meta is None:
+            print(f"Preprocessing {csv_path} into {cache_dir}")
+            build_wifi_cache(csv_path, cache_dir)
+            meta = _read_cache_meta(cache_dir)
+        _loaded_grids[key] = SeriesGrid.load(cache_dir, meta['names'])
+    return _loaded_grids[key]
 
 # our data is somewhat ready, we can now create a dataset class
-class TimeSeriesDataset(torch.utils.data.Dataset):
-    def __init__(self, day_data, day_multiplier=20):
-        self.day_data = day_data
-        self.days = list(day_data.keys())
-        self.maxval = max(max(values) for values in day_data.values())
+class DayGridDataset(torch.utils.data.Dataset):
+    # one item per day: the day of the week token (weekday * day_multiplier) followed by the day's values on the
+    # grid, float32. backed by one contiguous (days, 1 + num_slots) tensor with the token already in column 0,
+    # items are views into it, subsets only hold an index tensor and share the storage.
+    # with series (one long per storage row, for models with num_series) an item is (row, series of the row)
+    def __init__(self, storage, indices=None, day_multiplier=20, series=None):
+        self.storage = storage
+        self.indices = torch.arange(len(storage)) if indices is None else indices
         self.day_multiplier = day_multiplier
-        print(f"Max value in dataset: {self.maxval}, day multiplier: {self.day_multiplier}")
+        self.series = series
+        self.maxval = float(storage[self.indices, 1:].max()) if len(self.indices) else 0.0
 
+    @staticmethod
+    def from_grid(values, weekday, day_multiplier=20, series=None):
+        values = np.asarray(values)
+        storage = torch.empty((values.shape[0], values.shape[1] + 1), dtype=torch.float32)
+        storage[:, 0] = torch.from_numpy(np.asarray(weekday, dtype=np.float32)) * day_multiplier  # prepend the day of the week
+        storage[:, 1:] = torch.from_numpy(np.array(values, dtype=np.float32))  # one copy out of the mmap
+        if series is not None:
+            series = torch.from_numpy(np.array(series, dtype=np.int64))
+        return DayGridDataset(storage, day_multiplier=day_multiplier, series=series)
+
+    def subset(self, mask):
+        # mask (or positions) relative to this dataset
+        indices = self.indices[torch.as_tensor(mask)]
+        return DayGridDataset(self.storage, indices, self.day_multiplier, self.series)
 
     def __len__(self):
-        return len(self.days)
+        return len(self.indices)
 
     def __getitem__(self, idx):
-        day = self.days[idx]
-        values = self.day_data[day]
-        assert len(values) == NUM_TIME_PER_DAY,  f"Expected {NUM_TIME_PER_DAY} values for day {day}, got {len(values)}"
-        day_of_week = day.weekday()  # 0=Monday, 6=Sunday
-        values = [self.day_multiplier * day_of_week] + values  # prepend the day of the week
-        return torch.tensor(values, dtype=torch.float32)
-
-# create the dataset
-validation_days = []
-# select 10% of the days randomly for validation
-
-random.seed(42)  # for reproducibility
-validation_days = random.sample(list(day_data.keys()), k=max(1, len(day_data)) // 10)
-# create a dataset for training and validation
-train_day_data = {day: values for day, values in day_data.items() if day not in validation_days}
-train_day_data_recent = {day: values for day, values in train_day_data.items() if day >= datetime.date(2024, 11, 1) and day not in validation_days}
-validation_day_data = {day: values for day, values in day_data.items() if day in validation_days}
-print(f"Training on {len(train_day_data)} days, validation on {len(validation_day_data)} days")
-
-# create the datasets
-dataset = TimeSeriesDataset(train_day_data)
-dataset_recent = TimeSeriesDataset(train_day_data_recent)
-validation_dataset = TimeSeriesDataset(validation_day_data)
-
-train_data_day_arrival = {day: values for day, values in day_arrival_data.items() if day not in validation_days}
-train_data_day_arrival_recent = {day: values for day, values in train_data_day_arrival.items() if day >= datetime.date(2024, 11, 1) and day not in validation_days}
-validation_data_day_arrival = {day: values for day, values in day_arrival_data.items() if day in validation_days}
-print(f"Training on {len(train_data_day_arrival)} days, validation on {len(validation_data_day_arrival)} days for arrival data")
-
-dataset_arrival = TimeSeriesDataset(train_data_day_arrival, day_multiplier=3)
-dataset_arrival_recent = TimeSeriesDataset(train_data_day_arrival_recent, day_multiplier=3)
-validation_dataset_arrival = TimeSeriesDataset(validation_data_day_arrival, day_multiplier=3)
\ No newline at end of file
+        if isinstance(idx, (int, np.integer)):
+            row = int(self.indices[idx])
+            return self.storage[row] if self.series is None else (self.storage[row], self.series[row])
+        # a whole batch of positions (see loader): one gather instead of one item at a time
+        rows = self.indices[torch.as_tensor(idx)]
+        return self.storage[rows] if self.series is None else (self.storage[rows], self.series[rows])
+
+    def loader(self, batch_size, shuffle=False, generator=None):
+        # DataLoader that hands whole index batches to __getitem__, so no per-item fetch and collate
+        if shuffle:
+            sampler = torch.utils.data.RandomSampler(self, generator=generator)
+        else:
+            sampler = torch.utils.data.SequentialSampler(self)
+        batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last=False)
+        return DataLoader(self, sampler=batch_sampler, batch_size=None)
+
+_loaded_splits = {}
+
+def load_splits(csv_path=DEFAULT_CSV):
+    # the train/validation datasets main.py and recog.py work with, built on first use.
+    # all splits of a series are index views over the same storage
+    if csv_path in _loaded_splits:
+        return _loaded_splits[csv_path]
+
+    grid = load_grid(csv_path)
+    dates = grid.dates
+
+    # select 10% of the days randomly for validation
+    random.seed(42)  # for reproducibility
+    validation_days = random.sample(dates, k=max(1, len(dates)) // 10)
+    validation_set = set(validation_days)
+    is_validation = torch.tensor([day in validation_set for day in dates], dtype=torch.bool)
+    is_recent = torch.from_numpy(np.asarray(grid.days) >= datetime.date(2024, 11, 1).toordinal())
+    # create a dataset for training and validation
+    train = ~is_validation
+    train_recent = train & is_recent
+    print(f"Training on {int(train.sum())} days, validation on {int(is_validation.sum())} days")
+
+    occupancy = DayGridDataset.from_grid(grid.occupancy, grid.weekday)
+    arrivals = DayGridDataset.from_grid(grid.arrivals, grid.weekday, day_multiplier=3)
+    splits = {
+        'validation_days': validation_days,
+        # create the datasets
+        'dataset': occupancy.subset(train),
+        'dataset_recent': occupancy.subset(train_recent),
+        'validation_dataset': occupancy.subset(is_validation),
+        'dataset_arrival': arrivals.subset(train),
+        'dataset_arrival_recent': arrivals.subset(train_recent),
+        'validation_dataset_arrival': arrivals.subset(is_validation),
+    }
+    for name, ds in splits.items():
+        if name != 'validation_days':
+            print(f"{name}: {len(ds)} days, max value {ds.maxval}, day multiplier {ds.day_multiplier}")
+    _loaded_splits[csv_path] = splits
+    return splits
+
+_loaded_wifi_splits = {}
+
+def load_wifi_splits(csv_path=WIFI_CSV):
+    # train/validation datasets over every building, rows are (building, day) with the building as series.
+    # the validation days are held out for all buildings at once, so no building's day leaks through a neighbour.
+    # every building is scaled to percent of its own level (the 99th percentile of its training values), so small
+    # and large buildings weigh the same in the loss; series['scale'] turns forecasts back into device counts
+    if csv_path in _loaded_wifi_splits:
+        return _loaded_wifi_splits[csv_path]
+
+    grid = load_series_grid(csv_path)
+    days = np.unique(grid.days)
+    rng = random.Random(42)  # for reproducibility
+    validation_days = sorted(rng.sample(days.tolist(), k=max(1, len(days) // 10))) if len(days) else []
+    is_validation = np.isin(grid.days, validation_days)
+    # the history is short, "recent" is the last 8 weeks
+    is_recent = grid.days > (days.max() - 56 if len(days) else 0)
+
+    scale = np.ones(len(grid.names))
+    for i in range(len(grid.names)):
+        train_values = grid.values[(grid.series == i) & ~is_validation]
+        if len(train_values):
+            scale[i] = max(1.0, float(np.percentile(train_values, 99)))
+    values = np.asarray(grid.values, dtype=np.float64) * (100.0 / scale[np.asarray(grid.series)])[:, None]
+    print(f"Training on {int((~is_validation).sum())} building days, validation on {int(is_validation.sum())}, "
+          f"{len(grid.names)} buildings")
+
+    rows = DayGridDataset.from_grid(values, grid.weekday, series=grid.series)
+    splits = {
+        'validation_days': [datetime.date.fromordinal(int(day)) for day in validation_days],
+        'series': {'names': list(grid.names), 'scale': scale.tolist()},
+        'dataset': rows.subset(torch.from_numpy(~is_validation)),
+        'dataset_recent': rows.subset(torch.from_numpy(~is_validation & is_recent)),
+        'validation_dataset': rows.subset(torch.from_numpy(is_validation)),
+    }
+    _loaded_wifi_splits[csv_path] = splits
+    return splits
+
+def __getattr__(name):
+    # keeps `from .data import dataset, ...` working, the data is only loaded when one of these is asked for
+    if name in ('validation_days', 'dataset', 'dataset_recent', 'validation_dataset',
+                'dataset_arrival', 'dataset_arrival_recent', 'validation_dataset_arrival'):
+        return load_splits()[name]
+    # the old dict form, {date: [values]}
+    if name in ('day_data', 'day_arrival_data'):
+        grid = load_grid()
+        values = grid.occupancy if name == 'day_data' else grid.arrivals
+        return {day: row.tolist() for day, row in zip(grid.dates, values)}
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+if __name__ == '__main__':
+    # python -m ai.data: bring the preprocessed cache up to date (appended rows are ingested incrementally)
+    # python -m ai.data ingest <delta.csv>: merge rows exported separately, e.g. `WHERE id > last_id`
+    # python -m ai.data last-id: the newest row id in the cache, for incremental exports
+    # python -m ai.data check-resample: compare the vectorized resampler against the per-day pandas one
+    # python -m ai.data wifi: bring the per-building wifi cache up to date
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'wifi':
+        grid = load_series_grid()
+        print(f"Cached {len(grid)} days of {len(grid.names)} buildings in {WIFI_CACHE_DIR}")
+    elif len(sys.argv) > 1 and sys.argv[1] == 'last-id':
+        meta = _read_cache_meta(CACHE_DIR)
+        print(meta['last_id'] if meta else -1)
+    elif len(sys.argv) > 1 and sys.argv[1] == 'check-resample':
+        samples = filter_samples(read_samples(DEFAULT_CSV))
+        days, fast = resample_days(samples)
+        ref_days, ref = resample_days_pandas(samples)
+        assert days == ref_days, "resamplers disagree on the days"
+        print(f"max abs difference over {len(days)} days: {np.abs(fast - ref).max() if len(days) else 0.0}")
+    elif len(sys.argv) > 2 and sys.argv[1] == 'ingest':
+        meta = _read_cache_meta(CACHE_DIR)
+        if meta is None or meta.get('version') != CACHE_VERSION:
+            # the delta alone is not the history, the cache has to come from the full export first
+            if not os.path.exists(DEFAULT_CSV):
+                sys.exit(f"No cache in {CACHE_DIR} and no {DEFAULT_CSV} to build it from, run data/get_data.sh first")
+            load_grid()
+        grid, num_rows = ingest_new_rows(read_samples(sys.argv[2]))
+        print(f"Ingested {num_rows} rows, {len(grid)} days in {CACHE_DIR}")
+    else:
+        grid = load_grid()
+        print(f"Cached {len(grid)} days in {CACHE_DIR}")
@@ -1,5 +1,20 @@
 #!/bin/bash
 
-docker compose exec -i mariadb mariadb -u root -p'secret' -e "SELECT * FROM rwth_gym INTO OUTFILE '/tmp/out.csv' FIELDS TERMINATED BY ','ENCLOSED BY '"'LINES TERMINATED BY '\n';"
+# ./get_data.sh          full export of rwth_gym into out.csv
+# ./get_data.sh append   only export rows newer than the last one in out.csv and append them,
+#                        the next ai.data load then only ingests the new rows
 
-docker compose cp mariadb:/tmp/out.csv .
\ No newline at end of file
+if [ "$1" == "append" ] && [ -s out.csv ]; then
+    # the largest id, not the last line's: out.csv files exported before the ORDER BY below aren't sorted
+    last_id=$(cut -d, -f1 out.csv | tr -d '"' | sort -n | tail -n 1)
+    docker compose exec -i mariadb rm -f /tmp/out_delta.csv
+    docker compose exec -i mariadb mariadb -u root -p'secret' -e "SELECT * FROM rwth_gym WHERE id > $last_id ORDER BY id INTO OUTFILE '/tmp/out_delta.csv' FIELDS TERMINATED BY ',' ENCLOSED BY '\"' LINES TERMINATED BY '\n';"
+    docker compose cp mariadb:/tmp/out_delta.csv .
+    cat out_delta.csv >> out.csv
+    rm out_delta.csv
+    exit 0
+fi
+
+docker compose exec -i mariadb mariadb -u root -p'secret' -e "SELECT * FROM rwth_gym ORDER BY id INTO OUTFILE '/tmp/out.csv' FIELDS TERMINATED BY ',' ENCLOSED BY '\"' LINES TERMINATED BY '\n';"
+
+docker compose cp mariadb:/tmp/out.csv .
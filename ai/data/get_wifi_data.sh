@@ -0,0 +1,11 @@
+#!/bin/bash
+
+# ./get_wifi_data.sh   export the online wifi_data rows with the building of their AP into wifi.csv,
+#                      ai.data aggregates them into one series per building (python -m ai.data wifi)
+#
+# the building of an AP is its newest wifi_data_apnames row, like resolveBuildingApnames in server/src/index.ts
+
+docker compose exec -i mariadb rm -f /tmp/wifi.csv
+docker compose exec -i mariadb mariadb -u root -p'secret' -e "SELECT wd.id, wd.apname, wan.building, wd.users_2_4_ghz + wd.users_5_ghz, wd.insert_time FROM wifi_data wd INNER JOIN (SELECT apname, MAX(id) AS max_id FROM wifi_data_apnames GROUP BY apname) latest ON wd.apname = latest.apname INNER JOIN wifi_data_apnames wan ON wan.id = latest.max_id WHERE wd.online = 1 AND wan.building != '' ORDER BY wd.id INTO OUTFILE '/tmp/wifi.csv' FIELDS TERMINATED BY ','ENCLOSED BY '"'LINES TERMINATED BY '\n';"
+
+docker compose cp mariadb:/tmp/wifi.csv .
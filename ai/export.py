@@ -0,0 +1,282 @@
+import os
+import sys
+import copy
+import json
+import math
+import time
+import hashlib
+import argparse
+import datetime
+from typing import List
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .data import NUM_TIME_PER_DAY, ARRIVAL_WINDOW
+from .model import TransformerDecoder, DecoderOnlyTransformerLayer
+from .checkpoint import load_model_and_config
+from .artifact import load_artifact, ArtifactPredictor
+from .backtest import TransformerPredictor, prepare, run_predictor, collect_points, evaluate, cutoff_slot
+
+# python -m ai.export --model ai/models/<run>/model_final.pt [--quantize] [--out model.pts] [--no-report]
+#
+# writes a TorchScript artifact with the whole inference path inside (arrival conversion, KV-cached greedy rollout),
+# loadable with ai.artifact.load_artifact without the model code or ai/data.py. afterwards the artifact is compared
+# against the eager fp32 model on the validation days (accuracy and latency), see export_report
+
+ARTIFACT_FORMAT = 1
+
+
+class _ExportLayer(nn.Module):
+    # DecoderOnlyTransformerLayer.forward_cached with the attention projections as plain nn.Linear,
+    # which is what TorchScript and dynamic quantization both want (MultiheadAttention keeps in_proj as a raw parameter)
+    def __init__(self, layer: DecoderOnlyTransformerLayer):
+        super().__init__()
+        attn = layer.self_attn
+        d_model = attn.embed_dim
+        self.num_heads = attn.num_heads
+        self.in_proj = nn.Linear(d_model, 3 * d_model)
+        self.in_proj.weight.data.copy_(attn.in_proj_weight.data)
+        self.in_proj.bias.data.copy_(attn.in_proj_bias.data)
+        self.out_proj = nn.Linear(d_model, d_model)
+        self.out_proj.load_state_dict(attn.out_proj.state_dict())
+        self.linear1 = copy.deepcopy(layer.linear1)
+        self.linear2 = copy.deepcopy(layer.linear2)
+
+    def forward(self, x: torch.Tensor, keys: torch.Tensor, values: torch.Tensor, start: int):
+        new_len, batch_size, d_model = x.size()
+        head_dim = d_model // self.num_heads
+        end = start + new_len
+        qkv = self.in_proj(x).chunk(3, dim=-1)
+        q = qkv[0].reshape(new_len, batch_size, self.num_heads, head_dim).permute(1, 2, 0, 3)
+        keys[:, :, start:end] = qkv[1].reshape(new_len, batch_size, self.num_heads, head_dim).permute(1, 2, 0, 3)
+        values[:, :, start:end] = qkv[2].reshape(new_len, batch_size, self.num_heads, head_dim).permute(1, 2, 0, 3)
+        if new_len > 1:
+            mask = torch.ones(new_len, end, dtype=torch.bool, device=x.device).tril(diagonal=start)
+            out = F.scaled_dot_product_attention(q, keys[:, :, :end], values[:, :, :end], attn_mask=mask)
+        else:
+            out = F.scaled_dot_product_attention(q, keys[:, :, :end], values[:, :, :end])
+        out = out.permute(2, 0, 1, 3).reshape(new_len, batch_size, d_model)
+        x = x + self.out_proj(out)
+        return x + self.linear2(torch.relu(self.linear1(x)))
+
+
+class ExportedForecaster(nn.Module):
+    # forward(weekday (rows,), occupancy prefixes (rows, slots), cutoff slots (rows,)) -> (rows, slots) occupancy,
+    # the known slots up to the cutoff followed by the forecast. same numbers as backtest.TransformerPredictor
+    def __init__(self, model: TransformerDecoder, use_arrival_data: bool, num_slots: int = NUM_TIME_PER_DAY):
+        super().__init__()
+        first_attn = model.decoder_blocks[0].self_attn
+        self.num_heads = first_attn.num_heads
+        self.head_dim = first_attn.embed_dim // first_attn.num_heads
+        self.num_layers = len(model.decoder_blocks)
+        self.num_slots = num_slots
+        self.register_buffer('positional', model.positional_encoding.weight.detach().clone())
+        self.input_linear = copy.deepcopy(model.input_linear)
+        self.input_linear2 = copy.deepcopy(model.input_linear2)
+        self.layers = nn.ModuleList([_ExportLayer(layer) for layer in model.decoder_blocks])
+        self.head = copy.deepcopy(model.linear)
+        self.maxval = float(model.maxval)
+        self.log_maxval = math.log(model.maxval + 1)
+        self.logscale_tricks = bool(model.logscale_tricks)
+        self.use_arrival_data = use_arrival_data
+        # the day token, see DayGridDataset
+        self.day_multiplier = 3.0 if use_arrival_data else 20.0
+        self.arrival_window = ARRIVAL_WINDOW
+
+    def _embed(self, x: torch.Tensor, start: int):
+        x = x.unsqueeze(-1).permute(1, 0, 2)
+        if self.logscale_tricks:
+            x = torch.log1p(x) / self.log_maxval
+        else:
+            x = x / self.maxval
+        x = self.input_linear2(torch.relu(self.input_linear(x)))
+        return x + self.positional[start:start + x.size(0)].unsqueeze(1)
+
+    def _project(self, x: torch.Tensor):
+        x = self.head(x)
+        if self.logscale_tricks:
+            return torch.expm1(x * self.log_maxval)
+        return x * self.maxval
+
+    def _step(self, x: torch.Tensor, keys: List[torch.Tensor], values: List[torch.Tensor], start: int):
+        x = self._embed(x, start)
+        for i, layer in enumerate(self.layers):
+            x = layer(x, keys[i], values[i], start)
+        return self._project(x)
+
+    def rollout(self, prefixes: torch.Tensor, lengths: torch.Tensor, total_len: int):
+        # ai.rollout.rollout
+        rows = prefixes.size(0)
+        device = prefixes.device
+        min_len = int(lengths.min())
+        is_known = torch.arange(total_len, device=device).unsqueeze(0) < lengths.unsqueeze(1)
+        out = torch.zeros(rows, total_len, device=device)
+        known = min(prefixes.size(1), total_len)
+        out[:, :known] = prefixes[:, :known]
+        out = torch.where(is_known, out, torch.zeros_like(out))
+
+        keys: List[torch.Tensor] = []
+        values: List[torch.Tensor] = []
+        for _ in range(self.num_layers):
+            keys.append(torch.zeros(rows, self.num_heads, total_len, self.head_dim, device=device))
+            values.append(torch.zeros(rows, self.num_heads, total_len, self.head_dim, device=device))
+        output = self._step(out[:, :min_len], keys, values, 0)
+        for t in range(min_len, total_len):
+            out[:, t] = torch.where(is_known[:, t], out[:, t], output[-1, :, 0])
+            if t + 1 < total_len:
+                output = self._step(out[:, t:t + 1], keys, values, t)
+        return out
+
+    def arrivals(self, occupancy: torch.Tensor):
+        # data.arrivals_from_occupancy
+        arrivals = torch.zeros_like(occupancy)
+        window_sum = torch.zeros_like(occupancy[:, 0])
+        for i in range(occupancy.size(1)):
+            arrivals[:, i] = torch.clamp(occupancy[:, i] - window_sum, min=0.0)
+            window_sum = window_sum + arrivals[:, i]
+            if i >= self.arrival_window:
+                window_sum = window_sum - arrivals[:, i - self.arrival_window]
+        return arrivals
+
+    def occupancy(self, arrivals: torch.Tensor):
+        # data.occupancy_from_arrivals
+        width = self.arrival_window + 1
+        csum = torch.cumsum(F.pad(arrivals, (width, 0)), dim=-1)
+        return csum[:, width:] - csum[:, :-width]
+
+    def forward(self, weekday: torch.Tensor, prefixes: torch.Tensor, cutoff: torch.Tensor):
+        series = self.arrivals(prefixes) if self.use_arrival_data else prefixes
+        tokens = weekday.to(series.dtype).unsqueeze(1) * self.day_multiplier
+        x = torch.cat([tokens, series], dim=1)
+        forecast = self.rollout(x, cutoff + 2, self.num_slots + 1)[:, 1:]
+        if self.use_arrival_data:
+            forecast = self.occupancy(forecast)
+        return forecast
+
+
+def module_dims(model: TransformerDecoder):
+    attn = model.decoder_blocks[0].self_attn
+    return attn.embed_dim, attn.num_heads
+
+
+def export(model_path, out_path, quantize=False):
+    model, config = load_model_and_config(model_path, map_location='cpu')
+    model = model.float().eval()
+    if getattr(model, 'attention', 'mha') != 'mha':
+        raise ValueError("only the mha attention can be exported for now")
+    if getattr(model, 'num_series', 0):
+        raise ValueError("multi-series (--data wifi) models can't be exported yet, the graph has no series input")
+    # the old pickled models were all trained on arrivals
+    use_arrival_data = config['use_arrival_data'] if config else True
+    module = ExportedForecaster(model, use_arrival_data).eval()
+    if quantize:
+        # int8 weights for the linears inside the blocks, the 1-wide input projection and the head stay fp32
+        module = torch.ao.quantization.quantize_dynamic(module, {'layers'}, dtype=torch.qint8)
+    scripted = torch.jit.script(module)
+
+    with open(model_path, 'rb') as f:
+        source_sha256 = hashlib.sha256(f.read()).hexdigest()
+    meta = {
+        'format': ARTIFACT_FORMAT,
+        'created': datetime.datetime.now().isoformat(),
+        'source': os.path.abspath(model_path),
+        'source_sha256': source_sha256,
+        'quantized': quantize,
+        'use_arrival_data': use_arrival_data,
+        'num_slots': NUM_TIME_PER_DAY,
+        'model': {
+            'd_model': module_dims(model)[0],
+            'nhead': module_dims(model)[1],
+            'num_layers': len(model.decoder_blocks),
+            'maxval': float(model.maxval),
+            'logscale_tricks': bool(model.logscale_tricks),
+        },
+        'torch': torch.__version__,
+    }
+    tmp_path = out_path + '.tmp'
+    torch.jit.save(scripted, tmp_path, _extra_files={'meta.json': json.dumps(meta)})
+    os.replace(tmp_path, out_path)
+    return meta
+
+
+def _single_row_ms(predictor, data, num=50, seed=0):
+    # latency of one forecast on its own, like a single uncached request
+    rng = np.random.default_rng(seed)
+    num_days, num_cutoffs, num_slots = data['prefixes'].shape
+    times = []
+    for _ in range(num):
+        d, c = rng.integers(num_days), rng.integers(num_cutoffs)
+        start = time.perf_counter()
+        predictor(data['days'][d:d + 1], data['weekday'][d:d + 1], np.array([data['cutoff_slots'][c]]),
+                  data['prefixes'][d, c][None], data['observed'][d, c][None])
+        times.append(1000 * (time.perf_counter() - start))
+    return {f'p{p}': float(np.percentile(times, p)) for p in (50, 90, 99)}
+
+
+def export_report(model_path, artifact_path):
+    # fp32 eager model vs the artifact on the validation days, same points for both
+    data = prepare('validation')
+    data['cutoff_slots'] = [cutoff_slot(hour) for hour in data['cutoff_hours']]
+
+    start = time.perf_counter()
+    model, config = load_model_and_config(model_path, map_location='cpu')
+    eager_load = time.perf_counter() - start
+    start = time.perf_counter()
+    module, meta = load_artifact(artifact_path)
+    artifact_load = time.perf_counter() - start
+
+    predictors = {
+        'eager_fp32': (TransformerPredictor(model.eval(), config['use_arrival_data'] if config else True), eager_load),
+        'artifact_int8' if meta['quantized'] else 'artifact_fp32': (ArtifactPredictor(module), artifact_load),
+    }
+    report = {'model': os.path.abspath(model_path), 'artifact': os.path.abspath(artifact_path), 'meta': meta,
+              'num_days': int(len(data['days'])), 'variants': {}}
+    reference = None
+    for name, (predictor, load_seconds) in predictors.items():
+        outputs, seconds = run_predictor(predictor, data['days'], data['weekday'], data['cutoff_hours'],
+                                         data['prefixes'], data['observed'])
+        points = collect_points(outputs, data['actual'], data['scored'], data['days'], data['cutoff_hours'])
+        metrics = evaluate(points)
+        variant = {
+            'load_seconds': load_seconds,
+            'mae': metrics['mae'],
+            'mae_by_horizon': metrics['mae_by_horizon'],
+            'batched_ms_per_forecast': 1000 * seconds / max(len(data['days']) * len(data['cutoff_hours']), 1),
+            'single_forecast_ms': _single_row_ms(predictor, data),
+        }
+        if reference is None:
+            reference = points['value']
+        else:
+            deviation = np.abs(points['value'] - reference)
+            variant['max_abs_deviation'] = float(deviation.max()) if len(deviation) else 0.0
+            variant['mean_abs_deviation'] = float(deviation.mean()) if len(deviation) else 0.0
+        report['variants'][name] = variant
+        print(f"{name}: MAE {variant['mae']:.3f}, {variant['batched_ms_per_forecast']:.2f} ms/forecast batched, "
+              f"single p50 {variant['single_forecast_ms']['p50']:.1f} ms, load {load_seconds:.2f}s"
+              + (f", mean |diff| to fp32 {variant['mean_abs_deviation']:.4f}" if 'mean_abs_deviation' in variant else ''))
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ai.export', description="Export a trained forecaster as TorchScript")
+    parser.add_argument('--model', required=True, help="checkpoint or old pickled model")
+    parser.add_argument('--out', help="artifact path (default: next to the model, .pts / _int8.pts)")
+    parser.add_argument('--quantize', action='store_true', help="dynamic int8 quantization of the linears in the blocks")
+    parser.add_argument('--no-report', action='store_true', help="skip the comparison on the validation days")
+    args = parser.parse_args(argv)
+
+    out = args.out or os.path.splitext(os.path.abspath(args.model))[0] + ('_int8.pts' if args.quantize else '.pts')
+    meta = export(args.model, out, args.quantize)
+    print(f"Exported {args.model} to {out} ({'int8' if meta['quantized'] else 'fp32'})")
+    if not args.no_report:
+        report = export_report(args.model, out)
+        report_path = os.path.splitext(out)[0] + '_report.json'
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=4)
+        print(f"Report written to {report_path}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
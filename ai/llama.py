@@ -1,5 +1,6 @@
 import torch
 from torch import nn
+import torch.nn.functional as F
 from typing import Tuple
 
 # Taken from facebookresearch/llama/model.py
@@ -49,55 +50,56 @@ class FusedEncoderBlock(nn.Module):
         - GELU activation is used instead of ReLU.
 
     Args:
-        model_config (ModelConfig): Model config settings.
+        d_model (int): Model width.
+        n_heads (int): Number of attention heads.
+        ff_mult (int): Width of the feed forward layer, as a multiple of d_model.
+        drop_p (float): Dropout probability.
     """
 
-    def __init__(self, model_config: ModelConfig):
+    def __init__(self, d_model: int, n_heads: int, ff_mult: int = 4, drop_p: float = 0.1):
         super().__init__()
 
-        self.pad_id = model_config.pad_id
-        self.drop_p = model_config.drop_p
-        self.n_heads = model_config.n_heads
-        self.d_head = model_config.d_model // model_config.n_heads
-        self.max_seq_len = model_config.max_seq_len
+        self.drop_p = drop_p
+        self.n_heads = n_heads
+        self.d_head = d_model // n_heads
 
         # Attention
         self.q = nn.Linear(
-            in_features=model_config.d_model,
-            out_features=model_config.d_model,
+            in_features=d_model,
+            out_features=d_model,
             bias=False,
         )
         self.k = nn.Linear(
-            in_features=model_config.d_model,
-            out_features=model_config.d_model,
+            in_features=d_model,
+            out_features=d_model,
             bias=False,
         )
         self.v = nn.Linear(
-            in_features=model_config.d_model,
-            out_features=model_config.d_model,
+            in_features=d_model,
+            out_features=d_model,
             bias=False,
         )
         self.att_proj_linear = nn.Linear(
-            in_features=model_config.d_model,
-            out_features=model_config.d_model,
+            in_features=d_model,
+            out_features=d_model,
         )
-        self.resid_dropout = nn.Dropout(model_config.drop_p)
+        self.resid_dropout = nn.Dropout(drop_p)
 
         # FF Layer
-        self.ff_dropout = nn.Dropout(model_config.drop_p)
+        self.ff_dropout = nn.Dropout(drop_p)
         self.ff_linear_1 = nn.Linear(
-            in_features=model_config.d_model,
-            out_features=model_config.d_model * model_config.ff_mult,
+            in_features=d_model,
+            out_features=d_model * ff_mult,
         )
         self.ff_linear_2 = nn.Linear(
-            in_features=model_config.d_model * model_config.ff_mult,
-            out_features=model_config.d_model,
+            in_features=d_model * ff_mult,
+            out_features=d_model,
         )
         self.ff_activation = nn.GELU()
 
         # Pre layer norms
-        self.norm1 = nn.LayerNorm(model_config.d_model)
-        self.norm2 = nn.LayerNorm(model_config.d_model)
+        self.norm1 = nn.LayerNorm(d_model)
+        self.norm2 = nn.LayerNorm(d_model)
 
     def forward(
         self, x: torch.Tensor, pad_mask: torch.Tensor, freqs_cis: torch.Tensor
@@ -151,3 +153,64 @@ class FusedEncoderBlock(nn.Module):
         x = self.ff_linear_2(self.ff_activation(self.ff_linear_1(x)))
 
         return self.ff_dropout(x)
+
+
+class FusedDecoderBlock(FusedEncoderBlock):
+    """Causal variant of FusedEncoderBlock, used by TransformerDecoder(attention='rotary').
+
+    Works in the (seq_len, batch_size, d_model) layout of ai/model.py. The causal mask is left to
+    F.scaled_dot_product_attention (is_causal=True) instead of being materialized, and the rotary
+    embeddings replace the learned positional table, so the sequence length is only bounded by the
+    precomputed frequencies (which the model extends on demand).
+
+    forward_cached is the incremental version for KV-cached decoding, like
+    DecoderOnlyTransformerLayer.forward_cached: keys/values hold the rotated keys and the values of all
+    earlier timesteps, x the timesteps from position `start` on.
+    """
+
+    def forward(self, x: torch.Tensor, freqs_cis: torch.Tensor):
+        x = x + self._causal_att_block(self.norm1(x), freqs_cis)
+        x = x + self._ff_block(self.norm2(x))
+
+        return x
+
+    def forward_cached(
+        self, x: torch.Tensor, keys: torch.Tensor, values: torch.Tensor, start: int, freqs_cis: torch.Tensor
+    ):
+        x = x + self._causal_att_block(self.norm1(x), freqs_cis, keys, values, start)
+        x = x + self._ff_block(self.norm2(x))
+
+        return x
+
+    def _causal_att_block(self, x, freqs_cis, keys=None, values=None, start=0):
+        seq_len, batch_size, _ = x.shape
+
+        # (s_len, b_sz, d_model) -> (b_sz, s_len, n_head, d_head) for the rotary embeddings
+        xq = self.q(x).view(seq_len, batch_size, self.n_heads, self.d_head).transpose(0, 1)
+        xk = self.k(x).view(seq_len, batch_size, self.n_heads, self.d_head).transpose(0, 1)
+        xv = self.v(x).view(seq_len, batch_size, self.n_heads, self.d_head).transpose(0, 1)
+        xq, xk = apply_rotary_emb(xq, xk, freqs_cis)
+
+        # (b_sz, n_head, s_len, d_head)
+        xq, xk, xv = xq.transpose(1, 2), xk.transpose(1, 2), xv.transpose(1, 2)
+        att_dropout = self.drop_p if self.training else 0.0
+
+        if keys is None:
+            att = F.scaled_dot_product_attention(xq, xk, xv, dropout_p=att_dropout, is_causal=True)
+        else:
+            end = start + seq_len
+            assert end <= keys.size(2), f"KV cache too small: need {end} timesteps, have {keys.size(2)}"
+            keys[:, :, start:end] = xk
+            values[:, :, start:end] = xv
+            # the first new timestep sees the whole cached prefix, every further one sees one more key
+            mask = None
+            if seq_len > 1:
+                mask = torch.ones(seq_len, end, dtype=torch.bool, device=x.device).tril(diagonal=start)
+            att = F.scaled_dot_product_attention(
+                xq, keys[:, :, :end], values[:, :, :end], attn_mask=mask, dropout_p=att_dropout
+            )
+
+        # back to (s_len, b_sz, d_model)
+        out = att.permute(2, 0, 1, 3).reshape(seq_len, batch_size, self.n_heads * self.d_head)
+
+        return self.resid_dropout(self.att_proj_linear(out))
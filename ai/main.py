@@ -1,154 +1,417 @@
-import pandas as pd
 import os
-import torch
+import sys
 import json
+import time
+import random
+import argparse
 import datetime
-from torch.utils.data import DataLoader
+import contextlib
+import dataclasses
+import numpy as np
+import torch
 
-import random
-from torch.optim.swa_utils import AveragedModel, SWALR
+try:
+    import resource
+except ImportError:  # not on windows
+    resource = None
 
-from .data import dataset, validation_dataset, dataset_recent, dataset_arrival, validation_dataset_arrival, dataset_arrival_recent
+from .data import NUM_TIME_PER_DAY, FULL_DAY_GRID, load_splits, load_wifi_splits
 from .model import TransformerDecoder
+from .rollout import sequence_training_inputs
+from .checkpoint import save_checkpoint, load_checkpoint, set_rng_state, append_run
+from . import profiling
+
+MODELS_DIR = os.path.join(os.path.dirname(__file__), 'models')
+RUN_REGISTRY = os.path.join(MODELS_DIR, 'runs.jsonl')
+
+
+@dataclasses.dataclass
+class TrainConfig:
+    # model
+    d_model: int = 128
+    nhead: int = 1
+    num_layers: int = 2
+    dropout_rate: float = 0.0
+    logscale_tricks: bool = False
+    # 'mha' (nn.MultiheadAttention, learned positional table) or 'rotary' (fused SDPA blocks with rotary embeddings)
+    attention: str = 'mha'
+    # 'next_step' (teacher-forced next value, forecasts by autoregressive rollout), 'horizon' (only the direct
+    # multi-horizon head, the whole rest of the day from every prefix in one pass) or 'both' (next-step loss
+    # + horizon_weight * horizon loss, the model can then forecast either way)
+    objective: str = 'next_step'
+    horizon_weight: float = 1.0
+    # data: 'gym' (the rwth_gym occupancy) or 'wifi' (the device counts of every building from the wifi export,
+    # one series per building on the full-day grid, trained together with a series embedding)
+    data: str = 'gym'
+    use_arrival_data: bool = True  # gym only, arrivals are a property of the gym's check-in system
+    # optimization
+    learning_rate: float = 1e-3
+    weight_decay: float = 0.0
+    batch_size: int = 8
+    epochs: int = 50
+    # after this epoch only train on the recent days, with larger batches
+    switch_to_recent_at: int = 45
+    recent_batch_size: int = 24
+    # after this epoch, half of the batches are trained on the model's own rollouts
+    enable_sequence_training_at: int = 40
+    sequence_training_prob: float = 0.5
+    # share of the positions after the random start point that get the model's own prediction during sequence training.
+    # 1.0 = full autoregressive rollout, below that scheduled sampling from a single teacher-forced pass
+    rollout_ratio: float = 1.0
+    # execution modes, both fall back to plain eager fp32 if they don't work on this machine
+    compile: bool = False
+    bf16: bool = False  # bf16 autocast for forward and loss, the weights and optimizer stay fp32
+    # bookkeeping
+    seed: int | None = None
+    checkpoint_every: int = 20
+    run_name: str = ''
+
+
+def _parse_bool(value):
+    if value.lower() in ('1', 'true', 'yes', 'on'):
+        return True
+    if value.lower() in ('0', 'false', 'no', 'off'):
+        return False
+    raise argparse.ArgumentTypeError(f"not a boolean: {value}")
+
+
+def parse_args(argv=None):
+    # config file < command line. when resuming, the run's own config is the base instead of the defaults
+    parser = argparse.ArgumentParser(prog='python -m ai.main', description="Train the TransformerDecoder forecaster")
+    parser.add_argument('--config', help="json file with TrainConfig fields")
+    parser.add_argument('--resume', help="checkpoint to continue from, e.g. ai/models/<run>/checkpoint_last.pt")
+    for field in dataclasses.fields(TrainConfig):
+        field_type = {bool: _parse_bool, int: int, float: float, str: str}.get(field.type, int)
+        parser.add_argument('--' + field.name.replace('_', '-'), dest=field.name, type=field_type, default=None)
+    args = parser.parse_args(argv)
+
+    overrides = {}
+    if args.config:
+        with open(args.config) as f:
+            overrides.update(json.load(f))
+    overrides.update({field.name: getattr(args, field.name) for field in dataclasses.fields(TrainConfig)
+                      if getattr(args, field.name) is not None})
+    return overrides, args.resume
+
 
-use_arrival_data = True  
-main_ds = dataset_arrival if use_arrival_data else dataset
-validation_ds = validation_dataset_arrival if use_arrival_data else validation_dataset
-main_recent_ds = dataset_arrival_recent if use_arrival_data else dataset_recent
-
-# create the model
-model = TransformerDecoder(d_model=128, nhead=1, num_layers=2, dropout_rate=0.0, maxval=dataset.maxval, logscale_tricks=False)
-# print the model
-print(model)
-print("Model parameters:", sum(p.numel() for p in model.parameters()))
-print("Model trainable parameters:", sum(p.numel() for p in model.parameters() if p.requires_grad))  # Exclude biases
-
-# model = torch.compile(model, fullgraph=True)  # Compile the model for better performance
-
-# Example training loop (quick and dirty)
-
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = model.to(device)
-
-learning_rate = 1e-3
-optimizer = torch.optim.AdamW(model.parameters(), lr=learning_rate, weight_decay=0)
-criterion = torch.nn.MSELoss()
-#criterion = torch.nn.L1Loss()  # Use L1 loss for robustness against outliers
-
-dataloader_train = DataLoader(main_ds, batch_size=8, shuffle=True)
-dataloader_validation = DataLoader(validation_ds, batch_size=8, shuffle=False)
-
-EPOCHS = 50
-SWITCH_TO_RECENT_AT = 45
-ENABLE_SEQUENCE_TRAINING_AT = 40
-
-all_stats = []
-
-def save_all_stats():
-    # save all stats to a single file
-    with open(os.path.join(os.path.dirname(__file__), "models/stats.json"), 'w') as f:
-        json.dump(all_stats, f, indent=4)
-
-for epoch in range(EPOCHS):
-    model.train()
-    total_loss = 0
-    total_loss_validation = 0
-    step_train = 0
-    for batch in dataloader_train:
-        batch: torch.Tensor = batch.to(device)
-        optimizer.zero_grad()
-        in_x = batch[:, :-1]  # (batch_size, seq_length-1)
-        cur_batchsize = in_x.size(0)
-
-        # sequence training
-        if random.random() < 0.5 and epoch > ENABLE_SEQUENCE_TRAINING_AT:
-            start_search_at = random.randint(1, in_x.size(1) - 1)
-
-            in_x_search = in_x[:, :start_search_at].clone()
-            while in_x_search.size(1) < in_x.size(1):
-                output = model(in_x_search)
-                output = output.permute(1, 0, 2)  # (batch_size, seq_length-1, 1)
-                next_value = output[:, -1, 0].unsqueeze(1)  #
-                in_x_search = torch.cat((in_x_search, next_value), dim=1)  # (batch_size, seq_length)
-            in_x = in_x_search  # Use the search input for training
-
-        output = model(in_x) # (seq_length, batch_size, 1)
-
-        # we want to predict the next value, so we need to shift the output by one
-        target = batch[:, 1:]
-        output = output.permute(1, 0, 2)  # (batch_size, seq_length-1, 1)
+def build_model(config: TrainConfig, maxval, num_series=0):
+    # kwargs are stored in the checkpoint, checkpoint.load_model rebuilds the model from them
+    num_slots = FULL_DAY_GRID.num_slots if config.data == 'wifi' else NUM_TIME_PER_DAY
+    model_kwargs = dict(
+        d_model=config.d_model,
+        nhead=config.nhead,
+        num_layers=config.num_layers,
+        dropout_rate=config.dropout_rate,
+        maxval=maxval,
+        logscale_tricks=config.logscale_tricks,
+        attention=config.attention,
+        horizon_head=config.objective != 'next_step',
+        max_time_dim=num_slots + 1,  # the day token and the slots
+        num_series=num_series,
+    )
+    return TransformerDecoder(**model_kwargs), model_kwargs
+
+
+def horizon_loss(horizon, batch):
+    # horizon: (seq_length, batch_size, max_time_dim) head output for batch[:, :-1], batch: (batch_size, seq_length + 1).
+    # MSE over every (last known position t, forecast position p > t) pair, i.e. all prefix lengths at once
+    seq_len = batch.size(1)
+    pred = horizon[:, :, :seq_len].permute(1, 0, 2)  # (batch_size, t, p)
+    t = torch.arange(pred.size(1), device=batch.device).unsqueeze(1)
+    p = torch.arange(seq_len, device=batch.device).unsqueeze(0)
+    err = (pred - batch.unsqueeze(1)) ** 2
+    return err[:, p > t].mean()
+
+
+def _split_batch(batch, device):
+    # (rows, series of the rows or None) of a loader batch, see DayGridDataset
+    if isinstance(batch, (tuple, list)):
+        return batch[0].to(device), batch[1].to(device)
+    return batch.to(device), None
+
+
+def _losses(config: TrainConfig, model, in_x, batch, criterion, series=None):
+    # (loss to optimize, {part: loss}, next-step output (batch_size, seq_length, 1)) of one batch
+    target = batch[:, 1:]
+    if config.objective == 'next_step':
+        output = model(in_x, series=series)  # (seq_length, batch_size, 1)
+    else:
+        output, horizon = model(in_x, horizon=True, series=series)
+    # we want to predict the next value, so we need to shift the output by one
+    output = output.float().permute(1, 0, 2)  # (batch_size, seq_length-1, 1)
+    parts = {}
+    if config.objective != 'horizon':
         #loss = criterion(torch.log(1 + output), torch.log(1 + target.unsqueeze(-1)))  # target needs to be of shape (batch_size, seq_length, 1)
-        loss = criterion(output, target.unsqueeze(-1))  # target needs to be of shape (batch_size, seq_length, 1)
-        # loss = loss / cur_batchsize # feels right
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)  # Gradient clipping
-        optimizer.step()
-        total_loss += loss.item()
-        step_train += 1
-        if step_train % 10 == 0:
-            print(f"Epoch {epoch}/{EPOCHS}, Step {step_train}, Loss: {loss.item():.4f}")
-    # Validation 
-    model.eval()
-    step_valid = 0
-    for batch in dataloader_validation:
-
-        batch = batch.to(device)
-        with torch.no_grad():
-            in_x = batch[:,:-1]
-            output = model(in_x)
-            target = batch[:, 1:]
-            output = output.permute(1, 0, 2)  # (batch_size, seq_length-1, 1)
-
-            if step_valid == 0:
-                print("Input", in_x.shape)
-                print("Output", output.shape)
-                # print first batch dimension
-                fr = 60
-                to = fr + 20
-                expected = target[0, fr:to].tolist()
-                predicted = output[0, fr:to, 0].tolist()
-                # zip them together
-                for i, (exp, pred) in enumerate(zip(expected, predicted)):
-                   print(f"Validation t={i+1}: Expected: {exp:.2f}, Predicted: {pred:.2f}")
-
-            loss = criterion(output, target.unsqueeze(-1))
-            total_loss_validation += loss.item()
-            step_valid += 1
-
-    
-        # decrease learning rate
-        # if epoch < swa_start and epoch % 50 == 0:
-        #     learning_rate *= 0.5
-        #     for param_group in optimizer.param_groups:
-        #         param_group['lr'] *= learning_rate
-        
-    if epoch == SWITCH_TO_RECENT_AT:
-        dataloader_train = DataLoader(main_recent_ds, batch_size=24, shuffle=True)
-    
-    # also save stats
-    stats = {
-        'epoch': epoch,
-        'train_loss': total_loss / step_train,
-        'valid_loss': total_loss_validation / step_valid,
-        'date': datetime.datetime.now().isoformat(),
-        'learning_rate': learning_rate,
-    }
-    all_stats.append(stats)
-    if epoch % 20 == 0:
-        torch.save(model, os.path.join(os.path.dirname(__file__), f'models/model_epoch_{epoch}.ptp'))
-        with open(os.path.join(os.path.dirname(__file__), f"models/stats_epoch_{epoch}.json"), 'w') as f:
-            import json
-            json.dump(stats, f, indent=4)
-        save_all_stats()
-    # elif epoch <= 10:
-    #     for param_group in optimizer.param_groups:
-    #         param_group['lr'] = epoch / 10 * learning_rate
-
-    print(f"Epoch {epoch}/{EPOCHS}, Training Loss: {total_loss/step_train:.4f}, Validation Loss: {total_loss_validation/step_valid:.4f}")
-
-# save the final model
-torch.save(model, os.path.join(os.path.dirname(__file__), "models/model_final.ptp"))
-# summarize all stats
-save_all_stats()
+        parts['next_step'] = criterion(output, target.unsqueeze(-1))  # target needs to be of shape (batch_size, seq_length, 1)
+    if config.objective != 'next_step':
+        parts['horizon'] = horizon_loss(horizon.float(), batch)
+    loss = parts.get('next_step', 0) + config.horizon_weight * parts.get('horizon', 0)
+    return loss, parts, output
+
+
+def _autocast(device, enabled):
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
+
+def _setup_modes(config: TrainConfig, model, device, sample, sample_series=None):
+    # tries the requested modes on one batch (forward and backward, like a training step) and keeps what works.
+    # torch.compile only compiles on the first call, so that is where it fails if it does
+    use_bf16 = config.bf16
+    if use_bf16 and device.type == 'cuda' and not torch.cuda.is_bf16_supported():
+        print("bf16 is not supported on this GPU, training in fp32")
+        use_bf16 = False
+
+    train_model = model
+    if config.compile:
+        try:
+            train_model = torch.compile(model)
+        except Exception as e:  # e.g. no compiler toolchain, unsupported python
+            print(f"torch.compile unavailable ({e!r}), training eagerly")
+
+    for _ in range(2):
+        try:
+            with _autocast(device, use_bf16):
+                outputs = train_model(sample, horizon=config.objective != 'next_step', series=sample_series)
+                sum(o.float().sum() for o in (outputs if isinstance(outputs, tuple) else (outputs,))).backward()
+            model.zero_grad(set_to_none=True)
+            break
+        except Exception as e:
+            model.zero_grad(set_to_none=True)
+            if train_model is not model:
+                print(f"compiled model failed ({e!r}), training eagerly")
+                train_model = model
+            elif use_bf16:
+                print(f"bf16 autocast failed ({e!r}), training in fp32")
+                use_bf16 = False
+            else:
+                raise
+    return train_model, use_bf16
+
+
+def _peak_memory_mb(device):
+    # (megabytes, scope): on the gpu the peak of this epoch (the stats are reset at its start), on the cpu the peak
+    # resident size of the whole process so far, which can't be reset and never goes down between epochs
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20, 'epoch'
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 'process'  # kilobytes on linux
+    return None, None
+
+
+def train(config: TrainConfig, resume=None):
+    assert config.objective in ('next_step', 'horizon', 'both'), f"unknown objective {config.objective}"
+    assert config.data in ('gym', 'wifi'), f"unknown data {config.data}"
+    checkpoint = load_checkpoint(resume) if resume else None
+    run_dir = os.path.dirname(os.path.abspath(resume)) if resume else os.path.join(
+        MODELS_DIR, config.run_name or datetime.datetime.now().strftime('run_%Y%m%d_%H%M%S'))
+    os.makedirs(run_dir, exist_ok=True)
+
+    if config.data == 'wifi':
+        splits = load_wifi_splits()
+        main_ds, validation_ds, main_recent_ds = splits['dataset'], splits['validation_dataset'], splits['dataset_recent']
+    else:
+        splits = load_splits()
+        main_ds = splits['dataset_arrival'] if config.use_arrival_data else splits['dataset']
+        validation_ds = splits['validation_dataset_arrival'] if config.use_arrival_data else splits['validation_dataset']
+        main_recent_ds = splits['dataset_arrival_recent'] if config.use_arrival_data else splits['dataset_recent']
+    # the buildings of the wifi model, {'names': [...], 'scale': [...]}, stored with the checkpoints
+    series_info = splits.get('series')
+
+    # after load_splits, it seeds `random` itself for the validation split
+    if config.seed is not None:
+        random.seed(config.seed)
+        np.random.seed(config.seed)
+        torch.manual_seed(config.seed)
+
+    # create the model
+    model, model_kwargs = build_model(config, maxval=splits['dataset'].maxval,
+                                      num_series=len(series_info['names']) if series_info else 0)
+    # print the model
+    print(model)
+    print("Model parameters:", sum(p.numel() for p in model.parameters()))
+    print("Model trainable parameters:", sum(p.numel() for p in model.parameters() if p.requires_grad))  # Exclude biases
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model = model.to(device)
+    # model is what gets saved and used for rollouts, train_model (maybe compiled) runs the batches
+    sample, sample_series = _split_batch(next(iter(validation_ds.loader(config.batch_size))), device)
+    train_model, use_bf16 = _setup_modes(config, model, device, sample[:, :-1], sample_series)
+    print(f"Training {'compiled' if train_model is not model else 'eager'}, {'bf16 autocast' if use_bf16 else 'fp32'}")
+
+    optimizer = torch.optim.AdamW(model.parameters(), lr=config.learning_rate, weight_decay=config.weight_decay)
+    criterion = torch.nn.MSELoss()
+    #criterion = torch.nn.L1Loss()  # Use L1 loss for robustness against outliers
+
+    start_epoch = 0
+    all_stats = []
+    started = datetime.datetime.now().isoformat()
+    if checkpoint is not None:
+        model.load_state_dict(checkpoint['model_state'])
+        optimizer.load_state_dict(checkpoint['optimizer_state'])
+        set_rng_state(checkpoint['rng'])
+        start_epoch = checkpoint['epoch'] + 1
+        all_stats = checkpoint['stats']
+        started = checkpoint['started']
+        print(f"Resuming {run_dir} at epoch {start_epoch}")
+
+    def save_all_stats():
+        # save all stats to a single file
+        with open(os.path.join(run_dir, "stats.json"), 'w') as f:
+            json.dump(all_stats, f, indent=4)
+
+    def save(path, epoch):
+        save_checkpoint(path, model, model_kwargs, optimizer, epoch=epoch, stats=all_stats,
+                        config=dataclasses.asdict(config), started=started, series=series_info)
+
+    dataloader_validation = validation_ds.loader(batch_size=config.batch_size, shuffle=False)
+    # AI_PROFILE_TORCH: a chrome trace of a few training steps
+    with profiling.torch_trace(f'train_{os.path.basename(run_dir)}') as trace:
+        for epoch in range(start_epoch, config.epochs):
+            if epoch > config.switch_to_recent_at:
+                dataloader_train = main_recent_ds.loader(batch_size=config.recent_batch_size, shuffle=True)
+            else:
+                dataloader_train = main_ds.loader(batch_size=config.batch_size, shuffle=True)
+
+            model.train()
+            total_loss = 0
+            total_loss_validation = 0
+            # the loss parts of objectives with a horizon head, summed over the batches
+            train_parts = {}
+            valid_parts = {}
+            step_train = 0
+            tokens = 0
+            step_times = []
+            if device.type == 'cuda':
+                torch.cuda.reset_peak_memory_stats(device)
+            epoch_start = time.perf_counter()
+            for batch in profiling.iterate('loader_fetch', dataloader_train):
+                step_start = time.perf_counter()
+                batch, series = _split_batch(batch, device)
+                optimizer.zero_grad()
+                in_x = batch[:, :-1]  # (batch_size, seq_length-1)
+
+                # sequence training. it feeds the next-step head's own rollouts, which a horizon-only model doesn't
+                # train and its direct forecasts never see
+                if (config.objective != 'horizon' and random.random() < config.sequence_training_prob
+                        and epoch > config.enable_sequence_training_at):
+                    start_search_at = random.randint(1, in_x.size(1) - 1)
+                    with profiling.stage('sequence_training'):
+                        in_x = sequence_training_inputs(model, in_x, start_search_at, config.rollout_ratio, series)  # Use the search input for training
+
+                with profiling.stage('forward'), _autocast(device, use_bf16):
+                    loss, parts, _ = _losses(config, train_model, in_x, batch, criterion, series)
+                with profiling.stage('backward'):
+                    loss.backward()
+                with profiling.stage('optimizer_step'):
+                    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)  # Gradient clipping
+                    optimizer.step()
+                total_loss += loss.item()  # also syncs with the gpu, so the step time is complete
+                for name, part in parts.items():
+                    train_parts[name] = train_parts.get(name, 0) + part.item()
+                trace.step()
+                step_train += 1
+                tokens += in_x.numel()
+                step_times.append(time.perf_counter() - step_start)
+                if step_train % 10 == 0:
+                    print(f"Epoch {epoch}/{config.epochs}, Step {step_train}, Loss: {loss.item():.4f}")
+            train_seconds = time.perf_counter() - epoch_start
+
+            # Validation
+            model.eval()
+            step_valid = 0
+            for batch in dataloader_validation:
+
+                batch, series = _split_batch(batch, device)
+                with torch.no_grad(), _autocast(device, use_bf16), profiling.stage('validation'):
+                    in_x = batch[:,:-1]
+                    loss, parts, output = _losses(config, train_model, in_x, batch, criterion, series)
+                    target = batch[:, 1:]
+
+                    if step_valid == 0:
+                        print("Input", in_x.shape)
+                        print("Output", output.shape)
+                        # print first batch dimension
+                        fr = 60
+                        to = fr + 20
+                        expected = target[0, fr:to].tolist()
+                        predicted = output[0, fr:to, 0].tolist()
+                        # zip them together
+                        for i, (exp, pred) in enumerate(zip(expected, predicted)):
+                           print(f"Validation t={i+1}: Expected: {exp:.2f}, Predicted: {pred:.2f}")
+
+                    total_loss_validation += loss.item()
+                    for name, part in parts.items():
+                        valid_parts[name] = valid_parts.get(name, 0) + part.item()
+                    step_valid += 1
+
+            # also save stats
+            peak_memory_mb, peak_memory_scope = _peak_memory_mb(device)
+            stats = {
+                'epoch': epoch,
+                'train_loss': total_loss / step_train,
+                'valid_loss': total_loss_validation / step_valid,
+                **({f'train_{name}_loss': total / step_train for name, total in train_parts.items()}
+                   if config.objective != 'next_step' else {}),
+                **({f'valid_{name}_loss': total / step_valid for name, total in valid_parts.items()}
+                   if config.objective != 'next_step' else {}),
+                'date': datetime.datetime.now().isoformat(),
+                'learning_rate': config.learning_rate,
+                'train_seconds': train_seconds,
+                'tokens_per_sec': tokens / train_seconds,
+                **{f'step_ms_p{p}': float(1000 * np.percentile(step_times, p)) for p in (50, 90, 99)},
+                'peak_memory_mb': peak_memory_mb,
+                'peak_memory_scope': peak_memory_scope,
+                'compiled': train_model is not model,
+                'bf16': use_bf16,
+            }
+            all_stats.append(stats)
+            profiling.flush(run=os.path.basename(run_dir), epoch=epoch)
+            save_all_stats()
+            # every epoch, so a pre-empted run loses at most one epoch
+            save(os.path.join(run_dir, 'checkpoint_last.pt'), epoch)
+            if epoch % config.checkpoint_every == 0:
+                save(os.path.join(run_dir, f'checkpoint_epoch_{epoch}.pt'), epoch)
+
+            print(f"Epoch {epoch}/{config.epochs}, Training Loss: {stats['train_loss']:.4f}, Validation Loss: {stats['valid_loss']:.4f}")
+            print(f"  {stats['tokens_per_sec']:.0f} tokens/s, step ms p50/p90/p99 "
+                  f"{stats['step_ms_p50']:.1f}/{stats['step_ms_p90']:.1f}/{stats['step_ms_p99']:.1f}, peak memory "
+                  + (f"{stats['peak_memory_mb']:.0f} MB ({stats['peak_memory_scope']} peak)"
+                     if stats['peak_memory_mb'] is not None else "n/a"))
+
+    # save the final model
+    save(os.path.join(run_dir, 'model_final.pt'), config.epochs - 1)
+    # summarize all stats
+    save_all_stats()
+
+    best = min(all_stats, key=lambda s: s['valid_loss']) if all_stats else None
+    append_run(RUN_REGISTRY, {
+        'run': os.path.basename(run_dir),
+        'started': started,
+        'finished': datetime.datetime.now().isoformat(),
+        'resumed': resume is not None,
+        'config': dataclasses.asdict(config),
+        'epochs': len(all_stats),
+        'final_train_loss': all_stats[-1]['train_loss'] if all_stats else None,
+        'final_valid_loss': all_stats[-1]['valid_loss'] if all_stats else None,
+        'best_valid_loss': best['valid_loss'] if best else None,
+        'best_epoch': best['epoch'] if best else None,
+        'checkpoint': os.path.join(run_dir, 'model_final.pt'),
+    })
+    return all_stats
+
+
+def main(argv=None):
+    overrides, resume = parse_args(argv)
+    base = {}
+    if resume:
+        # continue with the run's own settings unless told otherwise (e.g. --epochs to extend it)
+        base = load_checkpoint(resume)['config']
+    config = TrainConfig(**{**base, **overrides})
+    print("Config:", dataclasses.asdict(config))
+    train(config, resume)
 
 
+if __name__ == '__main__':
+    main(sys.argv[1:])
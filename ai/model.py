@@ -1,5 +1,20 @@
 import torch.nn as nn
 import torch
+import torch.nn.functional as F
+
+from .llama import FusedDecoderBlock, precompute_freqs_cis
+
+
+class KVCache:
+    # per-layer key/value buffers for incremental decoding (see TransformerDecoder.forward_step).
+    # buffers are preallocated to max_len, only the first `length` timesteps are valid.
+    # meant for inference, the in-place writes do not mix with autograd
+    def __init__(self, num_layers, batch_size, num_heads, head_dim, max_len, device=None, dtype=torch.float32):
+        shape = (batch_size, num_heads, max_len, head_dim)
+        self.keys = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(num_layers)]
+        self.values = [torch.zeros(shape, device=device, dtype=dtype) for _ in range(num_layers)]
+        self.max_len = max_len
+        self.length = 0
 
 class DecoderOnlyTransformerLayer(nn.Module):
     def __init__(self, d_model, num_heads, dim_feedforward, dropout_rate=0.1):
@@ -30,35 +45,98 @@ class DecoderOnlyTransformerLayer(nn.Module):
         #tgt = self.norm2(tgt)
         return tgt
 
+    def forward_cached(self, tgt, keys, values, start):
+        # same as forward, but tgt only holds the timesteps starting at position `start` (new_len, batch_size, d_model).
+        # keys/values of the earlier timesteps are read from the cache buffers, the new ones are written into them
+        attn_output = self._cached_self_attn(tgt, keys, values, start)
+        tgt = tgt + self.dropout1(attn_output)
+
+        ff_output = self.linear2(self.relu(self.linear1(tgt)))
+        tgt = tgt + self.dropout2(ff_output)
+        return tgt
+
+    def _cached_self_attn(self, tgt, keys, values, start):
+        # does what self.self_attn does internally (packed in-projection, per-head attention, out-projection),
+        # but lets us keep the projected keys/values around instead of recomputing them for the whole prefix
+        attn = self.self_attn
+        new_len, batch_size, d_model = tgt.size()
+        head_dim = d_model // attn.num_heads
+        end = start + new_len
+        assert end <= keys.size(2), f"KV cache too small: need {end} timesteps, have {keys.size(2)}"
+
+        q, k, v = F.linear(tgt, attn.in_proj_weight, attn.in_proj_bias).chunk(3, dim=-1)
+        # (new_len, batch_size, d_model) -> (batch_size, num_heads, new_len, head_dim)
+        q, k, v = (t.reshape(new_len, batch_size, attn.num_heads, head_dim).permute(1, 2, 0, 3) for t in (q, k, v))
+        keys[:, :, start:end] = k
+        values[:, :, start:end] = v
+
+        # the first new timestep sees the whole cached prefix, every further one sees one more key (causal)
+        mask = None
+        if new_len > 1:
+            mask = torch.ones(new_len, end, dtype=torch.bool, device=tgt.device).tril(diagonal=start)
+        dropout_p = attn.dropout if self.training else 0.0
+        out = F.scaled_dot_product_attention(q, keys[:, :, :end], values[:, :, :end], attn_mask=mask, dropout_p=dropout_p)
+        out = out.permute(2, 0, 1, 3).reshape(new_len, batch_size, d_model)
+        return attn.out_proj(out)
+
 # define a decoder only transformer model
 class TransformerDecoder(torch.nn.Module):
-    def __init__(self, d_model=64, nhead=4, num_layers=2, dropout_rate=0.1, maxval=250, logscale_tricks=True, max_time_dim=216):
+    def __init__(self, d_model=64, nhead=4, num_layers=2, dropout_rate=0.1, maxval=250, logscale_tricks=True, max_time_dim=216,
+                 attention='mha', horizon_head=False, num_series=0):
+        # attention='mha': nn.MultiheadAttention blocks with a learned positional table, sequences up to max_time_dim.
+        # attention='rotary': FusedDecoderBlock (SDPA, rotary embeddings, pre-norm) from llama.py, no positional table,
+        # max_time_dim is only the length the rotary frequencies are precomputed for.
+        # horizon_head: a second output that forecasts every position of the sequence (up to max_time_dim) from each
+        # prefix at once, see forward_horizon. the next-step output is there either way.
+        # num_series > 0: several series (e.g. the buildings of the wifi data) share one model, a learned embedding of
+        # the series is added at every position. the rows of a batch may belong to different series, forward,
+        # forward_horizon and forward_step then take series, (batch_size,) long
         super(TransformerDecoder, self).__init__()
-        
-        self.positional_encoding = nn.Embedding(max_time_dim, d_model)
-        # initialize positional encoding with sinusoidal values
-        position = torch.arange(0, max_time_dim, dtype=torch.long).unsqueeze(1)  # (seq_len, 1)
-        div_term = torch.exp(torch.arange(0, d_model, 2).float() * -(torch.log(torch.tensor(512.0)) / d_model))
-        pe = torch.zeros(max_time_dim, d_model)
-        pe[:, 0::2] = torch.sin(position * div_term)  # even indices
-        pe[:, 1::2] = torch.cos(position * div_term)  # odd indices
-        self.positional_encoding.weight = nn.Parameter(pe, requires_grad=True)
+        assert attention in ('mha', 'rotary'), f"unknown attention {attention}"
+        self.attention = attention
+        self.max_time_dim = max_time_dim
+
+        if attention == 'mha':
+            self.positional_encoding = nn.Embedding(max_time_dim, d_model)
+            # initialize positional encoding with sinusoidal values
+            position = torch.arange(0, max_time_dim, dtype=torch.long).unsqueeze(1)  # (seq_len, 1)
+            div_term = torch.exp(torch.arange(0, d_model, 2).float() * -(torch.log(torch.tensor(512.0)) / d_model))
+            pe = torch.zeros(max_time_dim, d_model)
+            pe[:, 0::2] = torch.sin(position * div_term)  # even indices
+            pe[:, 1::2] = torch.cos(position * div_term)  # odd indices
+            self.positional_encoding.weight = nn.Parameter(pe, requires_grad=True)
 
         decoder_layers = []
         for _ in range(num_layers):
-            decoder_layers.append(
-                DecoderOnlyTransformerLayer(d_model, nhead, d_model * 4, dropout_rate)
-            )
+            if attention == 'rotary':
+                decoder_layers.append(FusedDecoderBlock(d_model, nhead, ff_mult=4, drop_p=dropout_rate))
+            else:
+                decoder_layers.append(
+                    DecoderOnlyTransformerLayer(d_model, nhead, d_model * 4, dropout_rate)
+                )
         self.decoder_blocks = torch.nn.ModuleList(decoder_layers) # Use ModuleList to hold layers
+        if attention == 'rotary':
+            # not part of the state dict, it is rebuilt from the dims
+            self.register_buffer('freqs_cis', precompute_freqs_cis(d_model // nhead, max_time_dim), persistent=False)
 
         self.input_linear = torch.nn.Linear(1, d_model)
         self.input_linear2 = torch.nn.Linear(d_model, d_model)  # Optional second linear layer
         self.linear = torch.nn.Linear(d_model, 1)
+        # position t's hidden state -> values for all positions, only the ones after t are trained and used
+        self.horizon_linear = torch.nn.Linear(d_model, max_time_dim) if horizon_head else None
+        self.num_series = num_series
+        self.series_embedding = nn.Embedding(num_series, d_model) if num_series else None
         self.maxval = maxval
         self.logscale_tricks = logscale_tricks
 
-    def generate_square_subsequent_mask(self, sz):
-        return (torch.triu(torch.ones(sz, sz), diagonal=1) == 1)
+    def generate_square_subsequent_mask(self, sz, device=None):
+        # the mask only depends on the size, so build it once for the largest size seen and slice it.
+        # getattr because models pickled before this existed don't have the attribute
+        mask = getattr(self, '_causal_mask', None)
+        if mask is None or mask.size(0) < sz or mask.device != torch.device(device or 'cpu'):
+            mask = (torch.triu(torch.ones(sz, sz, device=device), diagonal=1) == 1)
+            self._causal_mask = mask
+        return mask[:sz, :sz]
         #mask = (torch.triu(torch.ones(sz, sz)) == 1).transpose(0, 1)
         # `bool` mask for MultiheadAttention where False means mask
         # For TransformerDecoderLayer it's float with -inf, but MultiheadAttention takes bool
@@ -68,10 +146,100 @@ class TransformerDecoder(torch.nn.Module):
         #return mask
 
 
-    def forward(self, x: torch.Tensor):
+    def _attention(self):
+        # models pickled before the rotary variant existed are all mha
+        return getattr(self, 'attention', 'mha')
+
+    def _rotary_freqs(self, start, length):
+        # rotary frequencies for positions start..start+length, extended when a longer sequence comes along
+        end = start + length
+        if end > self.freqs_cis.size(0):
+            self.freqs_cis = precompute_freqs_cis(self.decoder_blocks[0].d_head, 2 * end).to(self.freqs_cis.device)
+        return self.freqs_cis[start:end]
+
+    def has_horizon_head(self):
+        # models pickled before the head existed have none
+        return getattr(self, 'horizon_linear', None) is not None
+
+    def _num_series(self):
+        # models pickled before the series embedding existed model a single series
+        return getattr(self, 'num_series', 0)
+
+    def forward(self, x: torch.Tensor, horizon=False, series=None):
         #print("Input shape:", x.shape)
         # x is of shape (batch_size, seq_length): value
         # x: (batch_size, seq_length)
+        # returns the next-step output (seq_length, batch_size, 1), with horizon=True also the forward_horizon
+        # output of the same pass: (next-step output, horizon output)
+        x = self._hidden(x, series)
+        if horizon:
+            return self._project(x), self._project_horizon(x)
+        return self._project(x)
+
+    def forward_horizon(self, x: torch.Tensor, series=None):
+        # direct multi-horizon forecast, (batch_size, seq_length) -> (seq_length, batch_size, max_time_dim):
+        # out[t, b, p] is the forecast for position p made from positions 0..t, meaningful for p > t.
+        # one pass forecasts the rest of the day for every prefix length, no autoregressive loop
+        return self._project_horizon(self._hidden(x, series))
+
+    def _hidden(self, x: torch.Tensor, series=None):
+        # (batch_size, seq_length) -> last decoder block's output (seq_length, batch_size, d_model)
+        x = self._embed(x, 0, series)
+        seq_len, batch_size, _ = x.size()
+        if self._attention() == 'rotary':
+            freqs_cis = self._rotary_freqs(0, seq_len)
+            for decoder_block in self.decoder_blocks:
+                x = decoder_block(x, freqs_cis)
+            return x
+
+        #print("Input shape2:", x.shape)
+        tgt_mask = self.generate_square_subsequent_mask(seq_len, x.device)
+
+        for decoder_block in self.decoder_blocks:
+            x = decoder_block(x, tgt_mask=tgt_mask)
+        return x
+
+    def init_cache(self, batch_size, max_len=None, device=None):
+        # empty KV cache for forward_step, by default large enough for the whole positional table
+        first_block = self.decoder_blocks[0]
+        if self._attention() == 'rotary':
+            num_heads, head_dim = first_block.n_heads, first_block.d_head
+            default_len = self.max_time_dim
+        else:
+            num_heads = first_block.self_attn.num_heads
+            head_dim = first_block.self_attn.embed_dim // num_heads
+            default_len = self.positional_encoding.num_embeddings
+        return KVCache(
+            num_layers=len(self.decoder_blocks),
+            batch_size=batch_size,
+            num_heads=num_heads,
+            head_dim=head_dim,
+            max_len=max_len or default_len,
+            device=device,
+            dtype=self.input_linear.weight.dtype,
+        )
+
+    def forward_step(self, x: torch.Tensor, cache: KVCache, series=None):
+        # incremental forward: x holds only the timesteps following the ones already in the cache (batch_size, new_len).
+        # returns the outputs for exactly these timesteps, (new_len, batch_size, 1), identical to the
+        # corresponding rows of forward() on the full prefix (python -m ai.model check-cache).
+        # typical use: one call with the known prefix, then one call per generated timestep
+        start = cache.length
+        x = self._embed(x, start, series)
+        if self._attention() == 'rotary':
+            freqs_cis = self._rotary_freqs(start, x.size(0))
+            for decoder_block, keys, values in zip(self.decoder_blocks, cache.keys, cache.values):
+                x = decoder_block.forward_cached(x, keys, values, start, freqs_cis)
+            cache.length = start + x.size(0)
+            return self._project(x)
+        for decoder_block, keys, values in zip(self.decoder_blocks, cache.keys, cache.values):
+            x = decoder_block.forward_cached(x, keys, values, start)
+        cache.length = start + x.size(0)
+        return self._project(x)
+
+    def _embed(self, x: torch.Tensor, start_pos: int, series=None):
+        # (batch_size, seq_length) values -> (seq_length, batch_size, d_model), positions start at start_pos.
+        # series: (batch_size,) series index of every row, required iff the model was built with num_series
         x = x.unsqueeze(-1) # (batch_size, seq_length, 1)
         x = x.permute(1, 0, 2)  # (seq_length, batch_size, 1)
 
@@ -95,19 +263,59 @@ class TransformerDecoder(torch.nn.Module):
         x = self.input_linear(x)  # (seq_length, batch_size, d_model)
         x = torch.relu(x)  # Apply ReLU activation
         x = self.input_linear2(x)
-        seq_len, batch_size, _ = x.size()
-        #print("Input shape2:", x.shape)
-        tgt_mask = self.generate_square_subsequent_mask(seq_len).to(x.device)
-        pos = torch.arange(0, seq_len, dtype=torch.long, device=x.device)
+        if self._num_series():
+            assert series is not None, "this model covers several series, pass the series of every row"
+            x = x + self.series_embedding(series.to(x.device)).unsqueeze(0)  # same for every position of a row
+        if self._attention() == 'rotary':
+            # positions come in through the rotary embeddings inside the attention
+            return x
+        seq_len = x.size(0)
+        pos = torch.arange(start_pos, start_pos + seq_len, dtype=torch.long, device=x.device)
         x = x + self.positional_encoding(pos).unsqueeze(1)  # (seq_length, batch_size, d_model)
+        return x
 
-        for decoder_block in self.decoder_blocks:
-            x = decoder_block(x, tgt_mask=tgt_mask)
-
+    def _project(self, x: torch.Tensor):
         x = self.linear(x)  # (seq_length, batch_size, 1)
-        if self.logscale_tricks:
-            x = torch.expm1(x * torch.log(torch.tensor(self.maxval + 1)))  # scale back to original value range
-        else:
-            x = x * self.maxval
         #x = (self.linear(x) + 1) * 100.0  # scale back to original value range
-        return x
\ No newline at end of file
+        return self._unscale(x)
+
+    def _project_horizon(self, x: torch.Tensor):
+        assert self.has_horizon_head(), "this model was built without horizon_head"
+        return self._unscale(self.horizon_linear(x))  # (seq_length, batch_size, max_time_dim)
+
+    def _unscale(self, x: torch.Tensor):
+        if self.logscale_tricks:
+            return torch.expm1(x * torch.log(torch.tensor(self.maxval + 1)))  # scale back to original value range
+        return x * self.maxval
+
+
+def check_cache(attention, num_series=0, seq_len=40, prefix_len=8, batch_size=3, seed=0):
+    # max relative difference between forward() on the whole sequence and forward_step() fed the first prefix_len
+    # timesteps at once, then one timestep per call. the rotary model starts with a frequency table shorter than the
+    # sequence, so the on-demand extension is covered too
+    torch.manual_seed(seed)
+    model = TransformerDecoder(d_model=32, nhead=2, num_layers=2, num_series=num_series, attention=attention,
+                               max_time_dim=seq_len if attention == 'mha' else seq_len // 4).eval()
+    x = torch.rand(batch_size, seq_len) * 100
+    series = torch.arange(batch_size) % num_series if num_series else None
+    with torch.no_grad():
+        full = model(x, series=series)
+        cache = model.init_cache(batch_size, max_len=seq_len)
+        steps = [model.forward_step(x[:, :prefix_len], cache, series=series)]
+        steps += [model.forward_step(x[:, t:t + 1], cache, series=series) for t in range(prefix_len, seq_len)]
+    return float((torch.cat(steps, dim=0) - full).abs().max() / full.abs().max())
+
+
+if __name__ == '__main__':
+    # python -m ai.model check-cache: the KV-cached incremental decode (rollout, serve, export) against the full
+    # forward, for both attention variants with and without a series embedding
+    import sys
+    if len(sys.argv) > 1 and sys.argv[1] == 'check-cache':
+        failed = False
+        for attention in ('mha', 'rotary'):
+            for num_series in (0, 3):
+                diff = check_cache(attention, num_series)
+                failed |= diff > 1e-4
+                print(f"{attention:<7} num_series={num_series}: max relative difference {diff:.2e}")
+        sys.exit(1 if failed else 0)
+    sys.exit("usage: python -m ai.model check-cache")
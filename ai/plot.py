@@ -1,8 +1,10 @@
 import os
+import sys
 from matplotlib import pyplot as plt
 import pandas as pd
 
-# read from models/stats.json, it looks like this:
+# read the stats.json of a training run (python -m ai.plot ai/models/<run>), by default the old models/stats.json.
+# it looks like this:
 """
 [
     {
@@ -16,7 +18,8 @@ import pandas as pd
 ]
 """
 
-with open(os.path.join(os.path.dirname(__file__), 'models', 'stats.json'), 'r') as f:
+run_dir = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'models')
+with open(os.path.join(run_dir, 'stats.json'), 'r') as f:
     stats = pd.read_json(f)
 
 # plot train_loss and valid_loss over epochs
@@ -0,0 +1,162 @@
+import os
+import json
+import time
+import atexit
+import datetime
+import threading
+import contextlib
+
+# stage timers for the ai pipeline, switched on from the environment so a slow run can be looked at without editing code:
+#
+#   AI_PROFILE=profile.jsonl      per-stage counters (count, total, mean, max), one json line per flush()
+#                                 (every training epoch, end of a backtest, exit)
+#   AI_PROFILE_TORCH=traces/      torch profiler chrome traces of a few training steps, stages show up as labels
+#   AI_PROFILE_SYNC=1             wait for the gpu at stage boundaries, so gpu stages get their real time
+#
+# disabled (the default), stage() hands out one shared null context, timed() returns the function itself and
+# iterate() the iterable itself, so the hooks cost next to nothing. the settings are read once at import
+
+LOG_PATH = os.environ.get('AI_PROFILE') or None
+TRACE_DIR = os.environ.get('AI_PROFILE_TORCH') or None
+SYNC = os.environ.get('AI_PROFILE_SYNC', '') not in ('', '0')
+ENABLED = LOG_PATH is not None or TRACE_DIR is not None
+
+_NULL = contextlib.nullcontext()
+_lock = threading.Lock()
+_counters = {}  # stage -> [count, total seconds, max seconds]
+
+
+def _sync():
+    import torch
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+
+
+def add(name, seconds, count=1):
+    with _lock:
+        counter = _counters.setdefault(name, [0, 0.0, 0.0])
+        counter[0] += count
+        counter[1] += seconds
+        counter[2] = max(counter[2], seconds)
+
+
+class _Stage:
+    __slots__ = ('name', 'start', 'label')
+
+    def __init__(self, name):
+        self.name = name
+        self.label = None
+
+    def __enter__(self):
+        if TRACE_DIR is not None:
+            import torch
+            self.label = torch.profiler.record_function(self.name)
+            self.label.__enter__()
+        if SYNC:
+            _sync()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if SYNC:
+            _sync()
+        add(self.name, time.perf_counter() - self.start)
+        if self.label is not None:
+            self.label.__exit__(*exc)
+        return False
+
+
+def stage(name):
+    # with stage('forward'): ...
+    return _Stage(name) if ENABLED else _NULL
+
+
+def timed(name):
+    # decorator version of stage, a no-op when profiling is off
+    def wrap(fn):
+        if not ENABLED:
+            return fn
+
+        def timed_fn(*args, **kwargs):
+            with _Stage(name):
+                return fn(*args, **kwargs)
+        timed_fn.__name__ = fn.__name__
+        timed_fn.__doc__ = fn.__doc__
+        timed_fn.__wrapped__ = fn
+        return timed_fn
+    return wrap
+
+
+def iterate(name, iterable):
+    # times every next() of the iterable, e.g. the dataloader fetch
+    if not ENABLED:
+        return iterable
+    return _timed_iter(name, iterable)
+
+
+def _timed_iter(name, iterable):
+    it = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(it)
+        except StopIteration:
+            return
+        add(name, time.perf_counter() - start)
+        yield item
+
+
+def snapshot(reset=True):
+    # {stage: {count, total_s, mean_ms, max_ms}}, largest total first
+    with _lock:
+        counters = dict(_counters)
+        if reset:
+            _counters.clear()
+    return {name: {'count': count, 'total_s': total, 'mean_ms': 1000 * total / count if count else 0.0, 'max_ms': 1000 * peak}
+            for name, (count, total, peak) in sorted(counters.items(), key=lambda item: -item[1][1])}
+
+
+def flush(**context):
+    # one json line with the counters since the last flush, plus whatever identifies this part of the run
+    if LOG_PATH is None:
+        return
+    stages = snapshot()
+    if not stages:
+        return
+    record = {'time': datetime.datetime.now().isoformat(), 'pid': os.getpid(), **context, 'stages': stages}
+    with _lock, open(LOG_PATH, 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+
+atexit.register(flush, context='exit')
+
+
+class _NullTrace:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def step(self):
+        pass
+
+
+def torch_trace(name, wait=1, warmup=1, active=5):
+    # torch profiler over a few steps of a loop (call .step() once per iteration), written as a chrome trace
+    # to AI_PROFILE_TORCH/<name>_<pid>.json. without AI_PROFILE_TORCH an object that does nothing
+    if TRACE_DIR is None:
+        return _NullTrace()
+    import torch
+    os.makedirs(TRACE_DIR, exist_ok=True)
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if torch.cuda.is_available():
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+    path = os.path.join(TRACE_DIR, f'{name}_{os.getpid()}.json')
+    return torch.profiler.profile(
+        activities=activities,
+        schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=1),
+        on_trace_ready=lambda profiler: profiler.export_chrome_trace(path),
+        record_shapes=True,
+        profile_memory=True,
+    )
@@ -0,0 +1,108 @@
+import torch
+
+from .model import TransformerDecoder
+from .profiling import stage
+
+
+def rollout(model: TransformerDecoder, prefixes: torch.Tensor, prefix_lengths: torch.Tensor, total_len: int,
+            series=None):
+    # greedy autoregressive decoding of many rows at once.
+    # prefixes: (rows, seq_length) padded batch, row r is known up to (excluding) prefix_lengths[r], the rest is ignored.
+    # series: (rows,) series of every row, for models built with num_series
+    # returns (rows, total_len): each row's known prefix followed by the model's forecast
+    #
+    # all rows share the same timeline (position i is the same time of day in every row), so instead of padding
+    # we run the shortest prefix once and then step all rows together. a row whose prefix is longer than the
+    # current step just feeds its known value instead of the prediction.
+    device = model.input_linear.weight.device
+    rows = prefixes.size(0)
+    prefix_lengths = prefix_lengths.to(device)
+    min_len = int(prefix_lengths.min())
+    assert min_len >= 1, "every row needs at least the day token as prefix"
+
+    positions = torch.arange(total_len, device=device)
+    is_known = positions.unsqueeze(0) < prefix_lengths.unsqueeze(1)  # (rows, total_len)
+
+    out = torch.zeros(rows, total_len, device=device)
+    known = min(prefixes.size(1), total_len)
+    out[:, :known] = prefixes[:, :known].to(device)
+    out = torch.where(is_known, out, torch.zeros_like(out))
+
+    with torch.no_grad():
+        cache = model.init_cache(rows, max_len=total_len, device=device)
+        with stage('decode_prefix'):
+            output = model.forward_step(out[:, :min_len], cache, series)  # (seq_length, rows, 1)
+        for t in range(min_len, total_len):
+            pred = output[-1, :, 0]  # (rows,)
+            out[:, t] = torch.where(is_known[:, t], out[:, t], pred)
+            if t + 1 < total_len:
+                with stage('decode_step'):
+                    output = model.forward_step(out[:, t:t + 1], cache, series)
+    return out
+
+
+def direct_forecast(model: TransformerDecoder, prefixes: torch.Tensor, prefix_lengths: torch.Tensor, total_len: int,
+                    series=None):
+    # same contract as rollout, but from the model's horizon head: one forward pass over the prefixes, each row's
+    # forecast is the head's output at its last known position. needs a model built with horizon_head
+    device = model.input_linear.weight.device
+    rows = prefixes.size(0)
+    prefix_lengths = prefix_lengths.to(device)
+    max_len = int(prefix_lengths.max())
+    assert int(prefix_lengths.min()) >= 1, "every row needs at least the day token as prefix"
+
+    positions = torch.arange(total_len, device=device)
+    is_known = positions.unsqueeze(0) < prefix_lengths.unsqueeze(1)  # (rows, total_len)
+    out = torch.zeros(rows, total_len, device=device)
+    known = min(prefixes.size(1), total_len)
+    out[:, :known] = prefixes[:, :known].to(device)
+    out = torch.where(is_known, out, torch.zeros_like(out))
+
+    with torch.no_grad(), stage('decode_direct'):
+        # causal, so what follows a row's prefix in the padded input doesn't change its output
+        horizon = model.forward_horizon(out[:, :max_len], series)  # (max_len, rows, max_time_dim)
+        pred = horizon[prefix_lengths - 1, torch.arange(rows, device=device)]  # (rows, max_time_dim)
+    assert pred.size(1) >= total_len, f"horizon head covers {pred.size(1)} positions, asked for {total_len}"
+    return torch.where(is_known, out, pred[:, :total_len])
+
+
+def rollout_cutoffs(model: TransformerDecoder, days: torch.Tensor, cutoffs: list[int], total_len: int, max_rows=512,
+                    series=None):
+    # forecast every (day, cutoff) pair: days is (num_days, seq_length) with the full known sequences,
+    # cutoffs are prefix lengths (including the day token), series the (num_days,) series of the days if the model
+    # has several.
+    # returns (num_days, len(cutoffs), total_len)
+    num_days = days.size(0)
+    rows = days.repeat_interleave(len(cutoffs), dim=0)
+    lengths = torch.tensor(cutoffs, dtype=torch.long).repeat(num_days)
+    if series is not None:
+        series = torch.as_tensor(series).repeat_interleave(len(cutoffs))
+
+    # bound the KV cache size, every chunk is still one batched decode
+    out = []
+    for start in range(0, rows.size(0), max_rows):
+        out.append(rollout(model, rows[start:start + max_rows], lengths[start:start + max_rows], total_len,
+                           None if series is None else series[start:start + max_rows]))
+    return torch.cat(out, dim=0).view(num_days, len(cutoffs), total_len)
+
+
+def sequence_training_inputs(model: TransformerDecoder, in_x: torch.Tensor, start: int, rollout_ratio: float,
+                             series=None):
+    # training inputs that contain the model's own predictions from position `start` on (scheduled sampling),
+    # so it learns to continue from its own mistakes. no gradient flows through the generated values.
+    # rollout_ratio is the fraction of these positions fed the prediction instead of the true value:
+    # 1.0 = full autoregressive rollout, exactly what the model sees at inference time (one KV-cached pass);
+    # below that, the predictions come from a single teacher-forced pass and are mixed in at random positions.
+    batch_size, seq_len = in_x.shape
+    if rollout_ratio >= 1.0:
+        lengths = torch.full((batch_size,), start, dtype=torch.long)
+        return rollout(model, in_x, lengths, seq_len, series)
+
+    with torch.no_grad():
+        output = model(in_x, series=series)  # (seq_length, batch_size, 1), output[t] is the prediction for position t + 1
+    predicted = output[:-1, :, 0].permute(1, 0)  # (batch_size, seq_length - 1) for positions 1..
+    positions = torch.arange(1, seq_len, device=in_x.device)
+    use_prediction = (torch.rand(batch_size, seq_len - 1, device=in_x.device) < rollout_ratio) & (positions >= start)
+    mixed = in_x.clone()
+    mixed[:, 1:] = torch.where(use_prediction, predicted, in_x[:, 1:])
+    return mixed
@@ -0,0 +1,394 @@
+import os
+import sys
+import json
+import time
+import queue
+import random
+import hashlib
+import argparse
+import datetime
+import threading
+import collections
+import urllib.request
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import torch
+
+from .data import GYM_GRID, resample_grid, load_grid
+from .backtest import TransformerPredictor, cutoff_slot, HORIZON_BIN_MIN, MAX_HORIZON_BIN
+from .checkpoint import load_model_and_config
+
+# python -m ai.serve --model ai/models/<run>/model_final.pt [--bands ai/models/<run>/backtest_....json] [--port 8765]
+# python -m ai.serve bench [--url http://127.0.0.1:8765] [--concurrency 16] [--requests 500]
+#
+# POST /forecast {"points": [{"created_at": <epoch ms or iso>, "value": 42}, ...], "date": "2025-01-31" (optional)}
+#   -> {"model": ..., "cutoff": <epoch ms>, "interpLine": [PredictedPoint, ...]} for the gym window of that day
+# GET /stats: request and batch latency percentiles, forecast cache counters. GET /health
+
+DEFAULT_PORT = 8765
+
+
+def _local_ns(created_at):
+    # epoch ms (like the node server sends) or an iso string -> naive local time as int64 ns, the csv's time base
+    if isinstance(created_at, (int, float)):
+        moment = datetime.datetime.fromtimestamp(created_at / 1000)
+    else:
+        moment = datetime.datetime.fromisoformat(str(created_at).replace('Z', '+00:00'))
+        if moment.tzinfo is not None:
+            moment = moment.astimezone().replace(tzinfo=None)
+    return int(np.datetime64(moment, 'ns').astype(np.int64))
+
+
+def _epoch_ms(day: datetime.date, offset_ns):
+    return int(datetime.datetime.combine(day, datetime.time()).timestamp() * 1000) + int(offset_ns) // 1_000_000
+
+
+class ForecastRequest:
+    # today's partial curve on the grid. cutoff is the slot of the newest sample, everything after it is forecast
+    def __init__(self, day: datetime.date, prefix, cutoff):
+        self.day = day
+        self.weekday = day.weekday()
+        self.prefix = prefix  # (num_slots,) occupancy
+        self.cutoff = cutoff  # -1 if there is nothing of the gym window yet
+
+    @staticmethod
+    def parse(body):
+        points = body.get('points') or []
+        if not isinstance(points, list):
+            raise ValueError("points must be a list")
+        times = np.array([_local_ns(p['created_at']) for p in points], dtype=np.int64)
+        values = np.array([float(p['value']) for p in points], dtype=np.float64)
+        if 'date' in body:
+            day = datetime.date.fromisoformat(body['date'])
+        elif len(times):
+            day = datetime.date.fromisoformat(str(times.max().astype('datetime64[ns]').astype('datetime64[D]')))
+        else:
+            raise ValueError("need points or a date")
+
+        midnight = int(np.datetime64(day, 'ns').astype(np.int64))
+        in_day = (times >= midnight) & (times < midnight + 86400 * 1_000_000_000)
+        times, values = times[in_day], values[in_day]
+        prefix = np.zeros(GYM_GRID.num_slots)
+        cutoff = -1
+        if len(times):
+            _, occupancy = resample_grid(times, values, GYM_GRID, min_samples=1, verbose=False)
+            if len(occupancy):
+                prefix = occupancy[0]
+                offsets = GYM_GRID.offsets_ns()
+                cutoff = int(np.searchsorted(offsets, times.max() - midnight, side='right')) - 1
+        return ForecastRequest(day, prefix, cutoff)
+
+    def prefix_hash(self):
+        # only what was observed counts, the slots after the cutoff are filler
+        observed = np.ascontiguousarray(self.prefix[:self.cutoff + 1], dtype=np.float32)
+        return hashlib.sha1(observed.tobytes()).hexdigest()
+
+
+class Forecaster:
+    # the model, loaded once, and the conversion of a batch of requests into PredictedPoint lines
+    def __init__(self, model_path, bands_path=None, device=None, max_rows=512, decode='ar'):
+        self.device = device or torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        model, config = load_model_and_config(model_path, map_location=self.device)
+        model = model.to(self.device).eval()
+        # the old pickled models were all trained on arrivals
+        self.predictor = TransformerPredictor(model, config['use_arrival_data'] if config else True, max_rows, decode)
+        with open(model_path, 'rb') as f:
+            self.model_id = hashlib.sha256(f.read()).hexdigest()[:16]
+        self.model_path = os.path.abspath(model_path)
+
+        # conformal residual quantiles per horizon bin from a backtest report, without them the bands collapse
+        self.bands = None
+        if bands_path:
+            with open(bands_path) as f:
+                report = json.load(f)
+            # a --decode compare report holds one report per decode, the bands have to come from the one served
+            if isinstance(report, list):
+                report = next(r for r in report if r.get('decode', 'ar') == decode)
+            residuals = report['residual_quantiles']
+            quantiles = residuals['quantiles']
+            self.bands = np.array(residuals['by_bin'])[:, [quantiles.index(q) for q in (0.25, 0.75, 0.05, 0.95)]]
+
+    def forecast(self, requests):
+        # one batched decode for all requests
+        cutoffs = np.array([max(r.cutoff, -1) for r in requests])
+        prefixes = np.stack([r.prefix for r in requests])
+        out = self.predictor(None, np.array([r.weekday for r in requests]), cutoffs, prefixes, None)['value']
+        return [self._line(r, prefix, forecast) for r, prefix, forecast in zip(requests, prefixes, out)]
+
+    def _line(self, request, prefix, forecast):
+        slots = np.arange(GYM_GRID.num_slots)
+        known = slots <= request.cutoff
+        value = np.where(known, prefix, np.maximum(forecast, 0))
+        lower = upper = lower_wide = upper_wide = value
+        if self.bands is not None:
+            horizon = (slots - request.cutoff) * GYM_GRID.step_minutes
+            offsets = self.bands[np.clip(horizon // HORIZON_BIN_MIN, 0, MAX_HORIZON_BIN)]  # (slots, 4)
+            offsets = np.where(known[:, None], 0, offsets)
+            lower, upper, lower_wide, upper_wide = (np.clip(value + offsets[:, i], 0, None) for i in range(4))
+        times = [_epoch_ms(request.day, offset) for offset in GYM_GRID.offsets_ns()]
+        return [{'created_at': t, 'value': float(v), 'lower': float(lo), 'upper': float(hi),
+                 'lowerWide': float(lo_w), 'upperWide': float(hi_w)}
+                for t, v, lo, hi, lo_w, hi_w in zip(times, value, lower, upper, lower_wide, upper_wide)]
+
+
+class LatencyStats:
+    # the last `window` observations per series, percentiles on demand
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.series = collections.defaultdict(lambda: collections.deque(maxlen=window))
+        self.counters = collections.Counter()
+
+    def add(self, name, value):
+        with self.lock:
+            self.series[name].append(value)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def summary(self):
+        with self.lock:
+            series = {name: np.array(values) for name, values in self.series.items()}
+            out = dict(self.counters)
+        for name, values in series.items():
+            if len(values):
+                out[name] = {'n': len(values), 'mean': float(values.mean()),
+                             **{f'p{p}': float(np.percentile(values, p)) for p in (50, 90, 99)},
+                             'max': float(values.max())}
+        return out
+
+
+class ForecastCache:
+    # LRU of forecast lines (futures, so identical requests in flight share one decode), keyed by model, day,
+    # weekday and the hash of the observed prefix. a newer prefix of the same day replaces the entry of the older one,
+    # a new sample only ever makes the old forecast stale
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.latest = {}  # (model, day) -> (key, cutoff) of its newest prefix
+        self.counters = collections.Counter()
+
+    def get(self, model_id, request: ForecastRequest, compute) -> Future:
+        key = (model_id, request.day, request.weekday, request.cutoff, request.prefix_hash())
+        day_key = (model_id, request.day)
+        with self.lock:
+            future = self.entries.get(key)
+            if future is not None:
+                self.entries.move_to_end(key)
+                self.counters['hits'] += 1
+                return future
+            self.counters['misses'] += 1
+
+            old_key, old_cutoff = self.latest.get(day_key, (None, -2))
+            if request.cutoff >= old_cutoff:
+                if old_key is not None and self.entries.pop(old_key, None) is not None:
+                    self.counters['invalidations'] += 1
+                self.latest[day_key] = (key, request.cutoff)
+
+            future = compute()
+            self.entries[key] = future
+            while len(self.entries) > self.max_entries:
+                evicted, _ = self.entries.popitem(last=False)
+                self.counters['evictions'] += 1
+                if self.latest.get(evicted[:2], (None,))[0] == evicted:
+                    del self.latest[evicted[:2]]
+        # a failed decode must not be served from the cache
+        future.add_done_callback(lambda f: f.exception() is not None and self._drop(key, f))
+        return future
+
+    def _drop(self, key, future):
+        with self.lock:
+            if self.entries.get(key) is future:
+                del self.entries[key]
+
+    def summary(self):
+        with self.lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return {**self.counters, 'size': len(self.entries), 'max_entries': self.max_entries,
+                    'hit_rate': self.counters['hits'] / lookups if lookups else None}
+
+
+class Batcher(threading.Thread):
+    # requests that arrive within max_wait_ms of the first one waiting are decoded together
+    def __init__(self, forecaster: Forecaster, stats: LatencyStats, max_wait_ms=5.0, max_batch=256):
+        super().__init__(daemon=True)
+        self.forecaster = forecaster
+        self.stats = stats
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+
+    def submit(self, request: ForecastRequest) -> Future:
+        future = Future()
+        self.queue.put((request, future))
+        return future
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            start = time.perf_counter()
+            try:
+                lines = self.forecaster.forecast([request for request, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            self.stats.add('decode_ms', 1000 * (time.perf_counter() - start))
+            self.stats.add('batch_size', len(batch))
+            for (_, future), line in zip(batch, lines):
+                future.set_result(line)
+
+
+def make_handler(batcher: Batcher, stats: LatencyStats, cache: ForecastCache = None):
+    forecaster = batcher.forecaster
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status, body):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                summary = {'model': forecaster.model_id, **stats.summary()}
+                if cache is not None:
+                    summary['cache'] = cache.summary()
+                self._send(200, summary)
+            elif self.path == '/health':
+                self._send(200, {'status': 'ok', 'model': forecaster.model_id})
+            else:
+                self._send(404, {'error': 'not found'})
+
+        def do_POST(self):
+            if self.path != '/forecast':
+                self._send(404, {'error': 'not found'})
+                return
+            start = time.perf_counter()
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+                request = ForecastRequest.parse(body)
+            except (ValueError, KeyError, TypeError) as e:
+                stats.count('bad_requests')
+                self._send(400, {'error': str(e)})
+                return
+            try:
+                if cache is not None:
+                    future = cache.get(forecaster.model_id, request, lambda: batcher.submit(request))
+                else:
+                    future = batcher.submit(request)
+                line = future.result()
+            except Exception as e:
+                stats.count('errors')
+                self._send(500, {'error': repr(e)})
+                return
+            stats.count('requests')
+            stats.add('request_ms', 1000 * (time.perf_counter() - start))
+            self._send(200, {
+                'model': forecaster.model_id,
+                'cutoff': line[request.cutoff]['created_at'] if request.cutoff >= 0 else None,
+                'interpLine': line,
+            })
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def serve(args):
+    forecaster = Forecaster(args.model, args.bands, decode=args.decode)
+    stats = LatencyStats()
+    batcher = Batcher(forecaster, stats, args.max_wait_ms, args.max_batch)
+    batcher.start()
+    # warm up, the first decode pays for the allocator and kernel selection
+    forecaster.forecast([ForecastRequest(datetime.date.today(), np.zeros(GYM_GRID.num_slots), cutoff_slot(12))])
+    cache = ForecastCache(args.cache_size) if args.cache_size > 0 else None
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batcher, stats, cache))
+    print(f"Serving {forecaster.model_path} ({forecaster.model_id}) on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+def _bench_bodies(num_requests, seed=0):
+    # stand-in traffic: random cached days, cut at random times of the day, sent as raw samples
+    grid = load_grid()
+    rng = random.Random(seed)
+    offsets = GYM_GRID.offsets_ns()
+    bodies = []
+    for _ in range(num_requests):
+        row = rng.randrange(len(grid))
+        day = datetime.date.fromordinal(int(grid.days[row]))
+        cutoff = rng.randrange(GYM_GRID.num_slots)
+        points = [{'created_at': _epoch_ms(day, offsets[s]), 'value': float(grid.occupancy[row, s])}
+                  for s in range(cutoff + 1)]
+        bodies.append({'date': day.isoformat(), 'points': points})
+    return bodies
+
+
+def bench(args):
+    # with --distinct below --requests the same prefixes come back, like viewers reloading between two samples
+    bodies = _bench_bodies(args.distinct or args.requests, args.seed)
+    bodies = [bodies[i % len(bodies)] for i in range(args.requests)]
+
+    def post(body):
+        start = time.perf_counter()
+        request = urllib.request.Request(args.url + '/forecast', data=json.dumps(body).encode(),
+                                         headers={'Content-Type': 'application/json'})
+        with urllib.request.urlopen(request) as response:
+            json.load(response)
+        return 1000 * (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        latencies = np.array(list(pool.map(post, bodies)))
+    seconds = time.perf_counter() - start
+    print(f"{len(latencies)} requests, concurrency {args.concurrency}: {len(latencies) / seconds:.1f} req/s")
+    print("client latency ms: " + "  ".join(f"p{p}={np.percentile(latencies, p):.1f}" for p in (50, 90, 99)))
+    with urllib.request.urlopen(args.url + '/stats') as response:
+        print("server stats:", json.dumps(json.load(response), indent=4))
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv and argv[0] == 'bench':
+        parser = argparse.ArgumentParser(prog='python -m ai.serve bench', description="Stand-in client for the forecast service")
+        parser.add_argument('--url', default=f'http://127.0.0.1:{DEFAULT_PORT}')
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument('--distinct', type=int, help="number of different requests (default: all different)")
+        parser.add_argument('--seed', type=int, default=0)
+        bench(parser.parse_args(argv[1:]))
+        return
+
+    parser = argparse.ArgumentParser(prog='python -m ai.serve', description="HTTP inference service for the forecaster")
+    parser.add_argument('--model', required=True, help="checkpoint or old pickled model")
+    parser.add_argument('--bands', help="backtest report whose residual quantiles become the bands")
+    parser.add_argument('--decode', choices=['ar', 'direct'], default='ar',
+                        help="autoregressive rollout, or one forward pass through the horizon head (--objective horizon/both)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0, help="how long a request waits for others to batch with")
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--cache-size', type=int, default=1024, help="forecasts kept in the LRU cache, 0 disables it")
+    serve(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    main()
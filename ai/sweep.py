@@ -0,0 +1,165 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import datetime
+import itertools
+import contextlib
+import dataclasses
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import torch
+
+from .data import load_grid
+from .main import TrainConfig, MODELS_DIR, train
+
+# python -m ai.sweep --param d_model=64,128 --param nhead=1,2 --param use_arrival_data=true,false --epochs 30
+# python -m ai.sweep --space space.json --random 20 --workers 8 --threads 2
+# python -m ai.sweep --param compile=true,false --param bf16=true,false --epochs 2 --workers 1  (which modes pay off)
+#
+# every trial is a normal training run (ai/models/sweeps/<sweep>/<trial>/, also in runs.jsonl), the ranked
+# results are streamed to ai/models/sweeps/<sweep>/results.jsonl
+
+
+def _parse_value(field_type, text):
+    if field_type is bool:
+        return text.lower() in ('1', 'true', 'yes', 'on')
+    if field_type is float:
+        return float(text)
+    if field_type is str:
+        return text
+    return int(text)
+
+
+def parse_space(space_path, params):
+    # {field: [values]} from a json file and/or --param field=v1,v2,...
+    fields = {field.name: field.type for field in dataclasses.fields(TrainConfig)}
+    space = {}
+    if space_path:
+        with open(space_path) as f:
+            space.update(json.load(f))
+    for param in params:
+        name, _, values = param.partition('=')
+        space[name] = [_parse_value(fields.get(name), value) for value in values.split(',')]
+    unknown = set(space) - set(fields)
+    if unknown:
+        raise ValueError(f"not TrainConfig fields: {sorted(unknown)}")
+    return space
+
+
+def trials(space, num_random=None, seed=0):
+    # the full grid, or num_random distinct points of it
+    names = sorted(space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*(space[name] for name in names))]
+    if num_random is not None and num_random < len(grid):
+        grid = random.Random(seed).sample(grid, num_random)
+    return grid
+
+
+def _init_worker(num_threads):
+    # every worker gets its own slice of the cores instead of all of them fighting over every core
+    torch.set_num_threads(num_threads)
+    with contextlib.suppress(RuntimeError):
+        torch.set_num_interop_threads(1)
+
+
+def _run_trial(config_dict, run_dir):
+    config = TrainConfig(**config_dict)
+    os.makedirs(run_dir, exist_ok=True)
+    start = time.perf_counter()
+    # the training output of parallel runs would interleave, each trial logs into its own directory
+    with open(os.path.join(run_dir, 'train.log'), 'w') as log, contextlib.redirect_stdout(log):
+        all_stats = train(config)
+    if not all_stats:
+        # epochs=0: nothing to rank, the trial is reported without losses
+        return {'run': config.run_name, 'best_valid_loss': None, 'seconds': time.perf_counter() - start}
+    best = min(all_stats, key=lambda s: s['valid_loss'])
+    return {
+        'run': config.run_name,
+        'best_valid_loss': best['valid_loss'],
+        'best_epoch': best['epoch'],
+        'final_valid_loss': all_stats[-1]['valid_loss'],
+        'final_train_loss': all_stats[-1]['train_loss'],
+        'tokens_per_sec': float(sum(s['tokens_per_sec'] for s in all_stats) / len(all_stats)),
+        'seconds': time.perf_counter() - start,
+    }
+
+
+def print_table(results, params, top=None):
+    ranked = sorted((r for r in results if r['best_valid_loss'] is not None), key=lambda r: r['best_valid_loss'])[:top]
+    if not ranked:
+        return
+    columns = ['rank', 'best_valid_loss', 'best_epoch', 'seconds', 'tokens/s'] + params + ['run']
+    rows = [[str(i + 1), f"{r['best_valid_loss']:.4f}", str(r['best_epoch']), f"{r['seconds']:.0f}", f"{r['tokens_per_sec']:.0f}"]
+            + [str(r['config'][p]) for p in params] + [r['run']] for i, r in enumerate(ranked)]
+    widths = [max(len(c), *(len(row[i]) for row in rows)) for i, c in enumerate(columns)]
+    print('  '.join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print('  '.join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ai.sweep', description="Parallel hyperparameter sweep over TrainConfig")
+    parser.add_argument('--space', help="json file {field: [values]}")
+    parser.add_argument('--param', action='append', default=[], help="field=v1,v2,... (repeatable)")
+    parser.add_argument('--random', type=int, help="sample this many points of the grid instead of running all of it")
+    parser.add_argument('--base', help="json file with the TrainConfig every trial starts from")
+    parser.add_argument('--epochs', type=int, help="shortcut for the base epochs")
+    parser.add_argument('--workers', type=int, help="parallel trials (default: cores / threads)")
+    parser.add_argument('--threads', type=int, default=1, help="torch threads per trial")
+    parser.add_argument('--name', default=datetime.datetime.now().strftime('sweep_%Y%m%d_%H%M%S'))
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+
+    space = parse_space(args.space, args.param)
+    base = {}
+    if args.base:
+        with open(args.base) as f:
+            base.update(json.load(f))
+    if args.epochs is not None:
+        base['epochs'] = args.epochs
+    points = trials(space, args.random, args.seed)
+    workers = args.workers or max(1, (os.cpu_count() or 1) // args.threads)
+    sweep_dir = os.path.join(MODELS_DIR, 'sweeps', args.name)
+    os.makedirs(sweep_dir, exist_ok=True)
+
+    # build / update the preprocessed cache once, so the workers don't all rebuild it. each worker still loads its
+    # own copy of the data (load_splits copies the grid into its datasets)
+    load_grid()
+
+    print(f"Sweep {args.name}: {len(points)} trials, {workers} workers x {args.threads} threads")
+    results = []
+    params = sorted(space)
+    # spawn: forking a process that already initialized torch's thread pools can hang
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(args.threads,)) as pool:
+        futures = {}
+        for i, point in enumerate(points):
+            run_name = os.path.join('sweeps', args.name, f'trial_{i:03d}')
+            config = {**base, **point, 'run_name': run_name}
+            futures[pool.submit(_run_trial, config, os.path.join(MODELS_DIR, run_name))] = config
+        for future in as_completed(futures):
+            config = futures[future]
+            try:
+                result = {**future.result(), 'config': config}
+            except Exception as e:
+                print(f"{config['run_name']} failed: {e!r}")
+                continue
+            results.append(result)
+            with open(os.path.join(sweep_dir, 'results.jsonl'), 'a') as f:
+                f.write(json.dumps(result) + '\n')
+            if result['best_valid_loss'] is None:
+                print(f"\n[{len(results)}/{len(points)}] {result['run']}: ran no epochs")
+                continue
+            print(f"\n[{len(results)}/{len(points)}] {result['run']}: best valid loss {result['best_valid_loss']:.4f}")
+            print_table(results, params, top=10)
+
+    print("\nFinal ranking:")
+    print_table(results, params)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import numpy as np
+import torch
+
+from .data import FULL_DAY_GRID, load_series_grid, load_wifi_splits
+from .model import TransformerDecoder
+from .rollout import rollout, direct_forecast
+from .checkpoint import load_checkpoint
+from .backtest import CUTOFF_HOURS, cutoff_slot
+from . import profiling
+
+# python -m ai.wifi --model ai/models/<run>/model_final.pt [--days all] [--decode direct] [--out report.json]
+#
+# as-of evaluation of a multi-series model (python -m ai.main --data wifi): every building day, cut off at every
+# cutoff hour, is forecast in one batched decode with the building as series, and scored on the slots after the
+# cutoff. the prefix is the day's grid up to the cutoff; the grid interpolates between the 10 minute buckets, so a
+# slot right before the cutoff may have seen the bucket after it when one is missing. "last week" is the same
+# building's day a week earlier as the forecast, the baseline to beat
+
+DAY_MULTIPLIER = 20  # the day token, like DayGridDataset for non-arrival data
+
+
+class WifiPredictor:
+    # the multi-series TransformerDecoder over all (building, day, cutoff) rows as one batch, in device counts
+    def __init__(self, model: TransformerDecoder, series_info, max_rows=2048, decode='ar'):
+        if decode not in ('ar', 'direct'):
+            raise ValueError(f"unknown decode {decode}")
+        if decode == 'direct' and not model.has_horizon_head():
+            raise ValueError("decode='direct' needs a model trained with a horizon head")
+        self.model = model
+        self.names = list(series_info['names'])
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.scale = np.asarray(series_info['scale'], dtype=np.float64)
+        self.max_rows = max_rows
+        self.decode = direct_forecast if decode == 'direct' else rollout
+        self.name = 'wifi_transformer_direct' if decode == 'direct' else 'wifi_transformer'
+
+    def series_of(self, names):
+        # model series of every name, -1 for buildings the model has not seen
+        return np.array([self.index.get(name, -1) for name in names], dtype=np.int64)
+
+    def __call__(self, series, weekday, cutoff_slots, prefixes):
+        # series: (rows,) from series_of, prefixes: (rows, num_slots) device counts known up to and including
+        # cutoff_slots. returns (rows, num_slots) device counts
+        scale = self.scale[series][:, None] / 100.0
+        x = torch.empty((len(series), prefixes.shape[1] + 1), dtype=torch.float32)
+        x[:, 0] = torch.as_tensor(weekday, dtype=torch.float32) * DAY_MULTIPLIER
+        x[:, 1:] = torch.from_numpy(np.asarray(prefixes / scale, dtype=np.float32))
+        lengths = torch.as_tensor(cutoff_slots, dtype=torch.long) + 2  # day token + slots 0..cutoff
+        series = torch.as_tensor(series, dtype=torch.long)
+
+        out = []
+        for start in range(0, len(x), self.max_rows):
+            rows = slice(start, start + self.max_rows)
+            out.append(self.decode(self.model, x[rows], lengths[rows], x.size(1), series[rows])[:, 1:])
+        return torch.cat(out, dim=0).cpu().numpy().astype(np.float64) * scale
+
+
+def load_wifi_model(path, map_location=None):
+    # (model, {'names': [...], 'scale': [...]}) of a checkpoint trained with --data wifi
+    checkpoint = load_checkpoint(path, map_location=map_location or 'cpu')
+    if not checkpoint.get('series'):
+        raise ValueError(f"{path} is not a multi-series model, train it with --data wifi")
+    model = TransformerDecoder(**checkpoint['model_kwargs'])
+    model.load_state_dict(checkpoint['model_state'])
+    return model, checkpoint['series']
+
+
+def evaluate(predictor, grid, rows, cutoff_hours):
+    # rows: positions in grid to forecast, each at every cutoff
+    series = predictor.series_of(grid.names)[np.asarray(grid.series)[rows]]
+    rows = rows[series >= 0]
+    series = series[series >= 0]
+    values = np.asarray(grid.values, dtype=np.float64)[rows]
+    cutoff_slots = np.array([cutoff_slot(hour, FULL_DAY_GRID) for hour in cutoff_hours])
+
+    # every (row, cutoff) pair, rows major
+    num_cutoffs = len(cutoff_hours)
+    flat_slots = np.tile(cutoff_slots, len(rows))
+    slots = np.arange(FULL_DAY_GRID.num_slots)
+    prefixes = np.where(slots[None, :] <= flat_slots[:, None], np.repeat(values, num_cutoffs, axis=0), 0.0)
+    start = time.perf_counter()
+    forecast = predictor(np.repeat(series, num_cutoffs), np.repeat(np.asarray(grid.weekday)[rows], num_cutoffs),
+                         flat_slots, prefixes)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+    forecast = forecast.reshape(len(rows), num_cutoffs, -1)
+
+    # the same building a week earlier, where the grid has that day
+    days = np.asarray(grid.days, dtype=np.int64)
+    grid_series = np.asarray(grid.series, dtype=np.int64)
+    key = grid_series * 10_000_000 + days
+    order = np.argsort(key)
+    week_key = grid_series[rows] * 10_000_000 + days[rows] - 7
+    pos = np.minimum(np.searchsorted(key[order], week_key), len(key) - 1)
+    has_week = key[order][pos] == week_key
+    last_week = np.asarray(grid.values, dtype=np.float64)[order[pos]]
+
+    scored = slots[None, None, :] > cutoff_slots[None, :, None]  # (1, cutoffs, slots)
+    abs_err = np.abs(forecast - values[:, None, :])
+    scale = predictor.scale[series][:, None, None]
+    mask = np.broadcast_to(scored, abs_err.shape)
+    week_mask = mask & has_week[:, None, None]
+    week_err = np.abs(last_week - values)[:, None, :]
+
+    per_building = []
+    for i in np.unique(series):
+        in_b = series == i
+        per_building.append({
+            'building': predictor.names[i],
+            'days': int(in_b.sum()),
+            'scale': float(predictor.scale[i]),
+            'mae': float(abs_err[in_b][mask[in_b]].mean()),
+            'mae_pct': float((100 * abs_err / scale)[in_b][mask[in_b]].mean()),
+        })
+    num_forecasts = len(rows) * num_cutoffs
+    return {
+        'predictor': predictor.name,
+        'created': datetime.datetime.now().isoformat(),
+        'num_buildings': len(per_building),
+        'num_building_days': int(len(rows)),
+        'cutoff_hours': list(cutoff_hours),
+        'num_forecasts': num_forecasts,
+        'seconds': seconds,
+        'ms_per_forecast': 1000 * seconds / max(num_forecasts, 1),
+        'mae': float(abs_err[mask].mean()) if len(rows) else None,
+        # percent of the building's own level, so small and large buildings count the same
+        'mae_pct': float((100 * abs_err / scale)[mask].mean()) if len(rows) else None,
+        'last_week_mae': float(np.broadcast_to(week_err, abs_err.shape)[week_mask].mean()) if week_mask.any() else None,
+        'model_mae_on_last_week_points': float(abs_err[week_mask].mean()) if week_mask.any() else None,
+        'mae_by_cutoff': {str(hour): float(abs_err[:, j][mask[:, j]].mean()) for j, hour in enumerate(cutoff_hours)},
+        'buildings': sorted(per_building, key=lambda b: -b['mae_pct']),
+    }
+
+
+def print_report(report, top=10):
+    print(f"\n{report['predictor']}: {report['num_buildings']} buildings, {report['num_building_days']} building days, "
+          f"{report['num_forecasts']} forecasts in {report['seconds']:.2f}s ({report['ms_per_forecast']:.3f} ms/forecast)")
+    print(f"  MAE {report['mae']:.2f} devices, {report['mae_pct']:.1f}% of the building's level")
+    if report['last_week_mae'] is not None:
+        print(f"  where last week exists: model MAE {report['model_mae_on_last_week_points']:.2f}, "
+              f"last week MAE {report['last_week_mae']:.2f}")
+    for hour, mae in report['mae_by_cutoff'].items():
+        print(f"  cutoff {hour}:00: MAE={mae:.2f}")
+    print("  worst buildings:")
+    for b in report['buildings'][:top]:
+        print(f"    {b['building']}: MAE={b['mae']:.2f} ({b['mae_pct']:.1f}%), level {b['scale']:.0f}, {b['days']} days")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m ai.wifi', description="As-of evaluation of the per-building wifi model")
+    parser.add_argument('--model', required=True, help="checkpoint of a --data wifi run")
+    parser.add_argument('--days', choices=['validation', 'all'], default='validation',
+                        help="the days held out in training (default), or all of them")
+    parser.add_argument('--cutoffs', default=','.join(map(str, CUTOFF_HOURS)), help="cutoff hours, comma separated")
+    parser.add_argument('--decode', choices=['ar', 'direct'], default='ar',
+                        help="autoregressive rollout, or the horizon head (--objective horizon/both)")
+    parser.add_argument('--out', help="json report (default: wifi_<time>.json next to the model)")
+    args = parser.parse_args(argv)
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    model, series_info = load_wifi_model(args.model, map_location=device)
+    model = model.to(device).eval()
+    predictor = WifiPredictor(model, series_info, decode=args.decode)
+
+    grid = load_series_grid()
+    rows = np.arange(len(grid))
+    if args.days == 'validation':
+        held_out = [day.toordinal() for day in load_wifi_splits()['validation_days']]
+        rows = rows[np.isin(grid.days, held_out)]
+    report = evaluate(predictor, grid, rows, [int(h) for h in args.cutoffs.split(',')])
+    profiling.flush(wifi=predictor.name, days=args.days)
+    report['model'] = os.path.abspath(args.model)
+    report['device'] = str(device)
+    report['days'] = args.days
+    print_report(report)
+
+    out = args.out or os.path.join(os.path.dirname(os.path.abspath(args.model)),
+                                   datetime.datetime.now().strftime('wifi_%Y%m%d_%H%M%S.json'))
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=4)
+    print(f"Report written to {out}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
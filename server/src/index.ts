@@ -232,13 +232,23 @@ const limiterPost = rateLimit({
 if (!process.env.WIFIAP_TOKEN) {
     console.error("WIFIAP_TOKEN not set!");
 }
-app.post("/api/v1/wifiap", limiterPost, express.json({ limit: "500kb" }), async (req, res) => {
+// The wifiap client uploads in chunks (each under the 500kb limit, which applies after gzip inflation),
+// so it needs more requests per window than the other uploaders.
+const limiterWifiap = rateLimit({
+    windowMs: 5 * 60 * 1000, // 60 req / 5 minute
+    max: 60,
+    standardHeaders: true,
+    legacyHeaders: false,
+});
+app.post("/api/v1/wifiap", limiterWifiap, express.json({ limit: "500kb" }), async (req, res) => {
     const data = req.body;
     if (!data || !data.data || !data.version || !data.header) {
         res.status(400).send('{error: true, msg: "Invalid body"}');
         return;
     }
-    if (data.version !== 1) {
+    // version 2 is version 1 with the static AP metadata (location, building, organisation) left null
+    // for APs whose metadata the client already uploaded unchanged
+    if (data.version !== 1 && data.version !== 2) {
         res.status(400).send('{error: true, msg: "Invalid version"}');
         return;
     }
@@ -255,6 +265,13 @@ app.post("/api/v1/wifiap", limiterPost, express.json({ limit: "500kb" }), async
         return;
     }
 
+    // batches the client replays from its spool carry their scrape time, store them under it rather
+    // than the time they arrived (never in the future)
+    const insertTime =
+        typeof data.scraped_at === "number" && data.scraped_at <= Date.now()
+            ? new Date(data.scraped_at)
+            : new Date();
+
     let conn;
     try {
         let keys = data.header;
@@ -267,12 +284,16 @@ app.post("/api/v1/wifiap", limiterPost, express.json({ limit: "500kb" }), async
                 for (let i = 0; i < keys.length; i++) {
                     row[keys[i]] = rowWithoutKeys[i];
                 }
-                // insert into wifi_data_apnames
-                await conn.query(
-                    `INSERT INTO wifi_data_apnames (apname, location, building, organisation) VALUES (?, ?, ?, ?)
-                    ON DUPLICATE KEY UPDATE apname=apname`,
-                    [row["Name"], row["Cover / Ort"], row["Gebäude"], row["Organisation"]],
-                );
+                // insert into wifi_data_apnames, unless the metadata was left out as unchanged
+                const hasMetadata =
+                    row["Cover / Ort"] != null || row["Gebäude"] != null || row["Organisation"] != null;
+                if (data.version === 1 || hasMetadata) {
+                    await conn.query(
+                        `INSERT INTO wifi_data_apnames (apname, location, building, organisation) VALUES (?, ?, ?, ?)
+                        ON DUPLICATE KEY UPDATE apname=apname`,
+                        [row["Name"], row["Cover / Ort"], row["Gebäude"], row["Organisation"]],
+                    );
+                }
 
                 // check if the numbers are parseable ints
                 if (
@@ -282,9 +303,10 @@ app.post("/api/v1/wifiap", limiterPost, express.json({ limit: "500kb" }), async
                     console.error("Invalid data for wifiap", row);
                 } else {
                     await conn.query(
-                        `INSERT INTO wifi_data (apname, users_2_4_ghz, users_5_ghz, online, last_online) VALUES (?, ?, ?, ?, ?)
+                        `INSERT INTO wifi_data (insert_time, apname, users_2_4_ghz, users_5_ghz, online, last_online) VALUES (?, ?, ?, ?, ?, ?)
                         ON DUPLICATE KEY UPDATE apname=apname`,
                         [
+                            insertTime,
                             row["Name"],
                             row["Nutzer 2.4 GHz"],
                             row["Nutzer 5 GHz"],
@@ -300,8 +322,28 @@ app.post("/api/v1/wifiap", limiterPost, express.json({ limit: "500kb" }), async
                 }
                 // insert into wifi_data
             }
+            // which scraper shard and cycle this chunk came from, to spot gaps per shard
+            const intOrNull = (value: unknown) => (Number.isInteger(value) ? value : null);
+            await conn.query(
+                `INSERT INTO wifi_data_uploads
+                    (uploader, shard, shard_count, cycle, chunk, chunks, scraped_at, num_rows, num_added)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)`,
+                [
+                    req.ip ?? "",
+                    intOrNull(data.shard),
+                    intOrNull(data.shard_count),
+                    intOrNull(data.cycle),
+                    intOrNull(data.chunk),
+                    intOrNull(data.chunks),
+                    insertTime,
+                    data.data.length,
+                    numAdded,
+                ],
+            );
             await conn.commit();
-            console.log(`Added ${numAdded} wifi AP entries from uploader ${req.ip}`);
+            const chunk = data.chunks ? ` (chunk ${data.chunk + 1}/${data.chunks})` : "";
+            const shard = data.shard_count ? ` shard ${data.shard}/${data.shard_count}` : "";
+            console.log(`Added ${numAdded} wifi AP entries from uploader ${req.ip}${shard}${chunk}`);
         } catch (err) {
             await conn.rollback();
             console.error(err);
@@ -1112,6 +1154,26 @@ const database_init = async () => {
         );
         await conn.query("CREATE INDEX IF NOT EXISTS idx_apname ON wifi_data_apnames (apname)");
 
+        // one row per accepted wifiap upload chunk
+        await conn.query(
+            `CREATE TABLE IF NOT EXISTS wifi_data_uploads (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                insert_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                uploader VARCHAR(64) NOT NULL,
+                shard SMALLINT NULL,
+                shard_count SMALLINT NULL,
+                cycle BIGINT NULL,
+                chunk SMALLINT NULL,
+                chunks SMALLINT NULL,
+                scraped_at TIMESTAMP NULL,
+                num_rows INT NOT NULL,
+                num_added INT NOT NULL
+            )`,
+        );
+        await conn.query(
+            "CREATE INDEX IF NOT EXISTS idx_uploads_cycle ON wifi_data_uploads (cycle, shard)",
+        );
+
         await conn.query(
             `CREATE TABLE IF NOT EXISTS wifi_data_aplocations (
                 id INT AUTO_INCREMENT PRIMARY KEY,
@@ -1,3 +1,5 @@
 #!/bin/bash
 
+# cron does not pass on the container environment
+export WIFIAP_DATA_DIR="${WIFIAP_DATA_DIR:-/data}"
 /usr/local/bin/python /app/src/main.py
\ No newline at end of file
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import argparse
+import glob
+import os
+import statistics
+import sys
+import time
+
+from parse import BACKENDS
+
+# python src/bench_parse.py PAGES_DIR [--repeats 20]
+#
+# runs both parser backends over pages saved with main.py --save-pages, checks that they give identical
+# rows for every page and reports the median parse time per page and backend and the speedup of lxml.
+# exits non-zero if any page differs
+
+
+def time_parse(parse, html, repeats):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        parse(html)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="compare the bs4 and lxml parser backends on saved pages")
+    parser.add_argument("pages_dir")
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args(argv)
+
+    paths = sorted(glob.glob(os.path.join(args.pages_dir, "*.html")))
+    if not paths:
+        print(f"No .html pages in {args.pages_dir}")
+        return 1
+
+    mismatches = 0
+    totals = {name: 0.0 for name in BACKENDS}
+    print(f"{'page':<34}{'rows':>6}{'bs4 ms':>10}{'lxml ms':>10}{'speedup':>9}")
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            html = f.read()
+        outputs = {name: parse(html) for name, parse in BACKENDS.items()}
+        if outputs["lxml"] != outputs["bs4"]:
+            mismatches += 1
+            print(f"MISMATCH in {path}")
+        times = {name: time_parse(parse, html, args.repeats) for name, parse in BACKENDS.items()}
+        for name, seconds in times.items():
+            totals[name] += seconds
+        print(f"{os.path.basename(path):<34}{len(outputs['bs4']):>6}{1000 * times['bs4']:>10.2f}"
+              f"{1000 * times['lxml']:>10.2f}{times['bs4'] / times['lxml']:>8.1f}x")
+
+    print(f"{'total':<34}{'':>6}{1000 * totals['bs4']:>10.2f}{1000 * totals['lxml']:>10.2f}"
+          f"{totals['bs4'] / totals['lxml']:>8.1f}x")
+    print(f"{len(paths)} pages, {mismatches} with different output")
+    return 1 if mismatches else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
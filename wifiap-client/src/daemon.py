@@ -0,0 +1,70 @@
+import signal
+import time
+
+# the long running mode: one process that keeps its session, parser and thread pool warm and runs a scrape
+# cycle at every multiple of the interval on the wall clock (:00, :10, ... for 600s, like the cron job).
+# the slots are computed from the clock, not by adding up sleeps, so a slow cycle doesn't shift the ones
+# after it; slots that were missed entirely (a cycle longer than the interval, a suspended machine) are
+# skipped, not run back to back. between cycles the spool is flushed whenever the flusher's backoff allows.
+# SIGTERM / SIGINT finish the current step and exit, whatever is not uploaded yet stays in the spool
+
+
+def slot_start(now, interval):
+    # start of the slot that `now` falls into
+    return now - now % interval
+
+
+class Daemon:
+    def __init__(self, run_cycle, flusher, interval=600):
+        # run_cycle(cycle) scrapes and spools one cycle, cycle being the slot start in unix seconds
+        self.run_cycle = run_cycle
+        self.flusher = flusher
+        self.interval = interval
+        self.stopping = False
+
+    def stop(self, *_):
+        print("Stopping after the current step")
+        self.stopping = True
+
+    def sleep_until(self, wall_time):
+        # short steps, so a signal is acted on quickly
+        while not self.stopping:
+            left = wall_time - time.time()
+            if left <= 0:
+                return
+            time.sleep(min(left, 1.0))
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        # the first cycle runs right away, in the slot we start in
+        next_slot = slot_start(time.time(), self.interval)
+        print(f"Running every {self.interval}s")
+        while not self.stopping:
+            # new batches, and whatever an earlier run left in the spool
+            pending = bool(self.flusher.spool.pending())
+            if pending and self.flusher.due():
+                pending = not self.flusher.flush()
+            # wake up for the next slot, or earlier when a retry comes due
+            wake = next_slot
+            if pending:
+                wake = min(wake, time.time() + max(0.0, self.flusher.retry_at - time.monotonic()))
+            self.sleep_until(wake)
+            if self.stopping:
+                break
+            now = time.time()
+            if now < next_slot:
+                continue
+
+            current = slot_start(now, self.interval)
+            if current > next_slot:
+                print(f"Skipped {int((current - next_slot) // self.interval)} missed cycles")
+            started = time.monotonic()
+            try:
+                self.run_cycle(int(current))
+            except Exception as err:
+                # a broken cycle must not end the daemon, the next slot tries again
+                print(f"Cycle {int(current)} failed: {err!r}")
+            print(f"Cycle {int(current)} took {time.monotonic() - started:.1f}s")
+            next_slot = current + self.interval
@@ -1,134 +1,168 @@
 #!/usr/bin/env python3
 
-import requests
-from bs4 import BeautifulSoup
-import json
-from dotenv import load_dotenv
+import argparse
+import glob
 import os
+import re
+import sys
+import time
 
-load_dotenv()
-
-server_url = os.getenv("SERVER_URL")
-assert server_url, "SERVER_URL must be set in .env"
-
-
-def grab_data(url):
-    # Fetch the page content
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-    }
-    response = requests.get(url, headers=headers)
-    response.raise_for_status()
-
-    # Parse the HTML content
-    soup = BeautifulSoup(response.text, "html.parser")
-
-    # Locate the table
-    table = soup.find("table", class_="table-sortable")
-
-    # Extract table rows
-    rows = table.find_all("tr")
-
-    keypath = "#breadcrumbs > nav > div > div > ol > li:nth-child(3) > a"
-    valuepath = "#breadcrumbs > nav > div > div > ol > li:nth-child(4) > div"
-    key = soup.select_one(keypath).get_text(strip=True)
-    value = soup.select_one(valuepath).get_text(strip=True)
-    key = key.replace("Organisationen", "Organisation")
+from dotenv import load_dotenv
 
+from daemon import Daemon, slot_start
+from scrape import DEFAULT_BASE_URL, Scraper
+from spool import Flusher, Spool
+from targets import load_targets, parse_shard, shard_targets
+from upload import UploadState
+
+# python src/main.py [--workers 4] [--rate 2] [--base-url URL] [--parser auto|lxml|bs4]
+#                       [--payload-version 1|2] [--full] [--no-gzip] [--save-pages DIR] [--dry-run]
+#                       [--daemon [--interval 600]] [--targets targets.json] [--shard 0/1]
+#
+# scrapes the organization and building pages from targets.json (this shard's part of them, see
+# src/targets.py) concurrently over one keep-alive session, writes the combined rows to the spool in
+# WIFIAP_DATA_DIR and uploads everything spooled to SERVER_URL, oldest first, gzipped and in chunks
+# (see src/upload.py for the payload versions, src/spool.py for the spool).
+# without --daemon that is one cycle, run by cron; with --daemon the process stays up and runs a cycle
+# every --interval seconds on the clock (src/daemon.py), retrying failed uploads with backoff in between.
+# --rate is the request limit per host (requests/s) that replaces the old one second sleep after every page.
+# a page that fails is reported and left out, the rest is still uploaded.
+# to try it locally, save the pages once with --save-pages and serve them with src/stub_server.py:
+#   python src/main.py --save-pages pages --dry-run
+#   python src/stub_server.py pages --port 8800 &
+#   python src/main.py --base-url http://localhost:8800/mops-admin/coverage --dry-run
+
+
+def combine(all_data):
+    # combine all data
+    header = list(all_data[0].keys())
+    seen_aps = set()
     table_data = []
-    header = []
-    for row in rows:
-        cells = row.find_all("td")
-        if cells:
-            assert len(header) > 0, "Header must be defined before data"
-            data = [cell.get_text(strip=True) for cell in cells]
-            data = data + [value]
-
-            if len(data) != len(header):
-                print(
-                    f"Row {data} has different number of columns than header {header}"
-                )
-                continue
-            if data[0] == "Gesamt":
-                break
-            idx_for_online = header.index("Online")
-            # online col has an <i> tag with class "fa fa-check"
-            data[idx_for_online] = (
-                "fa-check" in cells[idx_for_online].find("i")["class"]
+    for data in all_data:
+        if data["Name"] not in seen_aps:
+            vals = []
+            assert len(data) == len(header) and all(key in header for key in data), (
+                f"Data {data} does not match header {header}"
             )
-
-            data = dict(zip(header, data))
-
-            table_data.append(data)
-        else:
-            header = row.find_all("th")
-            if header:
-                header = [cell.get_text(strip=True) for cell in header]
-                assert key not in header
-                header = header + [key]
-                print(header)
-
-    import time
-
-    time.sleep(1)
-    return table_data
-
-
-orgs = [
-    "ORG-42NHW",  # itcenter
-    "ORG-46EVW",  # bib
-    "ORG-59BSY",  # hsz
-    "ORG-87MDR",  # fsmpi
-]
-buildings = [
-    "1960",  # academica
-    "2356",  # as55 e12
-    "1385",  # carl
-    "1580",  # semi90
-]
-
-# todo error handling
-all_data = []
-for org in orgs:
-    url = (
-        f"https://noc-portal.itc.rwth-aachen.de/mops-admin/coverage/organizations/{org}"
-    )
-    all_data.extend(grab_data(url))
-
-for building in buildings:
-    url = f"https://noc-portal.itc.rwth-aachen.de/mops-admin/coverage/buildings/{building}"
-    all_data.extend(grab_data(url))
-
-# combine all data
-header = list(all_data[0].keys())
-seen_aps = set()
-table_data = []
-for data in all_data:
-    if data["Name"] not in seen_aps:
-        vals = []
-        assert len(data) == len(header) and all(key in header for key in data), (
-            f"Data {data} does not match header {header}"
-        )
-        for key in header:
-            vals.append(data[key])
-        table_data.append(vals)
-        seen_aps.add(data["Name"])
-
-send_data = {
-    "version": 1,
-    "header": header,
-    "data": table_data,
-}
-
-print(f"Seen APs: {len(seen_aps)}")
-# print(send_data)
-json_data = json.dumps(send_data)
-
-headers = {"Content-Type": "application/json"}
-response = requests.post(server_url, data=json_data, headers=headers)
-
-print(f"Status code: {response.status_code}")
-print(f"Response: {response.text}")
-# dump the response on error
-if response.status_code != 200:
-    print(f"Response: {response}")
+            for key in header:
+                vals.append(data[key])
+            table_data.append(vals)
+            seen_aps.add(data["Name"])
+    return header, table_data
+
+
+def stale_spool_dirs(base_dir, shard):
+    # spool directories of other shard layouts under base_dir (the plain "spool" of a single instance, or
+    # "shard-i-of-m/spool" with another m). nothing writes to them any more, their batches would never be sent.
+    # the other shards of our own layout are live instances and not included
+    index, count = shard
+    candidates = [os.path.join(base_dir, "spool")] + glob.glob(os.path.join(base_dir, "shard-*-of-*", "spool"))
+    stale = []
+    for path in candidates:
+        match = re.fullmatch(r"shard-(\d+)-of-(\d+)", os.path.basename(os.path.dirname(path)))
+        layout_count = int(match.group(2)) if match else 1
+        if layout_count != count and os.path.isdir(path):
+            stale.append(path)
+    return stale
+
+
+def run_cycle(scraper, spool, cycle, targets_path, shard):
+    # scrape one cycle of this shard's targets into the spool, returns whether every page worked.
+    # the targets are read every cycle, so a running daemon picks up changes to the file
+    index, count = shard
+    targets = shard_targets(load_targets(targets_path), index, count)
+    if not targets:
+        print(f"Shard {index}/{count} has no targets")
+        return False
+    all_data, failures = scraper.scrape(targets)
+    if not all_data:
+        print("No data scraped, nothing to spool")
+        return False
+
+    header, table_data = combine(all_data)
+    print(f"Shard {index}/{count}: {len(targets)} pages, seen APs: {len(table_data)}, failed pages: {len(failures)}")
+    if spool is not None:
+        spool.append({
+            "cycle": cycle,
+            "shard": index,
+            "shard_count": count,
+            "scraped_at": int(time.time() * 1000),
+            "header": header,
+            "data": table_data,
+        })
+    return not failures
+
+
+def main(argv=None):
+    load_dotenv()
+    shard = os.getenv("WIFIAP_SHARD") or f"{os.getenv('SHARD_INDEX', '0')}/{os.getenv('SHARD_COUNT', '1')}"
+    parser = argparse.ArgumentParser(description="scrape the NOC coverage pages and upload them")
+    parser.add_argument("--targets", default=None, help="targets file, default WIFIAP_TARGETS or targets.json")
+    parser.add_argument("--shard", type=parse_shard, default=parse_shard(shard),
+                        help="index/count of this instance, default SHARD_INDEX/SHARD_COUNT or 0/1")
+    parser.add_argument("--base-url", default=os.getenv("NOC_BASE_URL", DEFAULT_BASE_URL))
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SCRAPE_WORKERS", "4")))
+    parser.add_argument("--rate", type=float, default=float(os.getenv("SCRAPE_RATE", "2")),
+                        help="requests per second per host, 0 for no limit")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--save-pages", default=None, help="also write the fetched pages to this directory")
+    parser.add_argument("--parser", choices=("auto", "lxml", "bs4"), default=None,
+                        help="html parser backend, default WIFIAP_PARSER or auto (lxml if installed)")
+    parser.add_argument("--payload-version", type=int, choices=(1, 2),
+                        default=int(os.getenv("WIFIAP_PAYLOAD_VERSION", "2")),
+                        help="2 leaves out AP metadata that was already uploaded unchanged")
+    parser.add_argument("--state-file", default=None,
+                        help="what the version 2 upload remembers between runs, default in WIFIAP_DATA_DIR")
+    parser.add_argument("--spool-dir", default=None, help="default in WIFIAP_DATA_DIR")
+    parser.add_argument("--full", action="store_true", help="send all AP metadata this time")
+    parser.add_argument("--no-gzip", action="store_true")
+    parser.add_argument("--dry-run", action="store_true", help="scrape and combine, but don't spool or upload")
+    parser.add_argument("--daemon", action="store_true", help="keep running, one cycle every --interval seconds")
+    parser.add_argument("--interval", type=int, default=int(os.getenv("SCRAPE_INTERVAL", "600")))
+    args = parser.parse_args(argv)
+
+    # several instances sharing a data directory each get their own spool and state
+    base_dir = os.getenv("WIFIAP_DATA_DIR", "data")
+    data_dir = base_dir
+    if args.shard[1] > 1:
+        data_dir = os.path.join(base_dir, f"shard-{args.shard[0]}-of-{args.shard[1]}")
+    state_file = args.state_file or os.path.join(data_dir, "upload_state.json")
+    spool_dir = args.spool_dir or os.path.join(data_dir, "spool")
+
+    server_url = os.getenv("SERVER_URL")
+    assert server_url or args.dry_run, "SERVER_URL must be set in .env"
+
+    def cycle_fn(spool):
+        return lambda cycle: run_cycle(scraper, spool, cycle, args.targets, args.shard)
+
+    scraper = Scraper(args.base_url, workers=args.workers, rate=args.rate, timeout=args.timeout,
+                      save_dir=args.save_pages, parser=args.parser)
+    try:
+        if args.dry_run:
+            return 0 if cycle_fn(None)(0) else 1
+
+        spool = Spool(spool_dir)
+        if args.spool_dir is None:
+            # after a change of SHARD_COUNT the batches spooled under the old layout are sent from here
+            for stale in stale_spool_dirs(base_dir, args.shard):
+                taken = spool.adopt(stale)
+                if taken:
+                    print(f"Took over {taken} spooled batches from {stale}")
+                bad = glob.glob(os.path.join(stale, "*.bad"))
+                if bad:
+                    print(f"Warning: {len(bad)} quarantined batches left in {stale}")
+        flusher = Flusher(spool, scraper.session, server_url, state=UploadState(state_file),
+                          version=args.payload_version, compress=not args.no_gzip, full=args.full)
+        if args.daemon:
+            Daemon(cycle_fn(spool), flusher, args.interval).run()
+            return 0
+
+        complete = cycle_fn(spool)(int(slot_start(time.time(), args.interval)))
+        uploaded = flusher.flush()
+        return 0 if complete and uploaded else 1
+    finally:
+        scraper.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
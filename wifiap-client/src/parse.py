@@ -0,0 +1,153 @@
+import os
+
+from bs4 import BeautifulSoup
+
+try:
+    import lxml.html
+except ImportError:  # the bs4 backend below works without it
+    lxml = None
+
+# a NOC coverage page (organization or building) -> list of row dicts, one per AP:
+# the table columns plus the breadcrumb key (Organisation / Gebäude) with the page's value, Online as a bool,
+# everything from the "Gesamt" row on left out.
+#
+# two backends with that same output: "bs4" (BeautifulSoup + html.parser, pure python) and "lxml"
+# (libxml2 + xpath, several times faster on the large building pages). src/bench_parse.py checks that they
+# agree on saved pages. "auto" takes lxml when it is installed
+
+KEY_PATH = "#breadcrumbs > nav > div > div > ol > li:nth-child(3) > a"
+VALUE_PATH = "#breadcrumbs > nav > div > div > ol > li:nth-child(4) > div"
+# the same two selectors for lxml. *[n][self::li] is nth-child: counts all siblings, not only li
+KEY_XPATH = "//*[@id='breadcrumbs']/nav/div/div/ol/*[3][self::li]/a"
+VALUE_XPATH = "//*[@id='breadcrumbs']/nav/div/div/ol/*[4][self::li]/div"
+TABLE_XPATH = "//table[contains(concat(' ', normalize-space(@class), ' '), ' table-sortable ')]"
+
+
+def parse_page_bs4(html):
+    soup = BeautifulSoup(html, "html.parser")
+
+    # Locate the table
+    table = soup.find("table", class_="table-sortable")
+
+    # Extract table rows
+    rows = table.find_all("tr")
+
+    key = soup.select_one(KEY_PATH).get_text(strip=True)
+    value = soup.select_one(VALUE_PATH).get_text(strip=True)
+    key = key.replace("Organisationen", "Organisation")
+
+    table_data = []
+    header = []
+    for row in rows:
+        cells = row.find_all("td")
+        if cells:
+            assert len(header) > 0, "Header must be defined before data"
+            data = [cell.get_text(strip=True) for cell in cells]
+            data = data + [value]
+
+            if len(data) != len(header):
+                print(
+                    f"Row {data} has different number of columns than header {header}"
+                )
+                continue
+            if data[0] == "Gesamt":
+                break
+            idx_for_online = header.index("Online")
+            # online col has an <i> tag with class "fa fa-check"
+            data[idx_for_online] = (
+                "fa-check" in cells[idx_for_online].find("i")["class"]
+            )
+
+            data = dict(zip(header, data))
+
+            table_data.append(data)
+        else:
+            header = row.find_all("th")
+            if header:
+                header = [cell.get_text(strip=True) for cell in header]
+                assert key not in header
+                header = header + [key]
+
+    return table_data
+
+
+# elements whose content get_text leaves out (bs4 keeps it as Script / Stylesheet / TemplateString, not text)
+SKIP_TEXT_TAGS = ("script", "style", "template")
+
+
+def _text_pieces(element):
+    if element.text:
+        yield element.text
+    for child in element:
+        if isinstance(child.tag, str) and child.tag not in SKIP_TEXT_TAGS:
+            yield from _text_pieces(child)
+        # the text after a skipped element (or a comment) still belongs to the parent
+        if child.tail:
+            yield child.tail
+
+
+def _text(element):
+    # get_text(strip=True): every text piece stripped, empty ones dropped, joined without separator
+    return "".join(piece.strip() for piece in _text_pieces(element))
+
+
+def _first(root, xpath):
+    found = root.xpath(xpath)
+    if not found:
+        raise ValueError(f"Nothing matches {xpath}")
+    return found[0]
+
+
+def parse_page_lxml(html):
+    root = lxml.html.document_fromstring(html)
+    table = _first(root, TABLE_XPATH)
+
+    key = _text(_first(root, KEY_XPATH)).replace("Organisationen", "Organisation")
+    value = _text(_first(root, VALUE_XPATH))
+
+    table_data = []
+    header = []
+    idx_for_online = None
+    for row in table.iter("tr"):
+        cells = list(row.iter("td"))
+        if cells:
+            assert len(header) > 0, "Header must be defined before data"
+            data = [_text(cell) for cell in cells]
+            data.append(value)
+
+            if len(data) != len(header):
+                print(
+                    f"Row {data} has different number of columns than header {header}"
+                )
+                continue
+            if data[0] == "Gesamt":
+                break
+            if idx_for_online is None:
+                idx_for_online = header.index("Online")
+            icon = cells[idx_for_online].find(".//i")
+            if icon is None:
+                raise ValueError(f"Online cell without icon in row {data}")
+            data[idx_for_online] = "fa-check" in icon.get("class", "").split()
+
+            table_data.append(dict(zip(header, data)))
+        else:
+            header = [_text(cell) for cell in row.iter("th")]
+            if header:
+                assert key not in header
+                header.append(key)
+                idx_for_online = None
+
+    return table_data
+
+
+BACKENDS = {"bs4": parse_page_bs4, "lxml": parse_page_lxml}
+
+
+def get_parser(name=None):
+    # name: "auto" (default, also from WIFIAP_PARSER), "lxml" or "bs4"
+    name = name or os.getenv("WIFIAP_PARSER", "auto")
+    if name == "auto":
+        name = "lxml" if lxml is not None else "bs4"
+    if name == "lxml" and lxml is None:
+        raise ImportError("the lxml parser backend needs the lxml package")
+    return BACKENDS[name]
@@ -0,0 +1,106 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from parse import get_parser
+
+DEFAULT_BASE_URL = "https://noc-portal.itc.rwth-aachen.de/mops-admin/coverage"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
+
+
+class HostRateLimiter:
+    # at most `per_second` requests per host, shared by all workers. every caller reserves the next free
+    # slot of its host under the lock and sleeps outside of it, so waiting workers don't block other hosts
+    def __init__(self, per_second):
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self.next_slot = {}
+        self.lock = threading.Lock()
+
+    def wait(self, url):
+        if self.interval == 0:
+            return
+        host = urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+def make_session(pool_size):
+    # one keep-alive session for all pages, with a connection per worker. connection errors and 502/503/504
+    # of the GETs are retried with backoff, the POSTs to our server are not
+    session = requests.Session()
+    session.headers["User-Agent"] = USER_AGENT
+    retry = Retry(
+        total=2,
+        backoff_factor=0.5,
+        status_forcelist=(502, 503, 504),
+        allowed_methods=("GET",),
+    )
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def target_url(base_url, kind, ident):
+    # kind is "organizations" or "buildings"
+    return f"{base_url.rstrip('/')}/{kind}/{ident}"
+
+
+def page_filename(kind, ident):
+    return f"{kind}_{ident}.html"
+
+
+class Scraper:
+    def __init__(self, base_url=DEFAULT_BASE_URL, workers=4, rate=2.0, timeout=30, save_dir=None, parser=None):
+        self.base_url = base_url
+        self.parse = get_parser(parser)
+        self.timeout = timeout
+        self.save_dir = save_dir
+        self.session = make_session(workers)
+        self.limiter = HostRateLimiter(rate)
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="scrape")
+
+    def fetch(self, kind, ident):
+        url = target_url(self.base_url, kind, ident)
+        self.limiter.wait(url)
+        response = self.session.get(url, timeout=self.timeout)
+        response.raise_for_status()
+        if self.save_dir is not None:
+            os.makedirs(self.save_dir, exist_ok=True)
+            with open(os.path.join(self.save_dir, page_filename(kind, ident)), "w", encoding="utf-8") as f:
+                f.write(response.text)
+        return response.text
+
+    def grab_data(self, kind, ident):
+        return self.parse(self.fetch(kind, ident))
+
+    def scrape(self, targets):
+        # targets: [(kind, ident)]. returns (rows of all pages in target order, [(target, error)]);
+        # a page that fails to load or parse only loses its own rows
+        futures = [self.pool.submit(self.grab_data, kind, ident) for kind, ident in targets]
+        all_data = []
+        failures = []
+        for target, future in zip(targets, futures):
+            try:
+                rows = future.result()
+            except Exception as err:
+                print(f"Failed to scrape {target[0]}/{target[1]}: {err!r}")
+                failures.append((target, err))
+                continue
+            print(f"{target[0]}/{target[1]}: {len(rows)} rows")
+            all_data.extend(rows)
+        return all_data, failures
+
+    def close(self):
+        self.pool.shutdown()
+        self.session.close()
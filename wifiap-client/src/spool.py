@@ -0,0 +1,161 @@
+import json
+import os
+import random
+import time
+
+import requests
+
+from upload import RejectedUpload, upload
+
+# every scraped cycle is written to the spool before anything is sent, one file per batch named by a
+# running sequence number: written to a temp file, fsynced and renamed, and only deleted once the server
+# accepted all of its chunks. the one change to a spooled batch: rows of a chunk the server refuses for
+# good move to a .bad file next to it, the other chunks go on as usual. the flusher sends the batches oldest first
+# and stops at the first failure, so batches reach the server in order; after a failure it backs off
+# exponentially (with jitter) before trying again. a server restart or outage therefore only delays
+# the data, the batches carry their scrape time and the server stores them under it.
+
+
+def pending_batches(directory):
+    # the batch files in directory, oldest first
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(".json") and name.split(".")[0].isdigit()
+    )
+
+
+class Spool:
+    def __init__(self, directory, max_batches=2016):
+        # max_batches: oldest batches are dropped beyond this, 2016 = two weeks of 10 minute cycles
+        self.directory = directory
+        self.max_batches = max_batches
+        os.makedirs(directory, exist_ok=True)
+        pending = self.pending()
+        self.seq = int(os.path.basename(pending[-1]).split(".")[0]) + 1 if pending else 0
+
+    def pending(self):
+        return pending_batches(self.directory)
+
+    def append(self, batch):
+        path = os.path.join(self.directory, f"{self.seq:012d}.json")
+        self._write(path, batch)
+        self.seq += 1
+
+        pending = self.pending()
+        for old in pending[: max(0, len(pending) - self.max_batches)]:
+            print(f"Spool full, dropping {old}")
+            os.remove(old)
+        return path
+
+    def load(self, path):
+        with open(path, encoding="utf-8") as f:
+            batch = json.load(f)
+        if not isinstance(batch, dict) or "header" not in batch or "data" not in batch:
+            raise ValueError("not a batch, header or data missing")
+        return batch
+
+    def _write(self, path, batch):
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(batch, f, separators=(",", ":"))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def remove(self, path):
+        os.remove(path)
+
+    def adopt(self, directory):
+        # moves the pending batches of another spool directory (an old shard layout) behind ours, oldest first.
+        # every file is claimed with a rename, so instances adopting the same directory never both take a batch.
+        # returns the number of batches taken over
+        taken = 0
+        for path in pending_batches(directory):
+            try:
+                os.replace(path, os.path.join(self.directory, f"{self.seq:012d}.json"))
+            except FileNotFoundError:
+                continue  # another instance was faster
+            self.seq += 1
+            taken += 1
+        return taken
+
+    def quarantine(self, path):
+        # a batch that can't be read or that the server rejects is kept aside instead of blocking
+        # everything behind it
+        os.replace(path, self._bad_path(path))
+
+    def _bad_path(self, path):
+        # a batch can have rows set aside more than once (quarantine_rows), every part gets its own file
+        bad = path + ".bad"
+        n = 1
+        while os.path.exists(bad):
+            bad = f"{path}.{n}.bad"
+            n += 1
+        return bad
+
+    def quarantine_rows(self, path, batch, ranges):
+        # sets the rows in ranges ([(start, end)] of batch["data"]) aside as a .bad batch of their own and keeps
+        # the rest of the batch pending. returns the remaining batch
+        rows = batch["data"]
+        bad = set(i for start, end in ranges for i in range(start, end))
+        self._write(self._bad_path(path), {**batch, "data": [row for i, row in enumerate(rows) if i in bad]})
+        batch = {**batch, "data": [row for i, row in enumerate(rows) if i not in bad]}
+        self._write(path, batch)
+        return batch
+
+
+class Flusher:
+    def __init__(self, spool, session, server_url, state=None, version=2, compress=True,
+                 min_backoff=5.0, max_backoff=600.0, full=False):
+        # full: send all AP metadata with the next batch the server accepts (--full), also in the daemon
+        self.spool = spool
+        self.session = session
+        self.server_url = server_url
+        self.state = state
+        self.version = version
+        self.compress = compress
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self.full = full
+        self.failures = 0
+        self.retry_at = 0.0  # time.monotonic()
+
+    def due(self):
+        return time.monotonic() >= self.retry_at
+
+    def flush(self, full=False):
+        # sends pending batches in order, returns whether the spool is empty afterwards
+        full = full or self.full
+        for path in self.spool.pending():
+            try:
+                batch = self.spool.load(path)
+            except ValueError as err:
+                print(f"Unreadable spool batch {path}: {err!r}")
+                self.spool.quarantine(path)
+                continue
+            # cycle, shard, scraped_at, ... go along with every chunk
+            extra = {key: value for key, value in batch.items() if key not in ("header", "data")}
+            try:
+                ok = upload(self.session, self.server_url, batch["header"], batch["data"], state=self.state,
+                            version=self.version, compress=self.compress, full=full, extra=extra)
+            except RejectedUpload as err:
+                # the accepted chunks are done, a resend of them would be harmless anyway. only the refused rows
+                # are set aside, the others stay pending if they didn't get through
+                print(f"Server rejected {err} of {path}")
+                self.spool.quarantine_rows(path, batch, err.ranges)
+                ok = err.others_ok
+            except requests.RequestException as err:
+                print(f"Upload of {path} failed: {err!r}")
+                ok = False
+            if not ok:
+                self.failures += 1
+                backoff = min(self.max_backoff, self.min_backoff * 2 ** (self.failures - 1))
+                backoff *= random.uniform(0.8, 1.2)
+                self.retry_at = time.monotonic() + backoff
+                print(f"{len(self.spool.pending())} batches spooled, retrying in {backoff:.0f}s")
+                return False
+            self.spool.remove(path)
+            self.failures = 0
+            full = self.full = False
+        return True
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+import argparse
+import gzip
+import json
+import os
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from scrape import page_filename
+
+# python src/stub_server.py PAGES_DIR [--port 8800] [--delay-ms 300] [--fail-posts 3]
+#
+# serves pages saved with main.py --save-pages under the NOC paths, .../organizations/<id> and
+# .../buildings/<id>, for trying out the scraper without hitting the portal. --delay-ms mimics the
+# portal's latency, so the concurrent fetch has something to overlap. unknown pages are a 404.
+# it also takes the uploads (any POST path, so SERVER_URL can point here): checks them like the server does,
+# gzip, 500kb after inflating, version 1/2, and prints a line per chunk. --fail-posts answers the first
+# uploads with a 503, like a restarting server, to see the spool replay them
+
+MAX_BODY = 500 * 1024
+
+
+def make_handler(pages_dir, delay, fail_posts=0):
+    failures_left = [fail_posts]
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep-alive, like the real portal
+
+        def do_GET(self):
+            parts = self.path.split("?")[0].rstrip("/").split("/")
+            path = None
+            if len(parts) >= 2:
+                path = os.path.join(pages_dir, page_filename(parts[-2], parts[-1]))
+            if delay:
+                time.sleep(delay)
+            if path is None or not os.path.isfile(path):
+                self.send_error(404)
+                return
+            with open(path, "rb") as f:
+                body = f.read()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            if failures_left[0] > 0:
+                failures_left[0] -= 1
+                self.reply(503, {"error": True, "msg": "stub outage"})
+                return
+            if self.headers.get("Content-Encoding") == "gzip":
+                body = gzip.decompress(body)
+            if len(body) > MAX_BODY:
+                self.reply(413, {"error": True, "msg": "too large"})
+                return
+            data = json.loads(body)
+            if data.get("version") not in (1, 2) or "header" not in data or "data" not in data:
+                self.reply(400, {"error": True, "msg": "Invalid body"})
+                return
+            static = sum(1 for row in data["data"] if row[data["header"].index("Organisation")] is not None)
+            print(f"upload v{data['version']} cycle {data.get('cycle')} chunk {data.get('chunk')}/{data.get('chunks')}: "
+                  f"{len(data['data'])} rows, {static} with metadata, {len(body) / 1000:.1f} kB json", flush=True)
+            self.reply(200, {"status": "ok"})
+
+        def reply(self, status, obj):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="serve saved NOC pages for local scraper runs")
+    parser.add_argument("pages_dir")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--delay-ms", type=float, default=300)
+    parser.add_argument("--fail-posts", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    handler = make_handler(args.pages_dir, args.delay_ms / 1000, args.fail_posts)
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), handler)
+    print(f"Serving {args.pages_dir} on http://127.0.0.1:{args.port}/mops-admin/coverage")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,41 @@
+import json
+import os
+import zlib
+
+# the pages to scrape come from targets.json ({"organizations": {id: note}, "buildings": {id: note}}),
+# WIFIAP_TARGETS or --targets for another file. with several scraper instances every target belongs to
+# exactly one shard, crc32("<kind>/<id>") % shard count: the same on every machine and every run, and adding
+# a target moves no other target to a different shard. each instance scrapes and deduplicates its own
+# targets only. an AP that shows up on pages of two shards is sent by both, the server keeps one row per
+# AP and last_online check (wifi_data's unique key), so it is not counted twice
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "targets.json")
+# organizations first, so an AP listed under both keeps its organization row
+KINDS = ("organizations", "buildings")
+
+
+def load_targets(path=None):
+    # [(kind, id)] in file order, organizations first
+    path = path or os.getenv("WIFIAP_TARGETS") or DEFAULT_PATH
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    unknown = set(config) - set(KINDS)
+    if unknown:
+        raise ValueError(f"Unknown target kinds in {path}: {sorted(unknown)}")
+    return [(kind, str(ident)) for kind in KINDS for ident in config.get(kind, {})]
+
+
+def parse_shard(text):
+    # "index/count", e.g. "0/3", -> (0, 3)
+    index, count = (int(part) for part in text.split("/"))
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Invalid shard {text}, expected index/count with 0 <= index < count")
+    return index, count
+
+
+def shard_of(kind, ident, count):
+    return zlib.crc32(f"{kind}/{ident}".encode("utf-8")) % count
+
+
+def shard_targets(targets, index, count):
+    return [(kind, ident) for kind, ident in targets if shard_of(kind, ident, count) == index]
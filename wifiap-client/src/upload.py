@@ -0,0 +1,180 @@
+import gzip
+import json
+import os
+import time
+
+# uploads to the server's /api/v1/wifiap
+#
+# version 1: {"version": 1, "header": [...], "data": [[...], ...]}, every row complete.
+# version 2: the same, but the static AP metadata (STATIC_COLUMNS) is null for APs whose metadata was
+#   already uploaded unchanged, the server then skips their wifi_data_apnames write. what was uploaded is
+#   remembered in a state file, updated only for chunks the server acknowledged, and a full upload is
+#   forced every FULL_EVERY_H hours (or with --full), so a lost state file or database cannot leave
+#   metadata missing for long.
+#
+# both versions are gzipped (Content-Encoding, inflated by express.json) and split into chunks whose
+# *uncompressed* json stays below MAX_CHUNK_BYTES, the server's 500kb limit applies after inflating.
+# every chunk is its own transaction on the server, resending a chunk is harmless (wifi_data is unique
+# on apname + last_online)
+
+STATIC_COLUMNS = ("Cover / Ort", "Gebäude", "Organisation")
+MAX_CHUNK_BYTES = 400_000
+FULL_EVERY_H = 24
+SEPARATORS = (",", ":")
+
+
+class RejectedUpload(Exception):
+    # the server refused chunks for good (malformed, too large), sending them again won't help.
+    # raised by upload() after it tried every chunk: ranges are the (start, end) rows of the refused chunks,
+    # others_ok whether all the other chunks were accepted
+    def __init__(self, message, ranges=(), others_ok=True):
+        super().__init__(message)
+        self.ranges = list(ranges)
+        self.others_ok = others_ok
+
+
+class UploadState:
+    # static metadata last uploaded per AP name, {"full_at": unix time, "static": {name: [values]}}
+    def __init__(self, path, full_every_h=FULL_EVERY_H):
+        self.path = path
+        self.full_every_h = full_every_h
+        self.full_at = 0.0
+        self.static = {}
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    saved = json.load(f)
+                self.full_at = saved["full_at"]
+                self.static = saved["static"]
+            except (ValueError, KeyError) as err:
+                print(f"Ignoring unreadable upload state {path}: {err!r}")
+
+    def needs_full(self):
+        return time.time() - self.full_at > self.full_every_h * 3600
+
+    def reset(self):
+        self.full_at = time.time()
+        self.static = {}
+
+    def strip(self, header, table_data):
+        # rows with the static columns nulled where they match what was last uploaded
+        idx_name = header.index("Name")
+        idx_static = [header.index(col) for col in STATIC_COLUMNS if col in header]
+        out = []
+        for row in table_data:
+            if self.static.get(row[idx_name]) == [row[i] for i in idx_static]:
+                row = list(row)
+                for i in idx_static:
+                    row[i] = None
+            out.append(row)
+        return out
+
+    def remember(self, header, table_data):
+        # table_data as built by combine(), not the stripped rows
+        idx_name = header.index("Name")
+        idx_static = [header.index(col) for col in STATIC_COLUMNS if col in header]
+        for row in table_data:
+            self.static[row[idx_name]] = [row[i] for i in idx_static]
+
+    def save(self):
+        if self.path is None:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"full_at": self.full_at, "static": self.static}, f)
+        os.replace(tmp, self.path)
+
+
+def chunk_rows(rows, max_bytes=MAX_CHUNK_BYTES, overhead=0):
+    # [(start, end)] slices of rows whose json stays below max_bytes, overhead is the rest of the payload
+    chunks = []
+    start = 0
+    size = overhead
+    for i, row in enumerate(rows):
+        row_bytes = len(json.dumps(row, separators=SEPARATORS).encode("utf-8")) + 1
+        if i > start and size + row_bytes > max_bytes:
+            chunks.append((start, i))
+            start = i
+            size = overhead
+        size += row_bytes
+    if start < len(rows):
+        chunks.append((start, len(rows)))
+    return chunks
+
+
+def build_payloads(header, rows, version=2, max_bytes=MAX_CHUNK_BYTES, extra=None):
+    # [(payload dict, (start, end) of rows)], extra: more top level fields for every chunk
+    base = {"version": version, "header": header, **(extra or {})}
+    empty = {**base, "data": [], "chunk": 0, "chunks": 0}
+    overhead = len(json.dumps(empty, separators=SEPARATORS).encode("utf-8")) + 16
+    chunks = chunk_rows(rows, max_bytes, overhead)
+    return [
+        ({**base, "chunk": i, "chunks": len(chunks), "data": rows[start:end]}, (start, end))
+        for i, (start, end) in enumerate(chunks)
+    ]
+
+
+def encode(payload, compress=True):
+    # (body bytes, headers)
+    body = json.dumps(payload, separators=SEPARATORS).encode("utf-8")
+    headers = {"Content-Type": "application/json"}
+    if compress:
+        body = gzip.compress(body, compresslevel=6)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+
+def post_payload(session, server_url, payload, compress=True, timeout=60):
+    # bytes sent, None if the server did not accept the chunk this time
+    body, headers = encode(payload, compress)
+    response = session.post(server_url, data=body, headers=headers, timeout=timeout)
+    if response.status_code in (400, 413):
+        raise RejectedUpload(f"chunk {payload.get('chunk')}: {response.status_code} {response.text}")
+    if response.status_code != 200:
+        print(f"Upload of chunk {payload.get('chunk')} failed: {response.status_code} {response.text}")
+        return None
+    return len(body)
+
+
+def upload(session, server_url, header, table_data, state=None, version=2, compress=True,
+           max_bytes=MAX_CHUNK_BYTES, full=False, extra=None):
+    # returns whether every chunk was accepted, extra: more top level fields for the payloads.
+    # a refused chunk doesn't stop the others, RejectedUpload comes at the end
+    rows = table_data
+    if version >= 2 and state is not None:
+        if full or state.needs_full():
+            state.reset()
+        rows = state.strip(header, table_data)
+    # strip() copies exactly the rows it nulls
+    unchanged = sum(1 for a, b in zip(rows, table_data) if a is not b)
+
+    payloads = build_payloads(header, rows, version, max_bytes, extra)
+    accepted = 0
+    sent_bytes = 0
+    rejected = []  # (start, end) of the refused chunks
+    try:
+        for payload, (start, end) in payloads:
+            try:
+                sent = post_payload(session, server_url, payload, compress)
+            except RejectedUpload as err:
+                print(f"Server rejected {err}")
+                rejected.append((start, end))
+                continue
+            if sent is None:
+                continue
+            accepted += 1
+            sent_bytes += sent
+            if version >= 2 and state is not None:
+                state.remember(header, table_data[start:end])
+    finally:
+        # what the server acknowledged so far, also when a chunk raised
+        if version >= 2 and state is not None:
+            state.save()
+
+    print(f"Uploaded {accepted}/{len(payloads)} chunks of {len(rows)} APs, {sent_bytes / 1000:.1f} kB sent, "
+          f"static metadata omitted for {unchanged}")
+    if rejected:
+        raise RejectedUpload(f"{len(rejected)} of {len(payloads)} chunks", rejected,
+                             others_ok=accepted + len(rejected) == len(payloads))
+    return accepted == len(payloads)